@@ -0,0 +1,279 @@
+'''
+Pack exposures into Slurm batch jobs for `nightwatch monitor --batch`
+
+Instead of one exclusive full-node job per exposure, pending exposures are
+collected into packs that are submitted as a single allocation.  Within
+the job, `nightwatch runpack` feeds the exposures of the pack through an
+ExposurePipeline whose stages run several exposures at once, all sharing
+one pool of worker processes sized to the node.
+
+A pack is submitted when it is full, when its oldest exposure has waited
+longer than `max_wait` seconds, or when discovery goes idle, so that
+realtime exposures are not held back while catchup fills whole packs.
+
+Submission goes through a backend with a `submit(scriptfile)` method that
+returns a job id: SbatchBackend calls sbatch, while FakeSbatchBackend
+records submissions and optionally runs the scripts locally, so that the
+packing and dispatch logic can be tested without Slurm.
+'''
+
+import os, sys, time
+import math
+import shlex
+import subprocess
+import traceback
+
+import desiutil.log
+
+
+def read_packfile(filename):
+    '''Returns list of raw data files listed in pack file, one per line'''
+    with open(filename) as fx:
+        return [line.strip() for line in fx
+                if line.strip() != '' and not line.startswith('#')]
+
+
+def parse_sbatch_directives(scriptfile):
+    '''
+    Returns dict of options from the #SBATCH lines of a batch script
+
+    Options without a value (e.g. --exclusive) map to True.
+    '''
+    tokens = list()
+    with open(scriptfile) as fx:
+        for line in fx:
+            if line.startswith('#SBATCH'):
+                tokens.extend(shlex.split(line[len('#SBATCH'):]))
+
+    directives = dict()
+    i = 0
+    while i < len(tokens):
+        key = tokens[i]
+        if '=' in key and key.startswith('--'):
+            key, value = key.split('=', 1)
+            i += 1
+        elif i+1 < len(tokens) and not tokens[i+1].startswith('-'):
+            value = tokens[i+1]
+            i += 2
+        else:
+            value = True
+            i += 1
+        directives[key] = value
+
+    return directives
+
+
+class SbatchBackend(object):
+    '''Submit batch scripts to Slurm with sbatch'''
+
+    def submit(self, scriptfile):
+        '''Submit scriptfile, returning the Slurm job id as a string'''
+        proc = subprocess.run(['sbatch', '--parsable', scriptfile],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError('sbatch {} failed with code {}: {}'.format(
+                scriptfile, proc.returncode, proc.stderr.strip()))
+
+        #- --parsable prints "jobid" or "jobid;cluster"
+        return proc.stdout.strip().split(';')[0]
+
+    def __repr__(self):
+        return 'SbatchBackend()'
+
+
+class FakeSbatchBackend(object):
+    '''
+    Stand-in for sbatch that records submitted scripts
+
+    Each submission is appended to self.jobs as a dict with keys jobid,
+    scriptfile, directives (see parse_sbatch_directives), and returncode.
+    '''
+
+    def __init__(self, execute=False, first_jobid=1):
+        '''
+        Options:
+            execute : if True, run each script with bash when it is
+                submitted, writing its output to the --output file
+            first_jobid : job id of the first submission
+        '''
+        self.execute = execute
+        self.next_jobid = first_jobid
+        self.jobs = list()
+
+    def submit(self, scriptfile):
+        '''Record (and optionally run) scriptfile, returning a fake job id'''
+        jobid = str(self.next_jobid)
+        self.next_jobid += 1
+        job = dict(jobid=jobid, scriptfile=scriptfile,
+                   directives=parse_sbatch_directives(scriptfile), returncode=None)
+
+        if self.execute:
+            env = dict(os.environ, SLURM_JOB_ID=jobid)
+            output = job['directives'].get('--output', os.devnull)
+            output = output.replace('%j', jobid)
+            with open(output, 'w') as logfx:
+                job['returncode'] = subprocess.call(['bash', scriptfile], env=env,
+                    stdout=logfx, stderr=subprocess.STDOUT)
+
+        self.jobs.append(job)
+        return jobid
+
+    def __repr__(self):
+        return 'FakeSbatchBackend({} jobs)'.format(len(self.jobs))
+
+
+class ExposurePacker(object):
+    '''Collect pending exposures and submit them in packs as batch jobs'''
+
+    def __init__(self, outdir, backend=None, plotdir=None, cameras=None,
+                 max_exposures=8, max_wait=120, concurrent=4,
+                 queue='realtime', max_time=15, exposure_time=5, startup_time=2,
+                 batchopts='-N 1 -C haswell -A desi', run_options=''):
+        '''
+        Args:
+            outdir : base output directory; pack files and scripts are
+                written to outdir/batch/
+
+        Options:
+            backend : object with submit(scriptfile) -> jobid;
+                default SbatchBackend()
+            plotdir : plot output directory passed to runpack
+            cameras : list of cameras to process; default all
+            max_exposures : max exposures per pack
+            max_wait : max seconds to hold a partial pack
+            concurrent : number of exposures processed at once in each job
+            queue : Slurm QOS
+            max_time : batch job time limit [minutes]; packs are sized so
+                that their estimated time fits
+            exposure_time : estimated minutes to process one exposure
+            startup_time : estimated minutes of job startup overhead
+            batchopts : additional sbatch options
+            run_options : additional options for `nightwatch runpack`
+        '''
+        self.outdir = os.path.abspath(outdir)
+        self.backend = SbatchBackend() if backend is None else backend
+        self.plotdir = None if plotdir is None else os.path.abspath(plotdir)
+        self.cameras = cameras
+        self.max_exposures = max(1, max_exposures)
+        self.max_wait = max_wait
+        self.concurrent = max(1, concurrent)
+        self.queue = queue
+        self.max_time = max_time
+        self.exposure_time = exposure_time
+        self.startup_time = startup_time
+        self.batchopts = batchopts
+        self.run_options = run_options
+        self.batchdir = os.path.join(self.outdir, 'batch')
+
+        self.pending = list()   #- (rawfile, time added)
+        self.submitted = dict() #- jobid -> list of rawfiles
+        self.failed = list()    #- rawfiles that couldn't be submitted
+        self._npacks = 0
+
+    def estimate_time(self, nexp):
+        '''Returns estimated minutes to process nexp exposures in one job'''
+        return self.startup_time + self.exposure_time * math.ceil(nexp / self.concurrent)
+
+    def pack_size(self):
+        '''Returns max number of exposures in a pack that fits in max_time'''
+        rounds = int((self.max_time - self.startup_time) // self.exposure_time)
+        return max(1, min(self.max_exposures, rounds * self.concurrent))
+
+    def add(self, rawfile, now=None):
+        '''Add rawfile to the pending exposures'''
+        if now is None:
+            now = time.time()
+        self.pending.append((os.path.abspath(rawfile), now))
+
+    def flush(self, idle=False, now=None):
+        '''
+        Submit packs of pending exposures
+
+        Options:
+            idle : if True, also submit a partial pack, e.g. because no more
+                exposures are expected soon
+            now : current time; default time.time()
+
+        Full packs are always submitted; a partial pack is submitted if
+        idle or if its oldest exposure has waited at least max_wait seconds.
+        Returns list of job ids submitted.
+        '''
+        if now is None:
+            now = time.time()
+
+        jobids = list()
+        size = self.pack_size()
+        while len(self.pending) > 0:
+            waited = now - self.pending[0][1]
+            if len(self.pending) < size and not idle and waited < self.max_wait:
+                break
+
+            rawfiles = [rawfile for rawfile, t in self.pending[0:size]]
+            self.pending = self.pending[size:]
+            try:
+                jobids.append(self.submit(rawfiles))
+            except Exception as err:
+                self.failed.extend(rawfiles)
+                print("Failed to submit batch job for {} exposures".format(len(rawfiles)))
+                print("Error message: {}".format(str(err)))
+                exc_info = sys.exc_info()
+                traceback.print_exception(*exc_info)
+                del exc_info
+                print("Now moving on ...")
+                sys.stdout.flush()
+
+        return jobids
+
+    def submit(self, rawfiles):
+        '''Write pack file and batch script for rawfiles and submit it'''
+        os.makedirs(self.batchdir, exist_ok=True)
+        self._npacks += 1
+        jobname = 'nightwatch-pack-{}-{:03d}'.format(
+            time.strftime('%Y%m%dT%H%M%S'), self._npacks)
+        packfile = os.path.join(self.batchdir, jobname+'.txt')
+        with open(packfile, 'w') as fx:
+            for rawfile in rawfiles:
+                fx.write(rawfile+'\n')
+
+        scriptfile = self.write_script(jobname, packfile, len(rawfiles))
+        jobid = self.backend.submit(scriptfile)
+        self.submitted[jobid] = list(rawfiles)
+
+        log = desiutil.log.get_logger()
+        log.info('Submitted batch job {} with {} exposures: {}'.format(
+            jobid, len(rawfiles), packfile))
+        return jobid
+
+    def write_script(self, jobname, packfile, nexp):
+        '''Write batch script to run `nightwatch runpack` on packfile'''
+        options = ['--packfile', packfile, '--outdir', self.outdir,
+                   '--concurrent', str(min(nexp, self.concurrent))]
+        if self.plotdir is not None:
+            options.extend(['--plotdir', self.plotdir])
+        if self.cameras is not None:
+            options.extend(['--cameras', ','.join(self.cameras)])
+        command = 'nightwatch runpack ' + ' '.join([shlex.quote(x) for x in options])
+        if self.run_options:
+            command += ' ' + self.run_options
+
+        minutes = int(math.ceil(min(self.max_time, self.estimate_time(nexp))))
+        scriptfile = os.path.join(self.batchdir, jobname+'.slurm')
+        with open(scriptfile, 'w') as fx:
+            fx.write(f"""#!/bin/bash -l
+
+#SBATCH {self.batchopts}
+#SBATCH --qos {self.queue}
+#SBATCH --time {minutes}
+#SBATCH --job-name {jobname}
+#SBATCH --output {self.batchdir}/{jobname}-%j.joblog
+#SBATCH --exclusive
+
+{command}
+""")
+
+        return scriptfile
+
+    def __repr__(self):
+        return 'ExposurePacker({} pending, {} submitted, {})'.format(
+            len(self.pending), len(self.submitted), self.backend)
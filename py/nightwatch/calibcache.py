@@ -0,0 +1,259 @@
+'''
+Cache of calibration products for in-process preproc and qproc
+
+Every preproc and qproc of a camera reads that camera's bias, dark, mask,
+pixflat, PSF, and fiberflat calibration products from $DESI_SPECTRO_CALIB
+and $DESI_SPECTRO_DARK again, which during calibration sequences means
+dozens of identical reads per camera per hour.  When qproc and preproc run
+within the shared worker processes, `install` wraps the desispec readers
+so that each worker keeps the products it has loaded in a CalibCache for
+the next exposures.
+
+Entries are keyed by the calibration file (which is specific to a camera)
+plus its modification time and size, so replaced calibration files are
+reread.  Images are read memory-mapped where possible, i.e. uncompressed
+and unscaled FITS images, in which case the data live in the OS page cache
+shared by all workers and don't count towards the cache size.  Other
+entries are kept in memory and evicted least recently used first once
+their total exceeds the cache size.  Callers get a copy of each entry,
+since preproc modifies e.g. the mask in place.
+
+The cache size per worker comes from $NIGHTWATCH_CALIB_CACHE in GB, set
+by `configure` before the worker pool starts; 0 disables the cache.  Since
+every worker holds its own cache, resources.CPUBudget adds the cache size
+to the memory of each worker when deciding how many workers fit.
+'''
+
+import os
+import copy
+import collections
+import functools
+import threading
+
+import numpy as np
+
+import desiutil.log
+
+#- environment variable with the cache size per process in GB
+CACHE_ENV = 'NIGHTWATCH_CALIB_CACHE'
+
+#- default cache size per process [GB]
+DEFAULT_CACHE_SIZE = 0.5
+
+_cache = None
+_installed = False
+_lock = threading.Lock()
+
+
+def _is_memmap(value):
+    '''Returns True if array value is backed by a memory-mapped file'''
+    while isinstance(value, np.ndarray):
+        if isinstance(value, np.memmap):
+            return True
+        value = value.base
+    return value is not None and type(value).__name__ == 'mmap'
+
+
+def _nbytes(value):
+    '''Returns private memory used by cached value in bytes (approximately)'''
+    if isinstance(value, np.ndarray):
+        return 0 if _is_memmap(value) else value.nbytes
+
+    #- e.g. XYTraceSet or FiberFlat: sum their array attributes
+    return sum([v.nbytes for v in getattr(value, '__dict__', dict()).values()
+                if isinstance(v, np.ndarray)])
+
+
+def _copy(value):
+    if isinstance(value, np.ndarray):
+        return np.array(value, copy=True)
+    else:
+        return copy.deepcopy(value)
+
+
+class CalibCache(object):
+    '''Memory-bounded LRU cache of calibration products keyed by file'''
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE*1e9):
+        '''
+        Options:
+            max_bytes : max total size of entries that aren't memory-mapped
+        '''
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  #- key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(kind, filename, *args, **kwargs):
+        '''
+        Returns cache key for reading filename with kind of reader and its
+        args, or None if filename doesn't exist
+        '''
+        try:
+            st = os.stat(filename)
+        except (OSError, TypeError):
+            return None
+        return (kind, os.path.abspath(filename), st.st_mtime, st.st_size,
+                args, tuple(sorted(kwargs.items())))
+
+    def get(self, kind, filename, reader, *args, **kwargs):
+        '''
+        Returns a copy of reader(filename, *args, **kwargs), from the cache
+        if filename is unchanged since it was last read
+        '''
+        key = self.key(kind, filename, *args, **kwargs)
+        if key is None:
+            return reader(filename, *args, **kwargs)
+
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return _copy(self.entries[key][0])
+
+        value = reader(filename, *args, **kwargs)
+        self.put(key, value)
+        return _copy(value)
+
+    def put(self, key, value):
+        '''Add value to the cache, evicting old entries to stay within max_bytes'''
+        nbytes = _nbytes(value)
+        with self._lock:
+            self.misses += 1
+            if nbytes > self.max_bytes:
+                return
+
+            #- drop older versions of the same file
+            for oldkey in [k for k in self.entries if k[0:2] == key[0:2] and k != key]:
+                self.nbytes -= self.entries.pop(oldkey)[1]
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                oldkey, (oldvalue, oldbytes) = self.entries.popitem(last=False)
+                self.nbytes -= oldbytes
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''Returns dict of hits, misses, entries, and bytes held in memory'''
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        entries=len(self.entries), nbytes=self.nbytes)
+
+    def __repr__(self):
+        return 'CalibCache({} entries, {:.2f}/{:.2f} GB, {} hits, {} misses)'.format(
+            len(self.entries), self.nbytes/1e9, self.max_bytes/1e9, self.hits, self.misses)
+
+
+def configure(size=DEFAULT_CACHE_SIZE):
+    '''
+    Set the cache size per process in GB for this process and the worker
+    processes it starts; 0 disables the cache
+
+    Must be called before the shared worker pool starts to affect workers.
+    '''
+    os.environ[CACHE_ENV] = str(size)
+
+
+def cache_size():
+    '''Returns the configured cache size per process in GB; 0 if disabled'''
+    try:
+        size = float(os.getenv(CACHE_ENV, DEFAULT_CACHE_SIZE))
+    except ValueError:
+        size = DEFAULT_CACHE_SIZE
+    return max(0.0, size)
+
+
+def get_cache():
+    '''Returns the process-wide CalibCache, or None if disabled'''
+    global _cache
+    with _lock:
+        if _cache is None:
+            size = cache_size()
+            if size <= 0:
+                return None
+            _cache = CalibCache(max_bytes=size*1e9)
+        return _cache
+
+
+def read_image(filename, hdu=0):
+    '''Read image from HDU hdu of filename, memory-mapped if possible'''
+    from astropy.io import fits
+    with fits.open(filename, memmap=True) as hdulist:
+        data = hdulist[hdu].data
+    return data
+
+
+def _cached(kind, reader):
+    '''Returns wrapper of reader(filename=..., ...) that goes through the cache'''
+    @functools.wraps(reader)
+    def wrapper(*args, **kwargs):
+        cache = get_cache()
+        if cache is None:
+            return reader(*args, **kwargs)
+        if len(args) > 0:
+            filename, args = args[0], args[1:]
+        else:
+            filename = kwargs.pop('filename', None)
+        if filename is None:
+            return reader(*args, **kwargs)
+        return cache.get(kind, filename, lambda f, *a, **k: reader(f, *a, **k), *args, **kwargs)
+
+    wrapper.uncached = reader
+    return wrapper
+
+
+def _image_reader(filename=None, camera=None, dateobs=None):
+    '''Like desispec.preproc.read_bias/read_mask/read_pixflat, but memory-mapped'''
+    if filename is None:
+        raise NotImplementedError
+    return read_image(filename, 0)
+
+
+def install():
+    '''
+    Route desispec calibration reads in this process through the cache
+
+    Wraps desispec.preproc.read_bias, read_mask, read_pixflat, read_dark,
+    and read_xytraceset, plus the PSF and fiberflat readers used by
+    desispec.scripts.qproc.  Does nothing if already installed or if the
+    cache is disabled.  Returns the CalibCache, or None.
+    '''
+    global _installed
+    cache = get_cache()
+    with _lock:
+        if _installed or cache is None:
+            return cache
+
+        import desispec.preproc
+
+        for name in ('read_bias', 'read_mask', 'read_pixflat'):
+            setattr(desispec.preproc, name, _cached(name, _image_reader))
+
+        desispec.preproc.read_dark = _cached('read_dark', desispec.preproc.read_dark)
+        desispec.preproc.read_xytraceset = _cached('read_xytraceset',
+                                                   desispec.preproc.read_xytraceset)
+
+        #- qproc needs more dependencies (e.g. specter) than preproc
+        try:
+            import desispec.scripts.qproc as qproc
+            qproc.read_xytraceset = _cached('read_xytraceset', qproc.read_xytraceset)
+            qproc.read_fiberflat = _cached('read_fiberflat', qproc.read_fiberflat)
+            qproc.read_average_flux_calibration = _cached('read_average_flux_calibration',
+                                                          qproc.read_average_flux_calibration)
+        except ImportError as err:
+            log = desiutil.log.get_logger()
+            log.debug('Not caching qproc calibrations: {}'.format(err))
+
+        _installed = True
+
+    log = desiutil.log.get_logger()
+    log.debug('Installed {} in process {}'.format(cache, os.getpid()))
+    return cache
@@ -0,0 +1,406 @@
+'''
+Discovery of new raw exposures for `nightwatch monitor`
+
+Two backends share the same interface:
+
+  * PollingFinder rescans indir/YEARMMDD/EXPID/ on every call, which works on
+    every filesystem but adds up to `waittime` seconds of latency.
+  * InotifyFinder asks the Linux kernel to deliver file creation events for the
+    latest night, so new exposures are noticed as soon as their raw data file
+    is closed or renamed into place.  It still rescans occasionally as a
+    safety net in case events are lost.
+
+Use `get_finder` to pick a backend.
+'''
+
+import os, re, time
+import ctypes
+import ctypes.util
+import select
+import struct
+import sys
+
+import desiutil.log
+
+from . import run
+
+#- inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+#- Network/parallel filesystems that do not reliably deliver inotify events
+#- for writes made by other hosts
+_NO_EVENT_FSTYPES = ('nfs', 'nfs4', 'lustre', 'gpfs', 'dvs', 'cifs', 'smb3',
+                     'fuse.sshfs', 'afs', 'ceph', 'beegfs')
+
+_re_night = re.compile(r'^20\d{6}$')
+_re_expid = re.compile(r'^\d{8}$')
+_re_rawfile = re.compile(r'^desi-\d{8}\.fits\.fz$')
+
+
+def _load_libc():
+    '''Returns libc with inotify functions, or None if unavailable'''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+def get_fstype(path):
+    '''
+    Returns the filesystem type of the mount containing `path`, or None if
+    it can't be determined (e.g. /proc/mounts doesn't exist)
+    '''
+    path = os.path.realpath(path)
+    fstype = None
+    mountpoint = ''
+    try:
+        with open('/proc/mounts') as fx:
+            for line in fx:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mnt = fields[1].replace('\\040', ' ')
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and \
+                        len(mnt) >= len(mountpoint):
+                    mountpoint = mnt
+                    fstype = fields[2]
+    except OSError:
+        return None
+
+    return fstype
+
+
+def inotify_supported(path):
+    '''
+    Returns True if inotify is available and events for `path` are expected
+    to be delivered, i.e. it is not on a network filesystem
+    '''
+    if _load_libc() is None:
+        return False
+
+    fstype = get_fstype(path)
+    if fstype is not None and fstype.lower() in _NO_EVENT_FSTYPES:
+        return False
+
+    return True
+
+
+class PollingFinder(object):
+    '''Find new exposures by rescanning the input directory tree'''
+
+    def __init__(self, indir, outdir=None, catchup=False, startdate=None,
+                 index=None):
+        '''
+        Args:
+            indir : directory of nights with exposures
+
+        Options:
+            outdir : directory of processed nights data, needed if catchup
+            catchup : if True, return the earliest unprocessed exposure in the
+                whole tree instead of the earliest one in the latest night
+            startdate : the earliest night to consider processing YYYYMMDD
+            index : ExposureIndex used to speed up catchup scans
+        '''
+        if catchup and outdir is None:
+            raise ValueError('outdir is required for catchup mode')
+
+        self.indir = indir
+        self.outdir = outdir
+        self.catchup = catchup
+        self.startdate = startdate
+        self.index = index
+
+    def next_expdir(self, processed):
+        '''
+        Returns the next indir/YEARMMDD/EXPID to process, or None
+
+        Args:
+            processed : set of exposure directories already processed
+        '''
+        if self.catchup:
+            return run.find_unprocessed_expdir(self.indir, self.outdir,
+                    processed, startdate=self.startdate, index=self.index)
+        else:
+            return run.find_latest_expdir(self.indir, processed,
+                    startdate=self.startdate)
+
+    def latest_expdirs(self, processed):
+        '''
+        Returns list of all unprocessed exposure directories in the latest night
+
+        Args:
+            processed : set of exposure directories already processed
+        '''
+        return run.find_latest_expdirs(self.indir, processed,
+                startdate=self.startdate)
+
+    def requeue(self, expdir):
+        '''Make expdir a candidate again after it was deferred'''
+        pass
+
+    def wait(self, timeout):
+        '''Wait up to `timeout` seconds for new data to (maybe) appear'''
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+
+class InotifyFinder(PollingFinder):
+    '''Find new exposures from inotify events, rescanning occasionally'''
+
+    #- events to watch for on night and exposure directories
+    dir_mask = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF
+
+    def __init__(self, indir, outdir=None, catchup=False, startdate=None,
+                 index=None, rescan=300):
+        '''
+        Args:
+            indir : directory of nights with exposures
+
+        Options:
+            outdir : directory of processed nights data, needed if catchup
+            catchup : if True, fall back to full tree scans until no more
+                unprocessed exposures are found
+            startdate : the earliest night to consider processing YYYYMMDD
+            index : ExposureIndex used to speed up catchup scans
+            rescan : seconds between safety-net rescans of the tree
+
+        Raises OSError if inotify can't be initialized
+        '''
+        super().__init__(indir, outdir=outdir, catchup=catchup,
+                         startdate=startdate, index=index)
+
+        self._libc = _load_libc()
+        if self._libc is None:
+            raise OSError('inotify is not available on this system')
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'inotify_init1: ' + os.strerror(errno))
+
+        self.rescan = rescan
+        self.pending = set()    #- expdirs with a raw file event
+        self.watches = dict()   #- watch descriptor -> path
+        self.night = None       #- night currently being watched
+        self._last_scan = None  #- time of last full rescan
+
+        self._add_watch(self.indir, IN_CREATE | IN_MOVED_TO)
+        night = self._latest_night()
+        if night is not None:
+            self._watch_night(night)
+
+    def _add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            log = desiutil.log.get_logger()
+            log.warning(f'Unable to watch {path}: {os.strerror(errno)}')
+            return None
+
+        self.watches[wd] = path
+        return wd
+
+    def _latest_night(self):
+        startdate = str(self.startdate) if self.startdate else ''
+        nights = [d for d in os.listdir(self.indir)
+                  if _re_night.match(d) and d >= startdate]
+        for night in sorted(nights, reverse=True):
+            if os.path.isdir(os.path.join(self.indir, night)):
+                return night
+
+        return None
+
+    def _watch_night(self, night):
+        '''Move night-level watches to indir/night and its exposure dirs'''
+        log = desiutil.log.get_logger()
+        if self.night is not None and night <= self.night:
+            return
+
+        #- drop watches on the previous night, keeping the top level indir
+        for wd, path in list(self.watches.items()):
+            if path != self.indir:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+        self.night = night
+        nightdir = os.path.join(self.indir, night)
+        log.debug(f'{run.timestamp()} Watching {nightdir} for new exposures')
+        self._add_watch(nightdir, self.dir_mask)
+        for expid in os.listdir(nightdir):
+            self._watch_expdir(os.path.join(nightdir, expid))
+
+    def _watch_expdir(self, expdir):
+        '''Watch expdir for raw data, checking for files already there'''
+        if not (_re_expid.match(os.path.basename(expdir)) and os.path.isdir(expdir)):
+            return
+
+        self._add_watch(expdir, self.dir_mask)
+
+        #- the raw file may have landed before the watch was added
+        for filename in os.listdir(expdir):
+            if _re_rawfile.match(filename):
+                self.pending.add(expdir)
+
+    def _read_events(self):
+        '''Read all queued inotify events and update pending exposures'''
+        log = desiutil.log.get_logger()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            if not buf:
+                return
+
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset+length].rstrip(b'\0')
+                offset += length
+                name = os.fsdecode(name)
+
+                if mask & IN_Q_OVERFLOW:
+                    log.warning('inotify event queue overflowed; rescanning')
+                    self._last_scan = None
+                    continue
+
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                path = self.watches.get(wd)
+                if path is None:
+                    continue
+
+                if path == self.indir:
+                    if (mask & IN_ISDIR) and _re_night.match(name):
+                        self._watch_night(name)
+                elif os.path.dirname(path) == self.indir:
+                    #- event in a night directory
+                    if mask & IN_ISDIR:
+                        self._watch_expdir(os.path.join(path, name))
+                elif _re_rawfile.match(name) and \
+                        mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    log.debug(f'{run.timestamp()} inotify event for {path}/{name}')
+                    self.pending.add(path)
+
+    def next_expdir(self, processed):
+        '''
+        Returns the next indir/YEARMMDD/EXPID to process, or None
+
+        Args:
+            processed : set of exposure directories already processed
+        '''
+        self._read_events()
+        self.pending -= processed
+        if len(self.pending) > 0:
+            return min(self.pending)
+
+        now = time.time()
+        if self.catchup or self._last_scan is None or \
+                now - self._last_scan > self.rescan:
+            expdir = super().next_expdir(processed)
+            if expdir is None:
+                #- nothing left to catch up on; rely on events from now on
+                self.catchup = False
+                self._last_scan = now
+            return expdir
+
+        return None
+
+    def latest_expdirs(self, processed):
+        '''
+        Returns list of all unprocessed exposure directories with raw data
+        events, plus those in the latest night if a rescan is due
+
+        Args:
+            processed : set of exposure directories already processed
+        '''
+        self._read_events()
+        self.pending -= processed
+
+        now = time.time()
+        if self._last_scan is None or now - self._last_scan > self.rescan:
+            self.pending.update(super().latest_expdirs(processed))
+            self._last_scan = now
+
+        return sorted(self.pending)
+
+    def requeue(self, expdir):
+        '''Make expdir a candidate again after it was deferred'''
+        self.pending.add(expdir)
+
+    def wait(self, timeout):
+        '''Wait up to `timeout` seconds for the next inotify event'''
+        if len(self.pending) > 0:
+            return
+
+        select.select([self.fd], [], [], timeout)
+
+    def close(self):
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+            self.fd = None
+
+
+def get_finder(method, indir, outdir=None, catchup=False, startdate=None,
+               index=None, rescan=300):
+    '''
+    Returns an exposure finder for monitoring indir/YEARMMDD/EXPID/
+
+    Args:
+        method : 'inotify', 'poll', or 'auto' to use inotify if indir is on a
+            filesystem that delivers events, otherwise polling
+        indir : directory of nights with exposures
+
+    Options:
+        outdir, catchup, startdate, index : passed to the finder
+        rescan : seconds between safety-net rescans for inotify
+
+    Returns a PollingFinder or InotifyFinder object
+    '''
+    log = desiutil.log.get_logger()
+    if method not in ('auto', 'inotify', 'poll'):
+        raise ValueError(f'Unknown discovery method {method}')
+
+    if method == 'auto':
+        method = 'inotify' if inotify_supported(indir) else 'poll'
+
+    if method == 'inotify':
+        try:
+            return InotifyFinder(indir, outdir=outdir, catchup=catchup,
+                                 startdate=startdate, index=index, rescan=rescan)
+        except OSError as err:
+            log.warning(f'Falling back to polling: {err}')
+
+    return PollingFinder(indir, outdir=outdir, catchup=catchup,
+                         startdate=startdate, index=index)
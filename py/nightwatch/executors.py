@@ -0,0 +1,321 @@
+'''
+Executors that process exposures for `nightwatch monitor`
+
+All executors share one API so that the monitor loop doesn't need to know
+how exposures are processed:
+
+  * submit(job) : start (or queue) processing of an ExposureJob
+  * poll(idle=False) : make progress on queued work; idle=True means that
+    no new exposures are currently expected
+  * idle() : True if nothing is queued or running
+  * close() : finish or hand off everything submitted
+  * stats() : dict of counts and timings for comparing executors
+
+Available executors (see EXECUTORS):
+
+  * local : process exposures in this process with an ExposurePipeline
+    and the shared worker pool
+  * subprocess : run `nightwatch run` for each exposure as a subprocess
+  * slurm : pack exposures into Slurm batch jobs with an ExposurePacker
+  * dryrun : record what would run and its estimated cost, without
+    processing anything
+
+Executors that know when an exposure is finished call on_done(job) with
+the ExposureJob, with job.error set if it failed.  Slurm jobs finish
+outside of this process, and dry runs never do, so those executors don't
+call on_done.
+'''
+
+import os, sys, time
+import json
+import subprocess
+
+import desiutil.log
+
+from .run import timestamp
+from .io import get_raw_exposure
+from .pipeline import ExposurePipeline
+from .batch import ExposurePacker
+
+EXECUTORS = ('local', 'subprocess', 'slurm', 'dryrun')
+
+#- rough qproc core-seconds per camera by OBSTYPE, for dry-run estimates
+QPROC_CAMERA_COST = dict(ZERO=15, DARK=20, ARC=60, FLAT=90, TWILIGHT=90, SCIENCE=120)
+DEFAULT_CAMERA_COST = 60
+
+#- rough core-seconds per exposure for QA, plots, and tables
+EXPOSURE_COST = 120
+
+
+def estimate_cost(rawfile, cameras=None):
+    '''
+    Returns dict(obstype, ncameras, core_seconds) estimating the cost of
+    processing rawfile
+
+    Args:
+        rawfile : raw data file path, or its RawExposure
+
+    Options:
+        cameras : list of cameras to process; default all in rawfile
+    '''
+    raw = get_raw_exposure(rawfile)
+    obstype = raw.obstype
+    ncameras = len([c for c in raw.cameras if cameras is None or c in cameras])
+
+    cost = ncameras * QPROC_CAMERA_COST.get(obstype, DEFAULT_CAMERA_COST) + EXPOSURE_COST
+    return dict(obstype=obstype, ncameras=ncameras, core_seconds=cost)
+
+
+class Executor(object):
+    '''Base class for exposure executors; see module docstring'''
+
+    name = None
+
+    def __init__(self, on_done=None):
+        '''
+        Options:
+            on_done : function called with each finished (or failed) ExposureJob
+        '''
+        self.on_done = on_done
+        self.nsubmitted = 0
+        self.nfinished = 0
+        self.nfailed = 0
+        self.time_start = time.time()
+
+    def submit(self, job):
+        raise NotImplementedError
+
+    def poll(self, idle=False):
+        pass
+
+    def idle(self):
+        return True
+
+    def close(self):
+        pass
+
+    def _done(self, job):
+        '''Count finished job and pass it on to on_done'''
+        self.nfinished += 1
+        if job.failed:
+            self.nfailed += 1
+
+        if self.on_done is not None:
+            try:
+                self.on_done(job)
+            except Exception as err:
+                log = desiutil.log.get_logger()
+                log.error('on_done callback failed for {}: {}'.format(job, err))
+
+    def stats(self):
+        '''Returns dict of exposures submitted, finished, failed and elapsed time'''
+        return dict(executor=self.name, submitted=self.nsubmitted, finished=self.nfinished,
+                    failed=self.nfailed, elapsed=time.time() - self.time_start)
+
+    def __repr__(self):
+        return '{}()'.format(self.__class__.__name__)
+
+
+class LocalExecutor(Executor):
+    '''Process exposures in this process through an ExposurePipeline'''
+
+    name = 'local'
+
+    def __init__(self, qarunner, on_done=None, **pipeline_options):
+        '''
+        Args:
+            qarunner : QARunner instance to use for the qa stage
+
+        Options:
+            on_done : function called with each finished ExposureJob
+            pipeline_options : passed to ExposurePipeline, e.g. workers,
+                queue_size, serial, qproc_mode
+        '''
+        super().__init__(on_done=on_done)
+        self.pipeline = ExposurePipeline(qarunner, on_done=self._done, **pipeline_options)
+
+    def submit(self, job):
+        self.nsubmitted += 1
+        self.pipeline.submit(job)
+
+    def idle(self):
+        return self.pipeline.idle()
+
+    def close(self):
+        self.pipeline.close()
+
+    def __repr__(self):
+        return 'LocalExecutor(serial={})'.format(self.pipeline.serial)
+
+
+class SubprocessExecutor(Executor):
+    '''Run `nightwatch run` for each exposure as a separate process'''
+
+    name = 'subprocess'
+
+    def __init__(self, on_done=None, max_running=1, ncpu=None, run_options=None):
+        '''
+        Options:
+            on_done : function called with each finished ExposureJob
+            max_running : max number of exposures processed at once
+            ncpu : number of worker processes for each exposure
+            run_options : list of additional `nightwatch run` options
+        '''
+        super().__init__(on_done=on_done)
+        self.max_running = max(1, max_running)
+        self.ncpu = ncpu
+        self.run_options = list() if run_options is None else list(run_options)
+        self.waiting = list()
+        self.running = list()   #- (job, Popen)
+
+    def command(self, job):
+        '''Returns `nightwatch run` command for job as a list'''
+        cmd = ['nightwatch', 'run', '--infile', job.rawfile, '--outdir', job.basedir,
+               '--plotdir', job.plotdir]
+        if job.cameras is not None:
+            cmd.extend(['--cameras', ','.join(job.cameras)])
+        if job.manifest.force:
+            cmd.append('--force')
+        if self.ncpu is not None:
+            cmd.extend(['--ncpu', str(self.ncpu)])
+        return cmd + self.run_options
+
+    def submit(self, job):
+        self.nsubmitted += 1
+        self.waiting.append(job)
+        self.poll()
+
+    def poll(self, idle=False):
+        #- reap finished processes
+        for job, proc in list(self.running):
+            err = proc.poll()
+            if err is None:
+                continue
+            self.running.remove((job, proc))
+            proc.logfile.close()
+            job.time_end = time.time()
+            if err != 0:
+                job.failed_stage = 'run'
+                job.error = 'nightwatch run exited with code {}; see {}'.format(
+                    err, proc.logfile.name)
+                print('{} Failed to process {}/{}: {}'.format(
+                    timestamp(), job.night, job.expid, job.error))
+            else:
+                print('{} Finished exposure {}/{} ({:.1f} min)'.format(
+                    timestamp(), job.night, job.expid, (job.time_end - job.time_start)/60))
+            sys.stdout.flush()
+            self._done(job)
+
+        #- start waiting exposures
+        while len(self.waiting) > 0 and len(self.running) < self.max_running:
+            job = self.waiting.pop(0)
+            os.makedirs(job.outdir, exist_ok=True)
+            logfile = '{}/nightwatch-run-{}.log'.format(job.outdir, job.expid)
+            cmd = self.command(job)
+            print('{} Running {}'.format(timestamp(), ' '.join(cmd)))
+            sys.stdout.flush()
+            logfx = open(logfile, 'w')
+            proc = subprocess.Popen(cmd, stdout=logfx, stderr=subprocess.STDOUT)
+            proc.logfile = logfx
+            self.running.append((job, proc))
+
+    def idle(self):
+        self.poll()
+        return len(self.waiting) == 0 and len(self.running) == 0
+
+    def close(self):
+        while not self.idle():
+            time.sleep(1)
+
+    def __repr__(self):
+        return 'SubprocessExecutor(max_running={})'.format(self.max_running)
+
+
+class SlurmExecutor(Executor):
+    '''Submit exposures to Slurm, packing several into each batch job'''
+
+    name = 'slurm'
+
+    def __init__(self, packer, on_done=None):
+        '''
+        Args:
+            packer : ExposurePacker to collect and submit exposures
+
+        Options:
+            on_done : unused; batch jobs finish outside of this process
+        '''
+        super().__init__(on_done=on_done)
+        self.packer = packer
+
+    def submit(self, job):
+        self.nsubmitted += 1
+        print('{} Adding {} to batch job'.format(timestamp(), job.rawfile))
+        self.packer.add(job.rawfile)
+        self.packer.flush()
+
+    def poll(self, idle=False):
+        self.packer.flush(idle=idle)
+
+    def idle(self):
+        return len(self.packer.pending) == 0
+
+    def close(self):
+        self.packer.flush(idle=True)
+
+    def stats(self):
+        stats = super().stats()
+        stats['jobs'] = len(self.packer.submitted)
+        return stats
+
+    def __repr__(self):
+        return 'SlurmExecutor({})'.format(self.packer)
+
+
+class DryRunExecutor(Executor):
+    '''Record exposures that would be processed and their estimated cost'''
+
+    name = 'dryrun'
+
+    def __init__(self, on_done=None, outfile=None, ncpu=None):
+        '''
+        Options:
+            on_done : unused; nothing is processed
+            outfile : append one JSON record per exposure to this file
+            ncpu : number of workers for estimated wall clock times
+        '''
+        super().__init__(on_done=on_done)
+        self.outfile = outfile
+        self.ncpu = max(1, ncpu or 1)
+        self.records = list()
+
+    def submit(self, job):
+        self.nsubmitted += 1
+        record = dict(night=job.night, expid=int(job.expid), rawfile=job.rawfile,
+                      outdir=job.outdir, cameras=job.cameras)
+        record.update(estimate_cost(job.raw, cameras=job.cameras))
+        record['wall_seconds'] = record['core_seconds'] / min(self.ncpu, max(1, record['ncameras']))
+        self.records.append(record)
+
+        print('{} Would process {}/{} {} with {} cameras: ~{:.0f} core-sec, ~{:.0f} sec on {} workers'.format(
+            timestamp(), job.night, job.expid, record['obstype'], record['ncameras'],
+            record['core_seconds'], record['wall_seconds'], self.ncpu))
+        sys.stdout.flush()
+
+        if self.outfile is not None:
+            with open(self.outfile, 'a') as fx:
+                fx.write(json.dumps(record) + '\n')
+
+    def stats(self):
+        stats = super().stats()
+        stats['core_seconds'] = sum([r['core_seconds'] for r in self.records])
+        stats['wall_seconds'] = sum([r['wall_seconds'] for r in self.records])
+        return stats
+
+    def close(self):
+        stats = self.stats()
+        print('{} Dry run: {} exposures, ~{:.1f} core-hours, ~{:.1f} hours on {} workers'.format(
+            timestamp(), stats['submitted'], stats['core_seconds']/3600,
+            stats['wall_seconds']/3600, self.ncpu))
+
+    def __repr__(self):
+        return 'DryRunExecutor({} exposures)'.format(len(self.records))
@@ -0,0 +1,183 @@
+'''
+Persistent index of processed exposures
+
+The monitor records every exposure it processes, skips, or fails to process
+in a small SQLite file in the output directory, along with the mtime of the
+raw data file.  Catchup scans and restarts consult the index instead of
+checking every outdir/YEARMMDD/EXPID/qa-EXPID.fits file, and skip whole
+nights whose directory hasn't changed since they were last fully indexed.
+'''
+
+import os, time
+import sqlite3
+import threading
+
+
+#- exposure status values
+PROCESSED = 'processed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+NORAW = 'noraw'
+
+
+def default_indexfile(outdir):
+    '''Returns the standard path to the exposure index for outdir'''
+    return os.path.join(outdir, 'nightwatch_index.db')
+
+
+class ExposureIndex(object):
+    '''SQLite index of exposure processing status'''
+
+    table_commands = {
+        'exposures' : """CREATE TABLE IF NOT EXISTS exposures(
+            night INT NOT NULL,
+            expid INT NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            mtime FLOAT,
+            updated FLOAT NOT NULL,
+            message TEXT,
+            PRIMARY KEY(night, expid));""",
+
+        'nights' : """CREATE TABLE IF NOT EXISTS nights(
+            night INT NOT NULL,
+            mtime FLOAT NOT NULL,
+            PRIMARY KEY(night));""",
+    }
+
+    def __init__(self, dbfile):
+        '''
+        Args:
+            dbfile : path to SQLite file; created if needed
+        '''
+        self.dbfile = dbfile
+        dirname = os.path.dirname(os.path.abspath(dbfile))
+        os.makedirs(dirname, exist_ok=True)
+
+        #- monitor pipeline stages may update the index from other threads
+        self._lock = threading.Lock()
+        self.dbconn = sqlite3.connect(dbfile, check_same_thread=False)
+        self.create_tables()
+
+    def create_tables(self):
+        with self._lock:
+            db_cur = self.dbconn.cursor()
+            try:
+                for tab, tab_cmd in self.table_commands.items():
+                    db_cur.execute(tab_cmd)
+            finally:
+                db_cur.close()
+
+            self.dbconn.commit()
+
+    def record(self, night, expid, status, mtime=None, message=None):
+        '''
+        Record the processing status of an exposure
+
+        Args:
+            night : int YEARMMDD
+            expid : int exposure ID
+            status : one of PROCESSED, SKIPPED, FAILED, NORAW
+
+        Options:
+            mtime : mtime of the raw data file (or exposure directory for NORAW)
+            message : optional string, e.g. an error message
+        '''
+        if status not in (PROCESSED, SKIPPED, FAILED, NORAW):
+            raise ValueError(f'Unknown exposure status {status}')
+
+        with self._lock:
+            self.dbconn.execute(
+                'INSERT OR REPLACE INTO exposures VALUES (?, ?, ?, ?, ?, ?)',
+                (int(night), int(expid), status, mtime, time.time(), message))
+            self.dbconn.commit()
+
+    def get(self, night, expid):
+        '''Returns (status, mtime) for night/expid, or None if not indexed'''
+        with self._lock:
+            row = self.dbconn.execute(
+                'SELECT status, mtime FROM exposures WHERE night=? AND expid=?',
+                (int(night), int(expid))).fetchone()
+
+        return row
+
+    def get_night(self, night):
+        '''Returns dict of expid -> (status, mtime) for exposures in night'''
+        with self._lock:
+            rows = self.dbconn.execute(
+                'SELECT expid, status, mtime FROM exposures WHERE night=?',
+                (int(night),)).fetchall()
+
+        return {expid: (status, mtime) for expid, status, mtime in rows}
+
+    def is_done(self, night, expid, rawfile=None):
+        '''
+        Returns True if night/expid doesn't need to be processed again
+
+        Processed and skipped exposures are done; failed exposures are done
+        unless the raw data file has been modified since the failure.
+        '''
+        entry = self.get(night, expid)
+        return entry_is_done(entry, rawfile)
+
+    def done_expdirs(self, indir):
+        '''
+        Returns set of indir/YEARMMDD/EXPID paths that were processed or skipped
+
+        Failed exposures are not included since they should be retried if
+        their raw data file changes; use `is_done` to check those.
+        '''
+        with self._lock:
+            rows = self.dbconn.execute(
+                'SELECT night, expid FROM exposures WHERE status IN (?, ?)',
+                (PROCESSED, SKIPPED)).fetchall()
+
+        return {os.path.join(indir, str(night), f'{expid:08d}')
+                for night, expid in rows}
+
+    def night_mtime(self, night):
+        '''Returns mtime of night dir when it was last fully indexed, or None'''
+        with self._lock:
+            row = self.dbconn.execute(
+                'SELECT mtime FROM nights WHERE night=?', (int(night),)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set_night_mtime(self, night, mtime):
+        '''Record that every exposure in night was indexed as of mtime'''
+        with self._lock:
+            self.dbconn.execute('INSERT OR REPLACE INTO nights VALUES (?, ?)',
+                                (int(night), mtime))
+            self.dbconn.commit()
+
+    def reset_failed(self):
+        '''Forget failed exposures so that they are retried'''
+        with self._lock:
+            n = self.dbconn.execute('DELETE FROM exposures WHERE status=?',
+                                    (FAILED,)).rowcount
+            self.dbconn.execute('DELETE FROM nights')
+            self.dbconn.commit()
+
+        return n
+
+    def close(self):
+        with self._lock:
+            self.dbconn.close()
+
+
+def entry_is_done(entry, rawfile=None):
+    '''Returns True if index entry (status, mtime) doesn't need reprocessing'''
+    if entry is None:
+        return False
+
+    status, mtime = entry
+    if status in (PROCESSED, SKIPPED):
+        return True
+    elif status == FAILED:
+        if rawfile is None or mtime is None:
+            return True
+        try:
+            return os.path.getmtime(rawfile) == mtime
+        except OSError:
+            return True
+    else:
+        return False
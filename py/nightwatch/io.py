@@ -39,11 +39,13 @@ def read_qa(filename):
 def findfile(filetype, night, expid=None, basedir=None):
     '''
     Returns standardized filepath given a type, night, exposure, basedir
-    Currently supported types: qa, expdir
+    Currently supported types: qa, expdir, manifest, timing
     '''
     filemap = dict(
         qa = '{night}/{expid:08d}/qa-{expid:08d}.fits',
-        expdir = '{night}/{expid:08d}'
+        expdir = '{night}/{expid:08d}',
+        manifest = '{night}/{expid:08d}/manifest-{expid:08d}.json',
+        timing = '{night}/{expid:08d}/timing-{expid:08d}.json',
     )
     if filetype not in filemap:
         raise ValueError('Unknown filetype {}; known types {}'.format(
@@ -95,19 +97,110 @@ def findfibers(datadir, fibers):
 
     return fibergroups, fibers[missing]
 
+class RawExposure(object):
+    '''
+    HDU index and header keywords of a desi-EXPID.fits.fz raw data file
+
+    The file is opened once to list its HDUs and read the first three
+    headers; NIGHT, EXPID, OBSTYPE, PROGRAM, TILEID, and the list of cameras
+    are derived from those.  Use get_raw_exposure to share instances.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Args:
+            filename : path to raw data file
+        '''
+        self.filename = filename
+        self.headers = list()
+        self.extnames = list()
+        with fitsio.FITS(filename) as fx:
+            for i, hdu in enumerate(fx):
+                self.extnames.append(hdu.get_extname().upper())
+                if i < 3:
+                    self.headers.append(hdu.read_header())
+
+        self.cameras = sorted([extname.lower() for extname in self.extnames
+                               if re.match('[BRZ][0-9]', extname)])
+
+        #- header with OBSTYPE or FLAVOR in HDU 0, then 1, then 2
+        self.header = self.headers[0]
+        for hdr in self.headers:
+            if ('OBSTYPE' in hdr) or ('FLAVOR' in hdr):
+                self.header = hdr
+                break
+
+        if 'OBSTYPE' in self.header:
+            self.obstype = str(self.header['OBSTYPE']).rstrip().upper()
+        elif 'FLAVOR' in self.header:
+            self.obstype = str(self.header['FLAVOR']).rstrip().upper()
+        else:
+            self.obstype = None
+
+        #- NIGHT, EXPID from HDU 1, then 0, then 2 (as for get_night_expid)
+        self.night = self.expid = None
+        for extnum in (1, 0, 2):
+            if extnum < len(self.headers):
+                try:
+                    self.night, self.expid = get_night_expid_header(self.headers[extnum])
+                    break
+                except ValueError:
+                    pass
+
+        self.program = self._keyword('PROGRAM')
+        self.tileid = self._keyword('TILEID')
+
+    def _keyword(self, key):
+        '''Returns value of key from HDU 1, then 0, then 2, or None'''
+        for extnum in (1, 0, 2):
+            if extnum < len(self.headers) and key in self.headers[extnum]:
+                return self.headers[extnum][key]
+        return None
+
+    @property
+    def primary_header(self):
+        '''Header of HDU 0'''
+        return self.headers[0]
+
+    def __repr__(self):
+        return 'RawExposure({})'.format(self.filename)
+
+
+#- RawExposure cache; abspath -> (mtime, size, RawExposure)
+_raw_cache = dict()
+_raw_cache_size = 64
+
+def get_raw_exposure(rawfile):
+    '''
+    Returns RawExposure for rawfile, reusing a cached instance unless the
+    file has changed since it was read
+
+    `rawfile` may also be a RawExposure, which is returned as is.
+    '''
+    if isinstance(rawfile, RawExposure):
+        return rawfile
+
+    path = os.path.abspath(rawfile)
+    st = os.stat(path)
+    cached = _raw_cache.get(path)
+    if cached is not None and cached[0:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+
+    raw = RawExposure(rawfile)
+    if len(_raw_cache) >= _raw_cache_size:
+        _raw_cache.clear()
+    _raw_cache[path] = (st.st_mtime, st.st_size, raw)
+    return raw
+
 def get_night_expid(filename):
     '''
     Returns NIGHT, EXPID from input filename header keywords
     '''
-    for extnum in (1,0,2):
-        hdr = fitsio.read_header(filename, extnum)
-        try:
-            night, expid = get_night_expid_header(hdr)
-            return night, expid
-        except ValueError:
-            pass
+    raw = get_raw_exposure(filename)
+    if raw.expid is None:
+        raise ValueError(f'Unable to determine NIGHT,EXPID from {filename} headers')
 
-    raise ValueError(f'Unable to determine NIGHT,EXPID from {filename} headers')
+    return raw.night, raw.expid
 
 def get_night_expid_header(hdr):
     '''
@@ -0,0 +1,232 @@
+'''
+Per-exposure manifest of processing stages, so that reruns skip completed work
+
+outdir/YEARMMDD/EXPID/manifest-EXPID.json records for each stage
+(fibermap, qproc-CAM for every camera, qa, plots) its input and output files
+with their sizes and mtimes, the software versions used, and whether it
+succeeded.  A stage is rerun only if it failed, if any input or output
+changed or disappeared, or if the software versions changed.  Since each
+stage's outputs are the next stage's inputs, rerunning a stage also makes
+the stages downstream of it stale.
+
+Files within the manifest's directory are recorded relative to it, so that
+the manifest stays valid when the exposure directory is moved as a whole,
+e.g. when published from scratch (see nightwatch.staging).
+'''
+
+import os, time
+import glob
+import json
+import threading
+
+import desiutil.log
+
+#- stage states
+DONE = 'done'
+FAILED = 'failed'
+
+
+def file_state(path):
+    '''Returns dict(size, mtime) for path, or None if it doesn't exist'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return dict(size=st.st_size, mtime=st.st_mtime)
+
+
+def software_versions():
+    '''Returns dict of package -> version for packages that affect outputs'''
+    versions = dict()
+    for name in ('nightwatch', 'desispec', 'desiutil'):
+        try:
+            module = __import__(name)
+            versions[name] = getattr(module, '__version__', 'unknown')
+        except ImportError:
+            versions[name] = None
+
+    return versions
+
+
+class ExposureManifest(object):
+    '''Record and check processing stages for a single exposure'''
+
+    def __init__(self, filename, force=False):
+        '''
+        Args:
+            filename : path to manifest JSON file; need not exist yet
+
+        Options:
+            force : if True, consider every stage stale, but still record them
+        '''
+        self.filename = filename
+        self.force = force
+        self.versions = software_versions()
+        self.stages = dict()
+        self._lock = threading.Lock()
+
+        log = desiutil.log.get_logger()
+        if os.path.exists(filename):
+            try:
+                with open(filename) as fx:
+                    data = json.load(fx)
+            except (OSError, ValueError) as err:
+                log.warning('Ignoring unreadable manifest {}: {}'.format(filename, err))
+                data = dict()
+
+            if data.get('versions') == self.versions:
+                self.stages = data.get('stages', dict())
+            elif len(data) > 0:
+                log.info('Software versions changed since {}; rerunning all stages'.format(
+                    filename))
+
+    def is_current(self, stage, inputs):
+        '''
+        Returns True if `stage` succeeded with the same `inputs` and its
+        recorded outputs are unchanged
+
+        Args:
+            stage : stage name, e.g. qa or qproc-b0
+            inputs : list of input file paths
+        '''
+        if self.force:
+            return False
+
+        entry = self.stages.get(stage)
+        if entry is None or entry['status'] != DONE:
+            return False
+
+        if entry['inputs'] != self._states(inputs):
+            return False
+
+        for key, state in entry['outputs'].items():
+            if file_state(self._path(key)) != state:
+                return False
+
+        return True
+
+    def _key(self, path):
+        '''Returns path relative to the manifest directory if within it'''
+        path = os.path.abspath(path)
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if path.startswith(dirname + os.sep):
+            return os.path.relpath(path, dirname)
+        return path
+
+    def _path(self, key):
+        '''Returns path for a key from `_key`'''
+        if os.path.isabs(key):
+            return key
+        return os.path.join(os.path.dirname(os.path.abspath(self.filename)), key)
+
+    def _states(self, paths):
+        return {self._key(path): file_state(path) for path in paths}
+
+    def record(self, stage, inputs, outputs, status=DONE, error=None):
+        '''
+        Record result of running `stage` and rewrite the manifest file
+
+        Args:
+            stage : stage name
+            inputs : list of input file paths
+            outputs : list of output file paths; missing files are ignored
+
+        Options:
+            status : DONE or FAILED
+            error : error message for failed stages
+        '''
+        entry = dict(
+            status = status,
+            time = time.time(),
+            inputs = self._states(inputs),
+            outputs = self._states([path for path in outputs if os.path.exists(path)]),
+            )
+        if error is not None:
+            entry['error'] = str(error)
+
+        with self._lock:
+            self.stages[stage] = entry
+            self._write()
+
+    def status(self, stage):
+        '''Returns recorded status of stage, or None if it hasn't run'''
+        entry = self.stages.get(stage)
+        return None if entry is None else entry['status']
+
+    def run_stage(self, stage, inputs, func, outputs):
+        '''
+        Run func() unless `stage` is current, recording the result
+
+        Args:
+            stage : stage name
+            inputs : list of input file paths
+            func : function to call with no arguments
+            outputs : list of output file paths, or a function returning
+                that list after func has run
+
+        Returns True if func was run, False if the stage was skipped.
+        Exceptions from func are recorded as a failed stage and re-raised.
+        If `outputs` is a list, the stage is also recorded as failed if any
+        of them doesn't exist after running func.
+        '''
+        log = desiutil.log.get_logger()
+        if self.is_current(stage, inputs):
+            log.info('Skipping {} stage {}; inputs and outputs unchanged'.format(
+                os.path.basename(self.filename), stage))
+            return False
+
+        try:
+            func()
+        except Exception as err:
+            self.record(stage, inputs, _outputs(outputs), status=FAILED, error=err)
+            raise
+
+        if callable(outputs):
+            self.record(stage, inputs, outputs())
+        else:
+            missing = [path for path in outputs if not os.path.exists(path)]
+            if len(missing) > 0:
+                error = 'missing outputs {}'.format(', '.join(missing))
+                log.warning('{} stage {} {}'.format(os.path.basename(self.filename), stage, error))
+                self.record(stage, inputs, outputs, status=FAILED, error=error)
+            else:
+                self.record(stage, inputs, outputs)
+
+        return True
+
+    def _write(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as fx:
+            json.dump(dict(versions=self.versions, stages=self.stages), fx, indent=1)
+        os.replace(tmpfile, self.filename)
+
+    def __repr__(self):
+        return 'ExposureManifest({})'.format(self.filename)
+
+
+def _outputs(outputs):
+    return outputs() if callable(outputs) else outputs
+
+
+#- Inputs of each stage; the outputs of one stage are the inputs of the next
+
+def fibermap_inputs(rawfile):
+    '''Returns list of inputs to assemble_fibermap for rawfile'''
+    rawdir = os.path.dirname(rawfile)
+    return [rawfile,] + sorted(glob.glob(os.path.join(rawdir, 'fiberassign-*.fits*'))) + \
+        sorted(glob.glob(os.path.join(rawdir, 'coordinates-*.fits')))
+
+
+def qa_inputs(outdir, expid):
+    '''Returns list of qproc outputs in outdir used by the QA'''
+    expid = int(expid)
+    return sorted(glob.glob('{}/*-??-{:08d}.fits'.format(outdir, expid))) + \
+        ['{}/errorcodes-{:08d}.txt'.format(outdir, expid),]
+
+
+def plot_outputs(plotdir, night, expid):
+    '''Returns function listing plot files for night/expid in plotdir'''
+    expdir = '{}/{}/{:08d}'.format(plotdir, night, int(expid))
+    return lambda: sorted(glob.glob(expdir + '/*.html'))
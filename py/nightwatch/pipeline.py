@@ -0,0 +1,438 @@
+'''
+Staged processing pipeline for `nightwatch monitor`
+
+Each exposure passes through the stages qproc (assemble_fibermap + qproc),
+qa, plots, and tables.  Stages run in their own worker threads connected by
+bounded queues, so that e.g. exposure N can be plotted while exposure N+1 is
+in qproc.  The heavy lifting within each stage still happens in subprocesses
+and multiprocessing pools; the threads only coordinate.
+'''
+
+import os, sys, time
+import queue
+import threading
+import traceback
+
+import desiutil.log
+
+from . import run
+from .run import timestamp
+from .io import get_raw_exposure, findfile
+from .manifest import ExposureManifest, fibermap_inputs, qa_inputs, plot_outputs
+from . import staging, resources, workers
+from .staging import ExposureStaging
+from . import timing
+from .timing import ExposureTimer
+
+#- stage names in processing order
+STAGES = ('qproc', 'qa', 'plots', 'tables')
+
+
+def parse_stage_workers(spec):
+    '''
+    Parse a stage concurrency specification like "qproc=1,plots=2"
+
+    Args:
+        spec : comma separated list of stage=nworkers, or None
+
+    Returns dict of stage name -> number of worker threads, including the
+    default of 1 for stages not in spec
+    '''
+    workers = {name: 1 for name in STAGES}
+    if spec is None or spec.strip() == '':
+        return workers
+
+    for item in spec.split(','):
+        try:
+            name, n = item.split('=')
+            name = name.strip()
+            n = int(n)
+        except ValueError:
+            raise ValueError(f'Unable to parse stage workers "{item}"; expected STAGE=N')
+
+        if name not in workers:
+            raise ValueError(f'Unknown stage {name}; known stages {STAGES}')
+        if n < 1:
+            raise ValueError(f'Stage {name} needs at least one worker')
+
+        workers[name] = n
+
+    #- tables are rewritten for the whole night; don't let them race
+    if workers['tables'] != 1:
+        log = desiutil.log.get_logger()
+        log.warning('Only one tables worker is supported; ignoring tables={}'.format(
+            workers['tables']))
+        workers['tables'] = 1
+
+    return workers
+
+
+class ExposureJob(object):
+    '''Processing state for a single exposure passing through the pipeline'''
+
+    def __init__(self, rawfile, basedir, plotdir=None, cameras=None, force=False,
+                 scratch=None):
+        '''
+        Args:
+            rawfile : path to indir/YEARMMDD/EXPID/desi-EXPID.fits.fz
+            basedir : write outputs to basedir/YEARMMDD/EXPID/
+
+        Options:
+            plotdir : write plots to plotdir/YEARMMDD/EXPID/; default basedir
+            cameras : list of cameras to process; default all
+            force : rerun all stages even if their manifest entries are current
+            scratch : if not None, write outputs to a staging directory in
+                scratch and publish them to basedir and plotdir after the
+                plots stage; see nightwatch.staging
+        '''
+        expdir = os.path.dirname(rawfile)
+        night, expid = expdir.split('/')[-2:]
+        self.night = int(night)
+        self.expid = expid
+        self.rawfile = rawfile
+        self.rawdir = expdir
+        self.basedir = basedir
+        self.plotdir = basedir if plotdir is None else plotdir
+
+        self.force = force
+        self.scratch = scratch
+        self.staging = None
+        self.scratch_bytes = 0
+
+        #- outputs are written to workdir and workplotdir, which are the
+        #- same as basedir and plotdir until `stage` moves them to scratch
+        self._set_workdirs(self.basedir, self.plotdir)
+
+        #- the summary QA DB is shared by all exposures, so it is updated
+        #- in place rather than staged
+        self.dbdir = os.path.join(self.basedir, 'historyqa')
+        #- timing goes directly to the final exposure directory, since it
+        #- is written after the staged outputs are published
+        self.timer = ExposureTimer(findfile('timing', self.night, int(expid), self.basedir),
+                                   self.night, expid)
+        self.cameras = cameras
+        self._raw = None
+        if os.path.exists(rawfile):
+            self.raw_mtime = os.path.getmtime(rawfile)
+        else:
+            self.raw_mtime = None
+
+        self.time_start = time.time()
+        self.time_end = None
+        self.failed_stage = None
+        self.error = None
+
+    def _set_workdirs(self, workdir, workplotdir):
+        self.workdir = workdir
+        self.workplotdir = workplotdir
+        self.outdir = '{}/{}/{}'.format(self.workdir, self.night, self.expid)
+        self.qafile = '{}/qa-{}.fits'.format(self.outdir, self.expid)
+        self.manifest = ExposureManifest(
+            '{}/manifest-{}.json'.format(self.outdir, self.expid), force=self.force)
+
+    def stage(self):
+        '''
+        Start writing outputs to a staging directory in scratch, if staging
+
+        Called when processing starts rather than when the job is created,
+        so that exposures waiting in the queue don't hold copies of their
+        existing outputs in scratch.  If scratch is memory-backed (e.g.
+        /dev/shm), blocks until the estimated size of the staged outputs
+        fits in the memory budget next to the worker processes; see
+        resources.CPUBudget.reserve.
+        '''
+        if self.scratch is None or self.staging is not None:
+            return
+
+        scratch = self.scratch
+        if scratch == 'auto':
+            scratch = staging.default_scratch()
+
+        if staging.in_memory(scratch):
+            ncameras = len(self.cameras) if self.cameras is not None else len(self.raw.cameras)
+            nbytes = staging.staged_bytes(self.basedir, self.night, self.expid,
+                                          plotdir=self.plotdir, ncameras=ncameras)
+            self.scratch_bytes = resources.get_budget().reserve(nbytes, workers.get_ncpu())
+
+        try:
+            self.staging = ExposureStaging(self.basedir, self.night, self.expid,
+                                           plotdir=self.plotdir, scratch=scratch)
+        except Exception:
+            self._release()
+            raise
+
+        self._set_workdirs(self.staging.basedir, self.staging.plotdir)
+
+    def publish(self):
+        '''Publish staged outputs, if any, and release their scratch memory'''
+        if self.staging is None or self.staging.published:
+            return
+
+        try:
+            self.staging.publish()
+        finally:
+            self._release()
+
+    def _release(self):
+        if self.scratch_bytes > 0:
+            resources.get_budget().release(self.scratch_bytes)
+            self.scratch_bytes = 0
+
+    @property
+    def raw(self):
+        '''RawExposure for rawfile, read once and shared by all stages'''
+        if self._raw is None:
+            self._raw = get_raw_exposure(self.rawfile)
+        return self._raw
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def __repr__(self):
+        return 'ExposureJob({}/{})'.format(self.night, self.expid)
+
+
+class ExposurePipeline(object):
+    '''Run exposures through qproc, qa, plots, and tables stages'''
+
+    def __init__(self, qarunner, workers=None, queue_size=2, serial=False,
+                 on_done=None, qproc_mode='inprocess', qproc_timeout=None, qproc_retries=0):
+        '''
+        Args:
+            qarunner : QARunner instance to use for the qa stage
+
+        Options:
+            workers : dict of stage name -> number of worker threads
+            queue_size : max number of exposures waiting in front of each stage
+            serial : if True, run all stages in the calling thread in `submit`
+            on_done : function called with each finished (or failed) ExposureJob
+            qproc_mode : 'inprocess' or 'subprocess'; see run.run_qproc
+            qproc_timeout : function(obstype) returning the qproc timeout per
+                camera in seconds, or None; see timing.parse_qproc_timeout
+            qproc_retries : number of times to retry cameras that time out
+        '''
+        self.qarunner = qarunner
+        self.workers = parse_stage_workers(None)
+        if workers is not None:
+            self.workers.update(workers)
+        self.queue_size = queue_size
+        self.serial = serial
+        self.on_done = on_done
+        self.qproc_mode = qproc_mode
+        self.qproc_timeout = qproc_timeout
+        self.qproc_retries = qproc_retries
+
+        self.funcs = dict(qproc=self.run_qproc, qa=self.run_qa,
+                          plots=self.run_plots, tables=self.run_tables)
+
+        self.queues = list()
+        self.threads = list()
+        if not serial:
+            for i, name in enumerate(STAGES):
+                self.queues.append(queue.Queue(maxsize=queue_size))
+                stage_threads = list()
+                for j in range(self.workers[name]):
+                    t = threading.Thread(target=self._worker, args=(i,),
+                            name=f'nightwatch-{name}-{j}', daemon=True)
+                    t.start()
+                    stage_threads.append(t)
+                self.threads.append(stage_threads)
+
+    #- Stage functions; tables receives a list of jobs so that exposures that
+    #- finish plotting together only rewrite the tables once
+
+    def run_qproc(self, job):
+        job.stage()
+        os.makedirs(job.outdir, exist_ok=True)
+        print('{} Running assemble_fibermap for {}/{}'.format(timestamp(), job.night, job.expid))
+        job.timer.obstype = job.raw.obstype
+        fibermap = '{}/fibermap-{}.fits'.format(job.outdir, job.expid)
+        with job.timer.time('fibermap'):
+            job.manifest.run_stage('fibermap', fibermap_inputs(job.rawfile),
+                    lambda: run.run_assemble_fibermap(job.raw, job.outdir),
+                    [fibermap,])
+
+        print('{} Running qproc on {}'.format(timestamp(), job.rawfile))
+        sys.stdout.flush()
+        #- per-camera QA runs in the qproc workers as each camera finishes,
+        #- leaving only the per-exposure QA for the qa stage
+        def on_camera(camera, err, qa_results):
+            self.qarunner.add_camera_results(job.outdir, camera, qa_results)
+
+        timeout = None
+        if self.qproc_timeout is not None:
+            timeout = self.qproc_timeout(job.raw.obstype)
+
+        run.run_qproc(job.raw, job.outdir, cameras=job.cameras, mode=self.qproc_mode,
+                      camera_qa=self.qarunner.camera_qa, on_camera=on_camera,
+                      manifest=job.manifest, timer=job.timer,
+                      timeout=timeout, retries=self.qproc_retries)
+
+    def run_qa(self, job):
+        print('{} Running QA on {}/{}'.format(timestamp(), job.night, job.expid))
+        sys.stdout.flush()
+
+        caldir = os.path.join(job.plotdir, "static")
+        jsonfile = os.path.join(caldir, "timeseries_dropdown.json")
+        os.makedirs(caldir, exist_ok=True)
+
+        job.manifest.run_stage('qa', qa_inputs(job.outdir, job.expid),
+                lambda: self.qarunner.run(indir=job.outdir, outfile=job.qafile, jsonfile=jsonfile,
+                                          timer=job.timer, dbdir=job.dbdir),
+                [job.qafile,])
+
+    def run_plots(self, job):
+        print('{} Generating plots for {}/{}'.format(timestamp(), job.night, job.expid))
+        sys.stdout.flush()
+        tmpdir = '{}/{}/{}'.format(job.workplotdir, job.night, job.expid)
+        os.makedirs(tmpdir, exist_ok=True)
+        job.manifest.run_stage('plots', [job.qafile,],
+                lambda: run.make_plots(infile=job.qafile, basedir=job.workplotdir, preprocdir=job.outdir,
+                                       logdir=job.outdir, rawdir=job.rawdir, cameras=job.cameras,
+                                       timer=job.timer),
+                plot_outputs(job.workplotdir, job.night, job.expid))
+
+    def run_tables(self, jobs):
+        nights = sorted(set([job.night for job in jobs]))
+        print('{} Updating night/exposure summary tables for {}'.format(
+            timestamp(), ','.join([str(n) for n in nights])))
+        sys.stdout.flush()
+        with timing.measure() as usage:
+            run.write_tables(jobs[0].basedir, jobs[0].plotdir, expnights=nights)
+        for job in jobs:
+            job.timer.add('tables', None, ok=True, shared=len(jobs), **usage)
+
+    def _run_stage(self, name, jobs):
+        '''Run stage `name` on list of jobs, recording any failure'''
+        jobs = [job for job in jobs if not job.failed]
+        if len(jobs) == 0:
+            return
+
+        try:
+            if name == 'tables':
+                self.funcs[name](jobs)
+            else:
+                for job in jobs:
+                    self.funcs[name](job)
+        except Exception as err:
+            for job in jobs:
+                job.failed_stage = name
+                job.error = err
+                print("Failed to {} exposure {}/{}".format(name, job.night, job.expid))
+            print("Error message: {}".format(str(err)))
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)
+            del exc_info
+            print("Now moving on ...")
+            sys.stdout.flush()
+
+        #- publish staged outputs once plotted, or as soon as the exposure
+        #- fails so that its logs are available; tables need them published
+        for job in jobs:
+            if name == 'plots' or job.failed:
+                self._publish(job)
+
+    def _publish(self, job):
+        try:
+            job.publish()
+        except Exception as err:
+            if not job.failed:
+                job.failed_stage = 'publish'
+                job.error = err
+            print("Failed to publish exposure {}/{}: {}".format(job.night, job.expid, err))
+            sys.stdout.flush()
+
+    def _finish(self, job):
+        job.time_end = time.time()
+        self.qarunner.forget(job.outdir)
+        job.timer.add('exposure', None, ok=not job.failed, start=job.time_start,
+                      wall=job.time_end - job.time_start, failed_stage=job.failed_stage)
+        try:
+            job.timer.write()
+        except OSError as err:
+            log = desiutil.log.get_logger()
+            log.warning('Unable to write {}: {}'.format(job.timer.filename, err))
+        if not job.failed:
+            dt = (job.time_end - job.time_start) / 60
+            print('{} Finished exposure {}/{} ({:.1f} min)'.format(
+                timestamp(), job.night, job.expid, dt))
+            sys.stdout.flush()
+
+        if self.on_done is not None:
+            try:
+                self.on_done(job)
+            except Exception as err:
+                log = desiutil.log.get_logger()
+                log.error('on_done callback failed for {}: {}'.format(job, err))
+
+    def _worker(self, istage):
+        name = STAGES[istage]
+        inqueue = self.queues[istage]
+        while True:
+            job = inqueue.get()
+            if job is None:
+                inqueue.task_done()
+                return
+
+            jobs = [job]
+            done = False
+            if name == 'tables':
+                #- coalesce exposures that are already waiting
+                while True:
+                    try:
+                        extra = inqueue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if extra is None:
+                        done = True
+                        break
+                    jobs.append(extra)
+
+            self._run_stage(name, jobs)
+
+            for job in jobs:
+                if job.failed or istage == len(STAGES) - 1:
+                    self._finish(job)
+                else:
+                    self.queues[istage+1].put(job)
+                inqueue.task_done()
+
+            if done:
+                inqueue.task_done()
+                return
+
+    def submit(self, job):
+        '''
+        Submit ExposureJob for processing
+
+        Blocks until there is room in front of the first stage, or until
+        processing is complete if serial=True.
+        '''
+        if self.serial:
+            for name in STAGES:
+                self._run_stage(name, [job,])
+            self._finish(job)
+        else:
+            self.queues[0].put(job)
+
+    def idle(self):
+        '''Returns True if no exposures are waiting or being processed'''
+        return all([q.unfinished_tasks == 0 for q in self.queues])
+
+    def close(self):
+        '''Finish processing submitted exposures and stop the worker threads'''
+        if self.serial:
+            return
+
+        for i, name in enumerate(STAGES):
+            for t in self.threads[i]:
+                self.queues[i].put(None)
+            for t in self.threads[i]:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,20 +1,21 @@
 from .base import QA
+import sys
 import glob
 import os
+import copy
 import collections
+import itertools
 
 import numpy as np
 import fitsio
 
-import multiprocessing as mp
-
 import scipy.ndimage
 
 from astropy.table import Table
 
 import desiutil.log
 from desispec.maskbits import ccdmask
-from ..run import get_ncpu
+from .. import workers
 
 def _fix_amp_names(hdr):
     '''In-place fix of header `hdr` amp names 1-4 to A-D if needed.'''
@@ -51,57 +52,101 @@ class QAAmp(QA):
         Count number of cosmics in this mask; doesn't try to deblend
         overlapping cosmics
         '''
-        cosmics_mask = mask & ccdmask.COSMIC
-
-        #- Any nonzero adjacent pixels count as connected, even if diagonal
-        structure=np.ones((3,3))
-        num_cosmics = scipy.ndimage.label(cosmics_mask, structure=structure)[1]
+        return _count_features(cosmics_plane(mask))
 
-        return num_cosmics
+    per_camera = True
+    uses_data = True
 
-    def run(self, indir):
+    def run(self, indir, camera=None, data=None):
         '''Generates table of PER_AMP qa metrics (READNOISE, BIAS, COSMICS_RATE).
         Args:
             indir: path to directory containing preproc-*.fits files for the given exposure
+            camera: only process this camera, e.g. b0; default all
+            data: ExposureData of indir to read through, if not parallel
         Returns an astropy Table object.'''
-        infiles = glob.glob(os.path.join(indir, 'preproc-*.fits'))
-        results = list()
-        argslist = [(self, infile, amp) for infile in infiles for amp in ['A', 'B', 'C', 'D']]
-        
-        ncpu = get_ncpu(None)
-        
-        if ncpu > 1:
-            pool = mp.Pool(ncpu)
-            results = pool.starmap(get_dico, argslist)
-            pool.close()
-            pool.join()
-            
+        infiles = glob.glob(os.path.join(indir, 'preproc-{}-*.fits'.format(camera or '*')))
+        if data is not None and not workers.parallel(len(infiles)):
+            #- e.g. per-camera QA in a qproc worker: share the reads with
+            #- other QA of this camera
+            results = [get_ccd_dicos(self, infile, hdr=data.header(infile, 'IMAGE'),
+                                     mask=data.read(infile, 'MASK'))
+                       for infile in infiles]
         else:
-            for args in argslist:
-                results.append(get_dico(*args))
+            #- one task per CCD, which reads its mask once for all amps
+            results = workers.starmap(get_ccd_dicos, [(self, infile) for infile in infiles])
 
-        #- remove None entries from missing amp (e.g. 2-amp readout)
-        results = [r for r in results if r is not None]
+        #- flatten; missing amps (e.g. 2-amp readout) have no rows
+        results = list(itertools.chain.from_iterable(results))
 
         table = Table(results, names=results[0].keys())
         
         return table
-           
-def get_dico(self, filename, amp):
-    '''Function to generate per amp metrics given a preproc file to analyze, and a specific amp.
+
+
+def amp_slices(shape):
+    '''Returns dict amp -> (yslice, xslice) of the quadrant of a CCD image
+    of `shape` read out by that amp'''
+    ny, nx = shape
+    return dict(
+        A = (slice(0, ny//2), slice(0, nx//2)),
+        B = (slice(0, ny//2), slice(nx//2, nx)),
+        C = (slice(ny//2, ny), slice(0, nx//2)),
+        D = (slice(ny//2, ny), slice(nx//2, nx)),
+        )
+
+
+def cosmics_plane(mask):
+    '''Returns uint8 image that is nonzero where `mask` has the COSMIC bit set
+
+    For C-contiguous integer masks this only touches the byte holding the
+    COSMIC bit instead of making a temporary the size of the mask.
+    '''
+    mask = np.asarray(mask)
+    bit = int(ccdmask.COSMIC).bit_length() - 1
+    itemsize = mask.dtype.itemsize
+    if mask.dtype.kind not in 'iu' or bit >= 8*itemsize or not mask.flags.c_contiguous:
+        return ((mask & ccdmask.COSMIC) != 0).view(np.uint8)
+
+    byteorder = mask.dtype.byteorder
+    if byteorder in '=|':
+        byteorder = '<' if sys.byteorder == 'little' else '>'
+    ibyte = bit//8 if byteorder == '<' else itemsize - 1 - bit//8
+
+    maskbytes = mask.view(np.uint8).reshape(mask.shape + (itemsize,))
+    return maskbytes[..., ibyte] & np.uint8(1 << (bit % 8))
+
+
+def _count_features(plane):
+    '''Returns number of connected nonzero regions of `plane`'''
+    #- Any nonzero adjacent pixels count as connected, even if diagonal
+    structure = np.ones((3,3))
+    return scipy.ndimage.label(plane, structure=structure)[1]
+
+
+def get_ccd_dicos(self, filename, hdr=None, mask=None):
+    '''Function to generate per amp metrics for all amps of a preproc file.
     Args:
         filename: path to preproc file (str)
-        amp: name of amp to analyze (str), either A, B, C, or D
-    Returns an OrderedDict object or None if amp isn't in data.
+        hdr, mask: IMAGE header and MASK of filename if already read
+    Returns list of OrderedDict objects, one per amp present in the data.
     '''
     
-    hdr = fitsio.read_header(filename, 'IMAGE') #- for readnoise, bias
+    if hdr is None:
+        hdr = fitsio.read_header(filename, 'IMAGE') #- for readnoise, bias
+    else:
+        hdr = copy.deepcopy(hdr)  #- shared; _fix_amp_names edits it
+    _fix_amp_names(hdr)
 
-    if 'BIASSEC'+amp not in hdr.keys():
-        return None
+    amps = [amp for amp in ['A', 'B', 'C', 'D'] if 'BIASSEC'+amp in hdr]
+    if len(amps) == 0:
+        return list()
+
+    #- read the mask once and only keep its COSMIC bit-plane
+    if mask is None:
+        mask = fitsio.read(filename, 'MASK')        #- for cosmics
+    plane = cosmics_plane(mask)
+    del mask
 
-    mask = fitsio.read(filename, 'MASK')        #- for cosmics
-    _fix_amp_names(hdr)
     night = hdr['NIGHT']
     expid = hdr['EXPID']
     cam = hdr['CAMERA'][0].upper()
@@ -114,30 +159,21 @@ def get_dico(self, filename, amp):
     else:
         exptime += 30.0
 
-    ny, nx = mask.shape
-    npix_amp = nx*ny//4
-    #- CCD read noise and overscan offset (bias) level
-    readnoise = hdr['OBSRDN'+amp]
-    biaslevel = hdr['OVERSCN'+amp]
-
-    #- Subregion of mask covered by this amp
-    if amp == 'A':
-        submask = mask[0:ny//2, 0:nx//2]
-    elif amp == 'B':
-        submask = mask[0:ny//2, nx//2:]
-    elif amp == 'C':
-        submask = mask[ny//2:, 0:nx//2]
-    else:
-        submask = mask[ny//2:, nx//2:]
+    results = list()
+    slices = amp_slices(plane.shape)
+    for amp in amps:
+        #- CCD read noise and overscan offset (bias) level
+        readnoise = hdr['OBSRDN'+amp]
+        biaslevel = hdr['OVERSCN'+amp]
 
-    #- Number of cosmics per minute on this amplifier
-    num_cosmics = self.count_cosmics(submask)
-    cosmics_rate = (num_cosmics / (exptime/60) )
+        #- Number of cosmics per minute on this amplifier, from a view
+        #- of the subregion covered by this amp
+        num_cosmics = _count_features(plane[slices[amp]])
+        cosmics_rate = (num_cosmics / (exptime/60) )
 
-    dico = {'NIGHT': night, 'EXPID': expid, 'SPECTRO': spectro, 'CAM': cam, 'AMP': amp,
-            'READNOISE': readnoise, 'BIAS': biaslevel, 'COSMICS_RATE': cosmics_rate
-           }
-        
-    return collections.OrderedDict(**dico)
+        dico = {'NIGHT': night, 'EXPID': expid, 'SPECTRO': spectro, 'CAM': cam, 'AMP': amp,
+                'READNOISE': readnoise, 'BIAS': biaslevel, 'COSMICS_RATE': cosmics_rate
+               }
+        results.append(collections.OrderedDict(**dico))
 
-        
+    return results
@@ -1,3 +1,8 @@
+import collections
+
+import numpy as np
+from astropy.table import Table
+
 class QA(object):
     """This is an abstract base class to define what quantities a
     subclass should define"""
@@ -25,8 +30,16 @@ class QA(object):
         of exposure (ZERO, DARK, ARC, FLAT, SCIENCE ...)'''
         return False
 
-    def run(self, indir):
-        '''Run this QA on files in `indir`
+    #- True if run(indir, camera=...) can process one camera at a time, so
+    #- that QA can start as soon as that camera's qproc outputs exist
+    per_camera = False
+
+    #- True if run(indir, ..., data=...) reads its inputs through a shared
+    #- ExposureData (see nightwatch.qa.data) when one is passed
+    uses_data = False
+
+    def run(self, indir, camera=None, data=None):
+        '''Run this QA on files in `indir`, optionally only for `camera`
         
         This class should return an astropy Table with metadata columns
         depending upon the QA type::
@@ -39,9 +52,78 @@ class QA(object):
           * PER_EXP: NIGHT, EXPID
         
         Additional columns contain a scalar QA metrics.
+
+        Instead of a Table, subclasses may return a columnar block, i.e. a
+        dict of equal-length arrays or a numpy structured array, which
+        QARunner converts with `as_table` without building rows.
+
+        `camera` (e.g. b0) is only passed to subclasses with per_camera=True.
+        `data` (ExposureData of `indir`) is only passed to subclasses with
+        uses_data=True; it is None when run on its own.
         '''
         raise NotImplementedError
 
     def __repr__(self):
         return self.__class__.__name__
 
+
+
+def as_table(results):
+    """Returns QA results (Table, dict of arrays, structured array, or None)
+    as an astropy Table, without copying rows"""
+    if results is None or isinstance(results, Table):
+        return results
+    return Table(results, copy=False)
+
+
+def stack_columns(blocks):
+    """
+    Concatenate columnar blocks of QA results into one dict of arrays
+
+    Args:
+        blocks : list of dicts of arrays, structured arrays, or Tables
+
+    Columns are ordered as first seen; rows of blocks missing a column get
+    NaN (float), 0 (other numbers), or an empty string.  Returns None if
+    there are no blocks.
+    """
+    blocks = [b for b in blocks if b is not None]
+    if len(blocks) == 0:
+        return None
+
+    columns = list()
+    for block in blocks:
+        columns.extend([name for name in _names(block) if name not in columns])
+
+    results = collections.OrderedDict()
+    for name in columns:
+        dtype = next(np.asarray(b[name]).dtype for b in blocks if name in _names(b))
+        if dtype.kind == 'f':
+            fill = np.nan
+        elif dtype.kind in 'SU':
+            fill = ''
+        else:
+            fill = 0
+
+        values = list()
+        for b in blocks:
+            if name in _names(b):
+                values.append(np.asarray(b[name]))
+            else:
+                values.append(np.full(_nrows(b), fill, dtype=dtype))
+        results[name] = np.concatenate(values)
+
+    return results
+
+
+def _nrows(block):
+    return len(block) if not isinstance(block, dict) else len(next(iter(block.values())))
+
+
+def _names(block):
+    if isinstance(block, np.ndarray):
+        return list(block.dtype.names)
+    elif isinstance(block, Table):
+        return block.colnames
+    else:
+        return list(block.keys())
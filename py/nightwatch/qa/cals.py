@@ -12,6 +12,19 @@ from astropy.table import Table
 from ..calibrations import pick_calib_file, get_calibrations
 
 
+def _read_fibers(qframe, fiberlo, fiberhi, data=None):
+    """Returns WAVELENGTH, FLUX of fibers [fiberlo:fiberhi] in file qframe,
+    read through ExposureData `data` if given."""
+    if data is not None:
+        rows = slice(fiberlo, fiberhi)
+        return (data.read(qframe, 'WAVELENGTH', rows=rows),
+                data.read(qframe, 'FLUX', rows=rows))
+
+    with fitsio.FITS(qframe) as fits:
+        return (fits['WAVELENGTH'][fiberlo:fiberhi, :],
+                fits['FLUX'][fiberlo:fiberhi, :])
+
+
 class QACalibArcs(QA):
     """Class representing arc lamp QA, tracking identified bright lines.
     
@@ -28,7 +41,9 @@ class QACalibArcs(QA):
         """
         return obstype.upper() == 'ARC'
     
-    def run(self, indir):
+    uses_data = True
+
+    def run(self, indir, data=None):
         """Loop through ARC qframes and identify the pseudo-equivalent widths of prominent lines.
 
         Returns Table object with columns:
@@ -38,7 +53,10 @@ class QACalibArcs(QA):
         """
         # get night, expid data
         qframes = sorted(glob(os.path.join(indir, 'qframe-*.fits')))
-        hdr = fitsio.read_header(qframes[0], ext='FIBERMAP')
+        if data is not None:
+            hdr = data.header(qframes[0], 'FIBERMAP')
+        else:
+            hdr = fitsio.read_header(qframes[0], ext='FIBERMAP')
         night = hdr['NIGHT']
         expid = hdr['EXPID']
         program = hdr['PROGRAM']
@@ -69,9 +87,9 @@ class QACalibArcs(QA):
 
                 # Loop over the brightest arc lines in each camera.
                 if os.path.exists(qframe):
-                    fits = fitsio.FITS(qframe)
-                    wave = np.median(fits['WAVELENGTH'][fiberlo:fiberhi, :], axis=0)
-                    flux = np.median(fits['FLUX'][fiberlo:fiberhi, :], axis=0)
+                    wave, flux = _read_fibers(qframe, fiberlo, fiberhi, data)
+                    wave = np.median(wave, axis=0)
+                    flux = np.median(flux, axis=0)
 
                     for arcline in wavelengths[cam]:
                         linelabel = f'{cam}{arcline:g}'
@@ -109,7 +127,9 @@ class QACalibFlats(QA):
         """
         return obstype.upper() == 'FLAT'
     
-    def run(self, indir):
+    uses_data = True
+
+    def run(self, indir, data=None):
         """Loop through FLAT qframes and compute integral flux in each camera.
 
         Returns Table object with columns:
@@ -119,7 +139,10 @@ class QACalibFlats(QA):
         """
         # get night, expid data
         qframes = sorted(glob(os.path.join(indir, 'qframe-*.fits')))
-        hdr = fitsio.read_header(qframes[0], ext='FIBERMAP')
+        if data is not None:
+            hdr = data.header(qframes[0], 'FIBERMAP')
+        else:
+            hdr = fitsio.read_header(qframes[0], ext='FIBERMAP')
         night = hdr['NIGHT']
         expid = hdr['EXPID']
         program = hdr['PROGRAM']
@@ -148,9 +171,9 @@ class QACalibFlats(QA):
                 qframe = os.path.join(indir, f'qframe-{cam.lower()}{spectro}-{expid:08d}.fits')
 
                 if os.path.exists(qframe):
-                    fits = fitsio.FITS(qframe)
-                    wave = np.median(fits['WAVELENGTH'][fiberlo:fiberhi, :], axis=0)
-                    flux = np.median(fits['FLUX'][fiberlo:fiberhi, :], axis=0)
+                    wave, flux = _read_fibers(qframe, fiberlo, fiberhi, data)
+                    wave = np.median(wave, axis=0)
+                    flux = np.median(flux, axis=0)
                     integ_flux = np.trapz(flux, wave)
 
                     dico[f'{cam}_INTEG_FLUX'] = integ_flux
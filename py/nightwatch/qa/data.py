@@ -0,0 +1,218 @@
+'''
+Shared, memoized access to the qproc outputs of one exposure for QA
+
+Several QA classes read the same files: QAAmp and QANoiseCorr read every
+preproc file, QASpecscore, QAFiberflat, and QASNR read every qframe or
+qcframe, QACalibArcs and QACalibFlats reopen the qframes, and QATraceShift
+and QAPSF read every psf header.  QARunner instead builds one ExposureData
+per exposure, and run_camera_qa one per camera in the qproc worker, and
+passes it to the QA classes (those with uses_data=True), which read
+through it:
+
+  * header(filename, ext) : FITS header
+  * read(filename, ext, rows=None, columns=None) : image or table HDU,
+    optionally only some rows (e.g. a slice of fibers) or table columns
+  * qframe(filename) : QFrame from desispec.qproc.io.read_qframe
+
+Each product is read at most once and kept until evicted.  Row and column
+selections are served from the full product if that is already loaded, and
+otherwise read (and kept) on their own, which is cheaper than reading the
+whole HDU for a small selection.  The images of qframe and qcframe files
+always come from their QFrame, so that those are read only once.
+Products are evicted least recently used first when their total size
+exceeds max_bytes.  The same product requested from several threads at
+once is only read once.
+
+Returned objects are shared between QA classes and must not be modified.
+
+An ExposureData lives in one process.  QAAmp and QANoiseCorr only read
+through it when they run serially, i.e. per camera within the qproc
+worker, where they share the preproc reads with each other.  When QARunner
+runs them itself (e.g. with --qproc-mode subprocess, or for cameras whose
+per-camera QA didn't run) they fan out one task per preproc file over the
+worker pool, and each task reads its own file: sending full CCD images to
+the workers would cost more than reading them there.
+'''
+
+import os
+import glob
+import threading
+import collections
+
+import numpy as np
+import fitsio
+
+#- default max memory for cached products of one exposure [bytes]
+DEFAULT_MAX_BYTES = 2e9
+
+#- QFrame attributes corresponding to qframe HDUs
+QFRAME_HDUS = dict(FLUX='flux', IVAR='ivar', MASK='mask', WAVELENGTH='wave')
+
+
+def _nbytes(value):
+    '''Returns approximate memory used by a cached product in bytes'''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif hasattr(value, 'as_array'):
+        #- astropy Table, e.g. a fibermap
+        return value.as_array().nbytes
+    elif isinstance(value, (fitsio.FITSHDR, dict)):
+        return 0
+    else:
+        #- e.g. QFrame: its arrays plus its fibermap
+        return sum([_nbytes(v) for v in getattr(value, '__dict__', dict()).values()
+                    if isinstance(v, np.ndarray) or hasattr(v, 'as_array')])
+
+
+def _is_qframe(filename):
+    return os.path.basename(filename).startswith(('qframe-', 'qcframe-'))
+
+
+def _selection_key(rows, columns):
+    if isinstance(rows, slice):
+        rows = ('slice', rows.start, rows.stop, rows.step)
+    elif rows is not None:
+        rows = tuple(np.atleast_1d(rows).tolist())
+    if columns is not None:
+        columns = tuple(columns)
+    return rows, columns
+
+
+class ExposureData(object):
+    '''Lazy, memoized, memory-bounded reads of one exposure's qproc outputs'''
+
+    def __init__(self, indir, max_bytes=DEFAULT_MAX_BYTES):
+        '''
+        Args:
+            indir : directory with the qproc outputs of one exposure
+
+        Options:
+            max_bytes : max total size of cached products
+        '''
+        self.indir = indir
+        self.max_bytes = max_bytes
+        self.products = collections.OrderedDict()   #- key -> (value, nbytes)
+        self.nbytes = 0
+        self.nread = 0
+        self.nhits = 0
+        self._lock = threading.Lock()
+        self._loading = dict()   #- key -> threading.Event
+
+    def files(self, prefix, camera=None):
+        '''
+        Returns sorted list of indir/PREFIX-CAMERA-*.fits files, e.g.
+        files('qframe', 'b0'); all cameras if camera is None
+        '''
+        pattern = os.path.join(self.indir, '{}-{}-*.fits'.format(prefix, camera or '*'))
+        return sorted(glob.glob(pattern))
+
+    def _get(self, key, loader):
+        '''Returns product for key, calling loader() if it isn't cached'''
+        while True:
+            with self._lock:
+                if key in self.products:
+                    self.products.move_to_end(key)
+                    self.nhits += 1
+                    return self.products[key][0]
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    break
+
+            #- another thread is reading it; wait and look again
+            event.wait()
+
+        try:
+            value = loader()
+            self._put(key, value)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+        return value
+
+    def _peek(self, key):
+        '''Returns cached product for key, or None'''
+        with self._lock:
+            if key in self.products:
+                self.products.move_to_end(key)
+                self.nhits += 1
+                return self.products[key][0]
+        return None
+
+    def _put(self, key, value):
+        nbytes = _nbytes(value)
+        with self._lock:
+            self.nread += 1
+            if nbytes > self.max_bytes:
+                return
+            self.products[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                oldkey, (oldvalue, oldbytes) = self.products.popitem(last=False)
+                self.nbytes -= oldbytes
+
+    def header(self, filename, ext=0):
+        '''Returns FITS header of HDU ext of filename'''
+        return self._get(('header', filename, ext),
+                         lambda: fitsio.read_header(filename, ext))
+
+    def read(self, filename, ext, rows=None, columns=None):
+        '''
+        Returns data of HDU ext of filename
+
+        Options:
+            rows : slice or indices of image rows or table rows to read
+            columns : list of table columns to read
+
+        The FLUX, IVAR, MASK, and WAVELENGTH images of qframe and qcframe
+        files are taken from their QFrame, which other QA need anyway.
+        '''
+        full = self._peek(('read', filename, ext, None, None))
+        if full is None and ext in QFRAME_HDUS and _is_qframe(filename):
+            full = getattr(self.qframe(filename), QFRAME_HDUS[ext])
+
+        if full is None and rows is None and columns is None:
+            return self._get(('read', filename, ext, None, None),
+                             lambda: fitsio.read(filename, ext))
+
+        if full is not None:
+            data = full
+            if columns is not None:
+                data = data[list(columns)]
+            if rows is not None:
+                data = data[rows]
+            return data
+
+        key = ('read', filename, ext) + _selection_key(rows, columns)
+        return self._get(key, lambda: self._read_selection(filename, ext, rows, columns))
+
+    @staticmethod
+    def _read_selection(filename, ext, rows, columns):
+        with fitsio.FITS(filename) as fx:
+            hdu = fx[ext]
+            if hdu.get_exttype() == 'IMAGE_HDU':
+                if isinstance(rows, slice) and rows.step in (None, 1):
+                    return hdu[rows.start or 0:rows.stop or hdu.get_dims()[0], :]
+                data = hdu.read()
+                return data if rows is None else data[rows]
+            else:
+                if isinstance(rows, slice):
+                    rows = np.arange(hdu.get_nrows())[rows]
+                return hdu.read(rows=rows, columns=columns)
+
+    def qframe(self, filename):
+        '''Returns QFrame read from a qframe or qcframe file'''
+        from desispec.qproc.io import read_qframe
+        return self._get(('qframe', filename), lambda: read_qframe(filename))
+
+    def clear(self):
+        '''Drop all cached products'''
+        with self._lock:
+            self.products.clear()
+            self.nbytes = 0
+
+    def __repr__(self):
+        return 'ExposureData({}, {} products, {:.2f} GB, {} reads, {} hits)'.format(
+            self.indir, len(self.products), self.nbytes/1e9, self.nread, self.nhits)
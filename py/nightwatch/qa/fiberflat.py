@@ -1,4 +1,4 @@
-from .base import QA
+from .base import QA, stack_columns
 import glob
 import os
 import collections
@@ -6,7 +6,6 @@ import collections
 import numpy as np
 import fitsio
 
-from astropy.table import Table
 
 import desiutil.log
 from desispec.qproc.io import read_qframe
@@ -22,20 +21,23 @@ class QAFiberflat(QA):
     def valid_obstype(self, obstype):
         return ( obstype.upper() == "FLAT" )
 
-    def run(self, indir):
+    per_camera = True
+    uses_data = True
+
+    def run(self, indir, camera=None, data=None):
         '''TODO: document'''
 
         log = desiutil.log.get_logger()
 
         results = list()
 
-        infiles = glob.glob(os.path.join(indir, 'qframe-*.fits'))
+        infiles = glob.glob(os.path.join(indir, 'qframe-{}-*.fits'.format(camera or '*')))
         if len(infiles) == 0 :
             log.error("no qframe in {}".format(indir))
             return None
     
         for filename in infiles:
-            qframe = read_qframe(filename)
+            qframe = data.qframe(filename) if data is not None else read_qframe(filename)
             night = int(qframe.meta['NIGHT'])
             expid = int(qframe.meta['EXPID'])
             cam = qframe.meta['CAMERA'][0].upper()
@@ -56,10 +58,11 @@ class QAFiberflat(QA):
             tmp = np.median(qframe.flux,axis=1)
             this_fflat = tmp/np.median(tmp)
 
-            for f,fiber in enumerate(qframe.fibermap["FIBER"]) :
-                results.append(collections.OrderedDict(
-                    NIGHT=night, EXPID=expid, SPECTRO=spectro, CAM=cam, FIBER=fiber,FIBERFLAT=this_fflat[f],REF_FIBERFLAT=reference_fflat[f]))
+            fibers = np.asarray(qframe.fibermap["FIBER"])
+            nfibers = fibers.size
+            results.append(collections.OrderedDict(
+                NIGHT=np.full(nfibers, night), EXPID=np.full(nfibers, expid),
+                SPECTRO=np.full(nfibers, spectro), CAM=np.full(nfibers, cam), FIBER=fibers,
+                FIBERFLAT=this_fflat[:nfibers], REF_FIBERFLAT=reference_fflat[:nfibers]))
 
-        if len(results)==0 :
-            return None
-        return Table(results, names=results[0].keys())
+        return stack_columns(results)
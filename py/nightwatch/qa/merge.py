@@ -0,0 +1,166 @@
+'''
+Merge QA results of the same type on their metadata columns
+
+QARunner combines the results of different QA classes of the same type
+(e.g. PER_CAMFIBER from QASpecscore and QAFiberflat) with an outer join on
+their metadata columns.  Repeated astropy.table.join calls sort, mask, and
+copy the growing table for every QA class.  Instead, `merge` maps each
+metadata tuple, e.g. (NIGHT, EXPID, SPECTRO, CAM, FIBER), to a dense slot
+index from the distinct values of each key column (like camera x fiber
+slot), and scatters the columns of every table into preallocated arrays.
+
+The output is the same as repeated outer joins: rows sorted by the keys,
+key columns first as in the first table, then the other columns of each
+table in order, masked where a table has no row for a key.  Inputs that
+join would treat differently (duplicate keys within a table, non-key
+columns in several tables, masked or mismatched key columns) fall back to
+astropy.table.join.
+'''
+
+import numpy as np
+from astropy.table import Table, Column, MaskedColumn, join
+
+import desiutil.log
+
+#- max number of dense slots per row to use an occupancy array instead of
+#- sorting the slot indices
+MAX_SLOTS_PER_ROW = 64
+
+
+class MergeFallback(Exception):
+    '''Raised when `dense_merge` can't reproduce astropy join for its inputs'''
+    pass
+
+
+def merge(tables, keys):
+    '''
+    Returns outer join of tables on keys
+
+    Args:
+        tables : list of astropy Tables
+        keys : list of key column names
+
+    Same as joining the tables in order with
+    astropy.table.join(..., keys=keys, join_type='outer'), in linear time
+    and memory where possible.
+    '''
+    if len(tables) == 1:
+        return tables[0]
+
+    try:
+        return dense_merge(tables, keys)
+    except MergeFallback as err:
+        log = desiutil.log.get_logger()
+        log.debug('Using astropy join to merge on {}: {}'.format(keys, err))
+        tx = tables[0]
+        for i in range(1, len(tables)):
+            tx = join(tx, tables[i], keys=keys, join_type='outer')
+        return tx
+
+
+def _key_codes(tables, keys):
+    '''
+    Returns (slots, nslots, values) where slots[i] are the dense slot
+    indices of the rows of tables[i], nslots the number of possible slots,
+    and values[key] the sorted distinct values of each key
+    '''
+    nrows = [len(t) for t in tables]
+    slots = np.zeros(sum(nrows), dtype=np.int64)
+    nslots = 1
+    values = dict()
+    for key in keys:
+        columns = [t[key] for t in tables]
+        if any([isinstance(c, MaskedColumn) and np.any(c.mask) for c in columns]):
+            raise MergeFallback('masked key column {}'.format(key))
+        if len(set([c.dtype.kind for c in columns])) > 1 or columns[0].ndim != 1:
+            raise MergeFallback('mismatched key column {}'.format(key))
+
+        values[key], codes = np.unique(np.concatenate([np.asarray(c) for c in columns]),
+                                       return_inverse=True)
+        if nslots * len(values[key]) >= 2**62:
+            raise MergeFallback('too many key combinations')
+        slots = slots*len(values[key]) + codes.ravel()
+        nslots *= len(values[key])
+
+    return np.split(slots, np.cumsum(nrows)[:-1]), nslots, values
+
+
+def dense_merge(tables, keys):
+    '''
+    Returns outer join of tables on keys using dense slot indices
+
+    Raises MergeFallback if the result could differ from astropy join.
+    '''
+    for t in tables:
+        missing = [k for k in keys if k not in t.colnames]
+        if len(missing) > 0:
+            raise MergeFallback('missing key columns {}'.format(missing))
+
+    names = list()
+    for t in tables:
+        for name in t.colnames:
+            if name in keys:
+                continue
+            if name in names:
+                raise MergeFallback('column {} in more than one table'.format(name))
+            names.append(name)
+
+    slots, nslots, values = _key_codes(tables, keys)
+
+    #- rank of each occupied slot = output row, in key order
+    allslots = np.concatenate(slots)
+    if nslots <= MAX_SLOTS_PER_ROW * max(len(allslots), 1):
+        occupied = np.zeros(nslots, dtype=bool)
+        occupied[allslots] = True
+        rank = np.cumsum(occupied) - 1
+        outslots = np.flatnonzero(occupied)
+        rows = [rank[s] for s in slots]
+    else:
+        outslots, inverse = np.unique(allslots, return_inverse=True)
+        rows = np.split(inverse.ravel(), np.cumsum([len(s) for s in slots])[:-1])
+
+    nout = len(outslots)
+    for t, r in zip(tables, rows):
+        if len(np.unique(r)) != len(r):
+            raise MergeFallback('duplicate keys')
+
+    #- key columns from the digits of the slot indices
+    columns = dict()
+    remainder = outslots
+    for key in reversed(keys):
+        n = len(values[key])
+        columns[key] = _new_column(tables[0][key], values[key][remainder % n])
+        remainder = remainder // n
+
+    #- scatter the other columns into their output rows
+    for t, r in zip(tables, rows):
+        for name in t.colnames:
+            if name in keys:
+                continue
+            col = t[name]
+            data = np.zeros((nout,) + col.shape[1:], dtype=col.dtype)
+            data[r] = np.asarray(col)
+            mask = np.ones(data.shape, dtype=bool)
+            mask[r] = np.ma.getmaskarray(col)
+            if np.any(mask):
+                columns[name] = _new_column(col, data, mask=mask)
+            else:
+                columns[name] = _new_column(col, data)
+
+    order = tables[0].colnames + [name for name in names if name not in tables[0].colnames]
+    result = Table([columns[name] for name in order], copy=False)
+    for t in tables:
+        result.meta.update(t.meta)
+
+    return result
+
+
+def _new_column(template, data, mask=None):
+    '''Returns Column (or MaskedColumn if mask is given) with data and the
+    name, unit, description, and format of template'''
+    kwargs = dict(name=template.info.name, unit=template.info.unit,
+                  description=template.info.description, format=template.info.format)
+    if mask is None:
+        return Column(data, copy=False, **kwargs)
+    else:
+        return MaskedColumn(data, mask=mask, copy=False, **kwargs)
@@ -1,6 +1,7 @@
 from .base import QA
 import glob
 import os
+import copy
 import collections
 import itertools
 
@@ -11,13 +12,18 @@ from astropy.table import Table
 
 import desiutil.log
 from desispec.preproc import calc_overscan
-from .amp import _fix_amp_names
+from .amp import _fix_amp_names, amp_slices
 
-import multiprocessing as mp
+from .. import workers
 
-from ..run import get_ncpu
+#- seed of the pixel sample for the median correlation, so that the
+#- results of an exposure don't change between runs
+CORR_SEED = 0
 
-def corr(img,d0=4,d1=4,nrand=50000) :
+#- correlation engines of `corr`
+CORR_METHODS = ('median', 'fft')
+
+def corr(img,d0=4,d1=4,nrand=50000,method='median',seed=CORR_SEED,nsigma=5) :
     """
     Computes the correlation function of an image.
 
@@ -25,31 +31,69 @@ def corr(img,d0=4,d1=4,nrand=50000) :
       img : 2D numpy array
       d0  : size of output correlation along axis 0
       d1  : size of output correlation along axis 1
-      
+      nrand : number of random pixels sampled by the median method
+      method : 'median' for the median of the products of nrand pixels with
+               their (i0,i1) neighbors, computed for all lags at once, or
+               'fft' for the mean products of all pixels within nsigma,
+               from an FFT autocorrelation whose cost doesn't depend on d0,d1
+      seed : random seed of the pixel sample of the median method
+      nsigma : clipping threshold of the fft method in units of rms
+
     return correlation function as a 2D array of shape (d0,d1)
     """
     log = desiutil.log.get_logger()
+    if method not in CORR_METHODS:
+        raise ValueError('Unknown correlation method {}; expected one of {}'.format(
+            method, CORR_METHODS))
+
     mean,rms = calc_overscan(img, nsigma=5, niter=3)
-    tmp = (img-mean)/rms
+    tmp = ((img-mean)/rms).astype(np.float32, copy=False)
     log.debug("mean={:3.2f} rms={:3.2f}".format(mean,rms))
+
+    if method == 'fft':
+        corrimg = _fft_corr(tmp, d0, d1, nsigma)
+    else:
+        corrimg = _median_corr(tmp, d0, d1, nrand, seed)
+
+    corrimg /= corrimg[0,0]
+    return corrimg
+
+def _median_corr(tmp, d0, d1, nrand, seed):
+    """Median over a pixel sample of tmp[i,j]*tmp[i+i0,j+i1] for all lags"""
     n0=tmp.shape[0]
     n1=tmp.shape[1]
-    
-    if nrand>=n0*n1 :
-        ii0 = np.arange(n0-d0)
-        ii1 = np.arange(n1-d1)
+
+    if nrand>=(n0-d0)*(n1-d1) :
+        ii0, ii1 = [x.ravel() for x in np.meshgrid(np.arange(n0-d0), np.arange(n1-d1), indexing='ij')]
     else : # random subsampling to run faster
-        ii0=np.random.choice(n0-d0,size=nrand)
-        ii1=np.random.choice(n1-d1,size=nrand)
-        
-    corrimg = np.zeros((d0,d1))
-    
-    for i0 in range(d0) :
-        for i1 in range(d1) :
-            corrimg[i0,i1] = np.median(tmp[ii0,ii1]*tmp[ii0+i0,ii1+i1])
-            #log.debug("corr[{},{}] = {:4.3f}".format(i0,i1,corrimg[i0,i1]))
-    corrimg /= corrimg[0,0]
-    return corrimg
+        rng = np.random.RandomState(seed)
+        ii0=rng.choice(n0-d0,size=nrand)
+        ii1=rng.choice(n1-d1,size=nrand)
+
+    #- gather the sample and its neighbors at all (d0,d1) lags in one pass
+    flat = tmp.ravel()
+    index = ii0*n1 + ii1
+    lags = (np.arange(d0)[:,None]*n1 + np.arange(d1)[None,:]).ravel()
+    products = flat[index][None,:] * flat[index[None,:] + lags[:,None]]
+
+    return np.median(products, axis=1).reshape(d0,d1).astype(float)
+
+def _fft_corr(tmp, d0, d1, nsigma):
+    """Mean of tmp[i,j]*tmp[i+i0,j+i1] over pixels within nsigma, via FFT"""
+    import scipy.fft
+
+    n0, n1 = tmp.shape
+    good = (np.abs(tmp) < nsigma).astype(np.float32)
+    tmp = tmp * good
+
+    #- zero-pad to avoid wrapping lags up to (d0,d1)
+    shape = (scipy.fft.next_fast_len(n0+d0), scipy.fft.next_fast_len(n1+d1))
+    def autocorr(x):
+        fx = scipy.fft.rfft2(x, s=shape)
+        return scipy.fft.irfft2(fx*np.conj(fx), s=shape)[0:d0, 0:d1]
+
+    npairs = autocorr(good)
+    return (autocorr(tmp) / np.maximum(np.round(npairs), 1)).astype(float)
 
 class QANoiseCorr(QA):
     """docstring for QANoiseCorr"""
@@ -61,34 +105,43 @@ class QANoiseCorr(QA):
         # can only reliably compute noise correlation with zero images
         return obstype.upper() == "ZERO"
 
-    def run(self, indir):
+    per_camera = True
+    uses_data = True
+
+    #- correlation engine (see CORR_METHODS) and size of the CORR-i0-i1
+    #- lags; changing the size changes the output columns
+    corr_method = 'median'
+    corr_size = (4, 4)
+
+    def run(self, indir, camera=None, data=None):
         '''TODO: document'''
         log = desiutil.log.get_logger()
-        infiles = glob.glob(os.path.join(indir, 'preproc-*.fits'))
-        results = list()
-        
-        ncpu = get_ncpu(None)
-        
-        if ncpu > 1:
-            pool = mp.Pool(ncpu)
-            results = pool.map(get_dico, infiles)
-            pool.close()
-            pool.join()
-
-            #- convert list of lists into flattened list
-            results = list(itertools.chain.from_iterable(results))
+        infiles = glob.glob(os.path.join(indir, 'preproc-{}-*.fits'.format(camera or '*')))
+        if data is not None and not workers.parallel(len(infiles)):
+            results = [get_dico(filename, img=data.read(filename, 'IMAGE'),
+                                hdr=data.header(filename, 'IMAGE'),
+                                method=self.corr_method, size=self.corr_size)
+                       for filename in infiles]
         else:
-            for filename in infiles:
-                results.extend(get_dico(filename))
+            argslist = [(filename, None, None, self.corr_method, self.corr_size)
+                        for filename in infiles]
+            results = workers.starmap(get_dico, argslist)
+
+        #- convert list of lists into flattened list
+        results = list(itertools.chain.from_iterable(results))
                 
         return Table(results, names=results[0].keys())
 
             
-def get_dico(filename):
+def get_dico(filename, img=None, hdr=None, method='median', size=(4,4)):
     '''Return list of dictionaries of noisecorr qa metrics for each amp,
-    given path to a preproc-*.fits file.'''
+    given path to a preproc-*.fits file, and optionally its already read
+    IMAGE data and header, using correlation `method` for `size` lags.'''
 
-    img,hdr = fitsio.read(filename, 'IMAGE',header=True) 
+    if img is None or hdr is None:
+        img,hdr = fitsio.read(filename, 'IMAGE',header=True) 
+    else:
+        hdr = copy.deepcopy(hdr)  #- shared; _fix_amp_names edits it
     _fix_amp_names(hdr)
     night = hdr['NIGHT']
     expid = hdr['EXPID']
@@ -96,25 +149,16 @@ def get_dico(filename):
     spectro = int(hdr['CAMERA'][1])
 
     results = list()
-    ny, nx = img.shape
-    npix_amp = nx*ny//4
+    slices = amp_slices(img.shape)
     for amp in ['A', 'B', 'C', 'D']:
         if 'BIASSEC'+amp not in hdr.keys():
             continue
 
-        #- Subregion of mask covered by this amp
-        if amp == 'A':
-            subimg  = img[0:ny//2, 0:nx//2].astype(float)
-        elif amp == 'B':
-            subimg  = img[0:ny//2, nx//2:].astype(float)
-        elif amp == 'C':
-            subimg  = img[ny//2:, 0:nx//2].astype(float)
-        else:
-            subimg  = img[ny//2:, nx//2:].astype(float)
+        #- Subregion of image covered by this amp, as a view
+        subimg = img[slices[amp]]
 
-        n0=4
-        n1=4
-        corrimg = corr(subimg,n0,n1)
+        n0, n1 = size
+        corrimg = corr(subimg,n0,n1,method=method)
 
         dico={"NIGHT":night,"EXPID":expid,"SPECTRO":spectro,"CAM":cam,"AMP":amp}
         for i0 in range(n0) :
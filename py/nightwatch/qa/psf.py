@@ -20,22 +20,29 @@ class QAPSF(QA):
     def valid_obstype(self, obstype):
         return obstype.upper() == "ARC"
 
-    def run(self, indir):
+    per_camera = True
+    uses_data = True
+
+    def run(self, indir, camera=None, data=None):
         '''TODO: document'''
         log = desiutil.log.get_logger()
-        infiles = glob.glob(os.path.join(indir, 'psf-*.fits'))
+        infiles = glob.glob(os.path.join(indir, 'psf-{}-*.fits'.format(camera or '*')))
         results = list()
         for filename in infiles:
             log.debug(filename)
-            hdr = fitsio.read_header(filename)
+            hdr = data.header(filename) if data is not None else fitsio.read_header(filename)
             night = hdr['NIGHT']
             expid = hdr['EXPID']
             cam = hdr['CAMERA'][0].upper()
             spectro = int(hdr['CAMERA'][1])
             dico={"NIGHT":night,"EXPID":expid,"SPECTRO":spectro,"CAM":cam}
             
-            xsig = fitsio.read(filename,"XSIG")
-            ysig = fitsio.read(filename,"XSIG")
+            if data is not None:
+                xsig = data.read(filename,"XSIG")
+                ysig = data.read(filename,"XSIG")
+            else:
+                xsig = fitsio.read(filename,"XSIG")
+                ysig = fitsio.read(filename,"XSIG")
             dico["MEANXSIG"]=np.mean(xsig[:,0])
             dico["MINXSIG"]=np.min(xsig[:,0]) 
             dico["MAXXSIG"]=np.max(xsig[:,0])
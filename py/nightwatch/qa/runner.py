@@ -6,11 +6,14 @@ import os, sys
 import json
 import traceback
 import glob
+import functools
+import threading
+import concurrent.futures
 from pathlib import Path
 
 import numpy as np
 import fitsio
-from astropy.table import join, Table
+from astropy.table import Table
 
 import desiutil.log
 
@@ -24,94 +27,295 @@ from .fiberflat import QAFiberflat
 from .snr import QASNR
 from .history import SQLiteSummaryDB
 from .qprocstatus import QAQPROCStatus
+from .base import as_table, stack_columns
+from .merge import merge
+from .data import ExposureData, DEFAULT_MAX_BYTES
+from .. import workers
 from ..run import timestamp
+from ..timing import timed
+
+def get_obstype(indir, camera=None, data=None):
+    '''
+    Returns (obstype, header) of the exposure in indir as guessed by qproc
+
+    Args:
+        indir : directory with qproc outputs
+
+    Options:
+        camera : only consider files for this camera, e.g. b0
+        data : ExposureData of indir to read headers through
+
+    Returns (None, None) if there are no preproc files
+    '''
+    log = desiutil.log.get_logger()
+    camera = camera or '*'
+    read_header = data.header if data is not None else fitsio.read_header
+    preprocfiles = sorted(glob.glob('{}/preproc-{}-*.fits'.format(indir, camera)))
+    if len(preprocfiles) == 0:
+        return None, None
+
+    # We can have different obstypes (signal+dark) with calibration data
+    # obtained with a calibration slit hooked to a single spectrograph.
+    # So we have to loop over all frames to check if there are science,
+    # arc, or flat obstypes as guessed by qproc.
+    qframefiles = sorted(glob.glob('{}/qframe-{}-*.fits'.format(indir, camera)))
+    if len(qframefiles) == 0 : # no qframe so it's either zero or dark
+        hdr = read_header(preprocfiles[0], 0)
+        if 'OBSTYPE' in hdr :
+            obstype = hdr['FLAVOR'].strip()
+        else :
+            log.warning("Using FLAVOR instead of missing OBSTYPE")
+            obstype = hdr['FLAVOR'].strip()
+    else :
+        obstype = None
+        log.debug("Reading qframe headers to guess flavor ...")
+        for qframefile in qframefiles : # look at all of them and prefer arc or flat over dark or zero
+            hdr = read_header(qframefile, 0)
+            if 'OBSTYPE' in hdr :
+                this_obstype = hdr['OBSTYPE'].strip().upper()
+            else:
+                log.warning("Using FLAVOR instead of missing OBSTYPE")
+                obstype = hdr['FLAVOR'].strip()
+
+            if this_obstype == "ARC" or this_obstype == "FLAT" \
+               or this_obstype  == "TESTARC" or this_obstype == "TESTFLAT" \
+               or this_obstype == "OTHER" :
+                obstype = this_obstype
+
+                if obstype == "OTHER":
+                    obstype = "TESTFLAT"
+
+                # we use this so we exit the loop
+                break
+            elif obstype == None :
+                obstype = this_obstype
+                # we stay in the loop in case another frame has another obstype
+
+    return obstype, hdr
+
+
+def run_camera_qa(indir, camera, qaclasses):
+    '''
+    Run per-camera QA for one camera as soon as its qproc outputs exist
+
+    Args:
+        indir : directory with qproc outputs
+        camera : camera to process, e.g. b0
+        qaclasses : list of QA classes with per_camera=True
+
+    Returns dict with the OBSTYPE of this camera's outputs under the key
+    'OBSTYPE', and name -> astropy Table (or None) for every QA class that is
+    valid for that OBSTYPE.  This is designed to be run in a worker process
+    right after qproc, and the results passed to QARunner.add_camera_results.
+    '''
+    log = desiutil.log.get_logger()
+    data = ExposureData(indir)
+    obstype, hdr = get_obstype(indir, camera, data=data)
+    results = dict(OBSTYPE=obstype)
+    if obstype is None:
+        if hdr is None:
+            log.error('No preproc file for {} in {}'.format(camera, indir))
+        return results
+
+    for X in qaclasses:
+        qa = X()
+        if not qa.valid_obstype(obstype):
+            continue
+        log.debug('{} Running {} {} for {}'.format(timestamp(), qa, qa.output_type, camera))
+        try:
+            if qa.uses_data:
+                results[repr(qa)] = qa.run(indir, camera=camera, data=data)
+            else:
+                results[repr(qa)] = qa.run(indir, camera=camera)
+        except Exception as err:
+            log.warning('{} failed on {} {} because {}; skipping'.format(qa, indir, camera, str(err)))
+            results[repr(qa)] = None
+
+    log.debug('{} for {}'.format(data, camera))
+    return results
+
 
 class QARunner(object):
 
     #- class-level variable of default QA classes to run
     default_qalist = (QAAmp, QANoiseCorr, QASpecscore, QATraceShift, QAPSF, QAFiberflat, QASNR, QACalibArcs, QACalibFlats, QAQPROCStatus)
 
-    def __init__(self, qalist=None):
-        '''TODO: document'''
+    def __init__(self, qalist=None, concurrency=1, data_bytes=DEFAULT_MAX_BYTES):
+        '''
+        Options:
+            qalist : list of QA classes to run; default default_qalist
+            concurrency : max number of QA classes to run at once in `run`,
+                further limited by the number of shared worker processes
+            data_bytes : memory cap of the ExposureData shared by the QA
+                classes of one exposure
+        '''
         if qalist is None:
             qalist = QARunner.default_qalist
 
         #- Runner keeps instances, not just their classes
         self.qalist = [X() for X in qalist]
+        self.concurrency = max(1, concurrency)
+        self.data_bytes = data_bytes
+
+        #- per-camera results streamed from qproc workers before `run`;
+        #- indir -> camera -> results from run_camera_qa
+        self._camera_results = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def camera_qa(self):
+        '''
+        Picklable function(indir, camera) to run the per-camera QA for one
+        camera, e.g. in the qproc worker right after qproc for that camera
+        '''
+        qaclasses = tuple([type(qa) for qa in self.qalist if qa.per_camera])
+        return functools.partial(run_camera_qa, qaclasses=qaclasses)
+
+    def add_camera_results(self, indir, camera, results):
+        '''
+        Store results of `camera_qa` for `camera` so that `run` doesn't
+        recompute them
+
+        Args:
+            indir : directory with qproc outputs
+            camera : e.g. b0
+            results : dict returned by run_camera_qa
+        '''
+        if results is None:
+            return
+
+        with self._lock:
+            self._camera_results.setdefault(indir, dict())[camera] = results
 
-    def run(self, indir, outfile=None, jsonfile=None):
-        '''TODO: document'''
         log = desiutil.log.get_logger()
-        log.debug('Running QA in {}'.format(indir))
-        print('here qa.runner', indir)
-        preprocfiles = sorted(glob.glob('{}/preproc-*.fits'.format(indir)))
-        if len(preprocfiles) == 0:
-            log.error('No preproc files found in {}'.format(indir))
-            return None
+        names = [key for key, value in results.items() if key != 'OBSTYPE' and value is not None]
+        log.info('{} Per-camera QA ready for {} in {}: {}'.format(
+            timestamp(), camera, indir, ', '.join(names)))
 
-        # We can have different obstypes (signal+dark) with calibration data
-        # obtained with a calibration slit hooked to a single spectrograph.
-        # So we have to loop over all frames to check if there are science,
-        # arc, or flat obstypes as guessed by qproc.
-        qframefiles = sorted(glob.glob('{}/qframe-*.fits'.format(indir)))
-        if len(qframefiles) == 0 : # no qframe so it's either zero or dark
-            hdr = fitsio.read_header(preprocfiles[0], 0)
-            if 'OBSTYPE' in hdr :
-                obstype = hdr['FLAVOR'].strip()
-            else :
-                log.warning("Using FLAVOR instead of missing OBSTYPE")
-                obstype = hdr['FLAVOR'].strip()
-        else :
-            obstype = None
-            log.debug("Reading qframe headers to guess flavor ...")
-            for qframefile in qframefiles : # look at all of them and prefer arc or flat over dark or zero
-                hdr = fitsio.read_header(qframefile, 0)
-                if 'OBSTYPE' in hdr :
-                    this_obstype = hdr['OBSTYPE'].strip().upper()
+    def forget(self, indir):
+        '''Drop any stored per-camera results for indir'''
+        with self._lock:
+            return self._camera_results.pop(indir, dict())
+
+    def _run_qa(self, qa, indir, streamed, timer=None, data=None):
+        '''
+        Returns results of `qa` for indir, or None if it failed, using
+        per-camera results in `streamed` where available, and reading
+        through ExposureData `data` if given
+        '''
+        log = desiutil.log.get_logger()
+        log.info('{} Running {} {}'.format(timestamp(), qa, qa.output_type))
+        qa_results = None
+        try:
+            with timed(timer, 'qa', str(qa)):
+                if qa.per_camera and len(streamed) > 0:
+                    qa_results = self._combine_camera_results(qa, indir, streamed, data)
+                elif qa.uses_data and data is not None:
+                    qa_results = qa.run(indir, data=data)
                 else:
-                    log.warning("Using FLAVOR instead of missing OBSTYPE")
-                    obstype = hdr['FLAVOR'].strip()
+                    qa_results = qa.run(indir)
+                qa_results = as_table(qa_results)
+        except Exception as err:
+            log.warning('{} failed on {} because {}; skipping'.format(qa, indir,str(err)))
+            exc_info = sys.exc_info()
+            traceback.print_exception(*exc_info)
+            del exc_info
+            #- TODO: print traceback somewhere useful
+
+        return qa_results
+
+    def _combine_camera_results(self, qa, indir, streamed, data=None):
+        '''
+        Returns Table of `qa` results for all cameras in indir, using results
+        in `streamed` (camera -> run_camera_qa results) where available
+        '''
+        kwargs = dict(data=data) if qa.uses_data and data is not None else dict()
+        log = desiutil.log.get_logger()
+        name = repr(qa)
+        preprocfiles = glob.glob('{}/preproc-*.fits'.format(indir))
+        cameras = sorted(set([os.path.basename(f).split('-')[1] for f in preprocfiles]))
+        todo = [cam for cam in cameras if name not in streamed.get(cam, dict())]
 
-                if this_obstype == "ARC" or this_obstype == "FLAT" \
-                   or this_obstype  == "TESTARC" or this_obstype == "TESTFLAT" \
-                   or this_obstype == "OTHER" :
-                    obstype = this_obstype
+        #- nothing streamed for this QA; run it on all cameras at once
+        if len(todo) == len(cameras):
+            return qa.run(indir, **kwargs)
 
-                    if obstype == "OTHER":
-                        obstype = "TESTFLAT"
+        #- in camera order, like the serial path, however results arrived
+        tables = list()
+        for cam in cameras:
+            if cam not in todo:
+                tables.append(streamed[cam][name])
+                continue
+            log.debug('Running {} for {} which was not streamed'.format(qa, cam))
+            try:
+                tables.append(qa.run(indir, camera=cam, **kwargs))
+            except Exception as err:
+                log.warning('{} failed on {} {} because {}; skipping'.format(qa, indir, cam, str(err)))
 
-                    # we use this so we exit the loop
-                    break
-                elif obstype == None :
-                    obstype = this_obstype
-                    # we stay in the loop in case another frame has another obstype
+        #- Tables or columnar blocks; stacked by column without building rows
+        return stack_columns(tables)
 
+    def run(self, indir, outfile=None, jsonfile=None, timer=None, dbdir=None):
+        '''
+        Run QA on the processed files in indir
+
+        Options:
+            outfile : write combined QA results to this FITS file
+            jsonfile : update this JSON file of thresholds-related results
+            timer : ExposureTimer to record the time of each QA class
+            dbdir : directory of the summary QA database to add outfile to;
+                default historyqa/ in the base directory of outfile, i.e.
+                next to its YEARMMDD/ night directory
+
+        When outfile is written to a staging directory (see
+        nightwatch.staging), pass the final output base directory's
+        historyqa/ as dbdir, since only exposure directories are published.
+        '''
+        log = desiutil.log.get_logger()
+        log.debug('Running QA in {}'.format(indir))
+        print('here qa.runner', indir)
+
+        #- QA classes share reads of the same qproc outputs
+        data = ExposureData(indir, max_bytes=self.data_bytes)
+        obstype, hdr = get_obstype(indir, data=data)
+        if obstype is None and hdr is None:
+            log.error('No preproc files found in {}'.format(indir))
+            self.forget(indir)
+            return None
 
         log.debug('Found OBSTYPE={} files'.format(obstype))
 
         results = dict()
-        
+        streamed = self.forget(indir)
+
+        qalist = list()
         for qa in self.qalist:
             if qa.valid_obstype(obstype):
-                log.info('{} Running {} {}'.format(timestamp(), qa, qa.output_type))
-                qa_results = None
-                try:
-                    qa_results = qa.run(indir)
-                except Exception as err:
-                    log.warning('{} failed on {} because {}; skipping'.format(qa, indir,str(err)))
-                    exc_info = sys.exc_info()
-                    traceback.print_exception(*exc_info)
-                    del exc_info
-                    #raise(err)
-                    #- TODO: print traceback somewhere useful
-
-                if qa_results is not None :
-                    if qa.output_type not in results:
-                        results[qa.output_type] = list()
-                    results[qa.output_type].append(qa_results)
-
+                qalist.append(qa)
             else :
                 log.debug('Skip {} {} for {}'.format(qa, qa.output_type, obstype))
+
+        #- QA classes are independent and mostly wait on I/O or the shared
+        #- worker pool, so run several at once; results are merged in
+        #- qalist order regardless of which finishes first
+        nthreads = min(self.concurrency, len(qalist), workers.get_ncpu())
+        run_qa = functools.partial(self._run_qa, indir=indir, streamed=streamed,
+                                   timer=timer, data=data)
+        if nthreads > 1:
+            log.debug('Running {} QA classes with {} threads'.format(len(qalist), nthreads))
+            with concurrent.futures.ThreadPoolExecutor(nthreads, thread_name_prefix='nightwatch-qa') as executor:
+                qa_outputs = list(executor.map(run_qa, qalist))
+        else:
+            qa_outputs = [run_qa(qa) for qa in qalist]
+
+        log.debug('QA done with {}'.format(data))
+        data.clear()
+
+        for qa, qa_results in zip(qalist, qa_outputs):
+            if qa_results is not None :
+                if qa.output_type not in results:
+                    results[qa.output_type] = list()
+                results[qa.output_type].append(qa_results)
         #- Combine results for different types of QA
         join_keys = dict(
             PER_AMP = ['NIGHT', 'EXPID', 'SPECTRO', 'CAM', 'AMP'],
@@ -158,10 +362,7 @@ class QARunner(object):
             if len(results[qatype]) == 1:
                 results[qatype] = results[qatype][0]
             else:
-                tx = results[qatype][0]
-                for i in range(1, len(results[qatype])):
-                    tx = join(tx, results[qatype][i], keys=join_keys[qatype], join_type='outer')
-                results[qatype] = tx
+                results[qatype] = merge(results[qatype], join_keys[qatype])
 
             #- convert python string to bytes for FITS format compatibility
             if 'AMP' in results[qatype].colnames:
@@ -190,8 +391,9 @@ class QARunner(object):
             log.info('{} Finished writing {}'.format(timestamp(), outfile))
 
             #- Save QA output to summary DB using the qa-00EXPID.fits output
-            nwbase = Path(outfile).parents[2]
-            dbdir = os.path.join(nwbase, 'historyqa')
+            if dbdir is None:
+                nwbase = Path(outfile).parents[2]
+                dbdir = os.path.join(nwbase, 'historyqa')
             dbfile = os.path.join(dbdir, 'nightwatch_summary_qa.db')
             os.makedirs(dbdir, exist_ok=True)
 
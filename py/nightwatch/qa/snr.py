@@ -6,7 +6,7 @@ import collections
 import numpy as np
 import fitsio
 
-from astropy.table import Table
+from astropy.table import Table, vstack
 from astropy import units,constants
 
 import desiutil.log
@@ -15,13 +15,13 @@ from desispec.calibfinder import CalibFinder
 from desispec.interpolation import resample_flux
 from desispec.io.filters import load_legacy_survey_filter
 from desispec.io.fluxcalibration import read_average_flux_calibration
+from speclite.filters import FilterConvolution, default_flux_unit
 
 from desimodel.io import load_desiparams
 
 from desitarget import targets
 
-import multiprocessing as mp
-from ..run import get_ncpu
+from .. import workers
 
 
 class QASNR(QA):
@@ -59,7 +59,13 @@ class QASNR(QA):
     def valid_obstype(self, obstype):
         return ( obstype.upper() == "SCIENCE" )
 
-    def run(self, indir):
+    uses_data = True
+
+    #- 'batched' computes all fibers of a spectrograph with whole-frame array
+    #- operations; 'per_fiber' uses the original get_dico per fiber
+    engine = 'batched'
+
+    def run(self, indir, data=None):
         '''TODO: document'''
 
         log = desiutil.log.get_logger()
@@ -74,7 +80,7 @@ class QASNR(QA):
         # find number of spectros
         spectros=[]
         for filename in infiles:
-            hdr=fitsio.read_header(filename)
+            hdr=data.header(filename) if data is not None else fitsio.read_header(filename)
             s=int(hdr['CAMERA'][1])
             spectros.append(s)
         spectros=np.unique(spectros)
@@ -86,7 +92,7 @@ class QASNR(QA):
             qframes={}
             fmap=None
             for infile in infiles :
-                qframe=read_qframe(infile)
+                qframe=data.qframe(infile) if data is not None else read_qframe(infile)
                 cam=qframe.meta["CAMERA"][0].upper()
                 qframes[cam]=qframe
                 
@@ -115,23 +121,217 @@ class QASNR(QA):
                     iiband[c] &= (self.rwave < qframe.wave[0][-1])
                     
             
+            if self.engine == 'batched':
+                results.append(get_spectro_table(self, iiband, qframes, fmap, night, expid, spectro, stars, qsos))
+                continue
+
             #- for each fiber, generate list of arguments to pass to get_dico
             #- get_fiber_data extracts data for only *one* fiber from qframes, fmap, which have data for all fibers
             #- this reduces the parallel processing overhead
             argslist = [(self, iiband, get_fiber_data(qframes, fmap, f, fiber, night, expid, spectro, stars, qsos)) for f, fiber in enumerate(fmap["FIBER"])]
             
-            ncpu = get_ncpu(None)
-            
-            if ncpu > 1:
-                pool = mp.Pool(ncpu)
-                results = pool.starmap(get_dico, argslist)
-            else:
-                for args in argslist:
-                    results.append(get_dico(**args))
+            results.append(Table(workers.starmap(get_dico, argslist)))
             
         if len(results)==0 :
             return None
-        return Table(results, names=results[0].keys())
+        return vstack(results)
+
+    def filter_weights(self):
+        '''
+        Returns dict band+photsys -> (lo, hi, weights) for the G, R, Z
+        filters, such that the maggies of a spectrum `rflux` in units of
+        1e-17 erg/s/cm2/A on self.rwave are rflux[..., lo:hi].dot(weights)
+        '''
+        if getattr(self, '_filter_weights', None) is None:
+            self._filter_weights = dict()
+            for photsys in ["N", "S"]:
+                for band in ["G", "R", "Z"]:
+                    self._filter_weights[band+photsys] = ab_maggies_weights(
+                        self.filters[band+photsys], self.rwave)
+
+        return self._filter_weights
+
+class FluxResampler(object):
+    """
+    Flux-conserving resampling of spectra on per-fiber wavelength grids onto
+    one output grid, equivalent to desispec.interpolation.resample_flux for
+    each fiber but precomputed once per camera and applied to all fibers
+    with array operations.
+
+    resample_flux integrates the piecewise linear function through the
+    input nodes (plus zero-valued nodes one step beyond each end) over each
+    output bin.  That is linear in the input values: with C the cumulative
+    trapezoid integral, the integral up to a bin edge t in input interval
+    [x_k, x_k+1] is C_k + a*y_k + b*y_k+1, where k, a, b only depend on the
+    wavelength grids.
+    """
+
+    def __init__(self, xout, x):
+        """
+        Args:
+            xout : sorted 1D output wavelength grid
+            x : sorted input wavelength grids, shape (nspec, nwave)
+        """
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        xout = np.asarray(xout, dtype=float)
+        nspec, nin = x.shape
+
+        #- output bin edges, as in resample_flux
+        edges = np.zeros(xout.size+1)
+        edges[1:-1] = (xout[:-1]+xout[1:])/2.
+        edges[0] = 1.5*xout[0]-0.5*xout[1]
+        edges[-1] = 1.5*xout[-1]-0.5*xout[-2]
+        self.binsize = np.diff(edges)
+        if np.any(self.binsize <= 0):
+            raise ValueError("Zero or negative bin size")
+
+        #- input nodes padded with the zero-flux edges of the end triangles
+        xx = np.hstack([2*x[:, 0:1]-x[:, 1:2], x, 2*x[:, -1:]-x[:, -2:-1]])
+        self.dxx = np.diff(xx, axis=1)
+
+        #- input interval k of each edge for each spectrum, found for all
+        #- spectra at once by offsetting each spectrum's grid
+        t = np.clip(edges[None, :], xx[:, 0:1], xx[:, -1:])
+        offset = (max(xx.max(), edges.max()) - min(xx.min(), edges.min()) + 1.0) * np.arange(nspec)[:, None]
+        k = np.searchsorted((xx+offset).ravel(), (t+offset).ravel(), side='right').reshape(t.shape)
+        k -= 1 + (nin+2)*np.arange(nspec)[:, None]
+        self.k = np.clip(k, 0, nin)
+
+        h = np.take_along_axis(self.dxx, self.k, axis=1)
+        u = np.clip(t - np.take_along_axis(xx, self.k, axis=1), 0, h)
+        self.b = u**2/(2*h)
+        self.a = u - self.b
+
+        self.dx = np.gradient(x, axis=1)
+        self.dxout = np.gradient(xout)
+
+    def integrate(self, y):
+        """Returns mean of input flux density y (nspec, nwave) in each output bin"""
+        y = np.atleast_2d(y)
+        yy = np.zeros((y.shape[0], y.shape[1]+2))
+        yy[:, 1:-1] = y
+        cumint = np.zeros_like(yy)
+        cumint[:, 1:] = np.cumsum((yy[:, :-1]+yy[:, 1:])*self.dxx/2., axis=1)
+        integral = np.take_along_axis(cumint, self.k, axis=1) \
+                 + np.take_along_axis(yy, self.k, axis=1)*self.a \
+                 + np.take_along_axis(yy, self.k+1, axis=1)*self.b
+        return np.diff(integral, axis=1) / self.binsize
+
+    def __call__(self, flux, ivar):
+        """Returns outflux, outivar like resample_flux(xout, x, flux, ivar)"""
+        a = self.integrate(flux*ivar)
+        b = self.integrate(ivar)
+        outflux = np.zeros(a.shape)
+        mask = (b > 0)
+        outflux[mask] = a[mask] / b[mask]
+        outivar = self.integrate(ivar/self.dx)*self.dxout
+        return outflux, outivar
+
+def ab_maggies_weights(filt, wave, chunksize=512):
+    """
+    Returns (lo, hi, weights) such that
+    filt.get_ab_maggies(flux*1e-17*erg/s/cm2/A, wave) == flux[..., lo:hi].dot(weights)
+
+    The speclite convolution is linear in flux, so the weights are its
+    response to unit spectra on the part of `wave` that covers the filter.
+    """
+    lo = np.where(wave <= filt.wavelength[0])[0][-1]
+    hi = 1 + np.where(wave >= filt.wavelength[-1])[0][0]
+    conv = FilterConvolution(filt, wave[lo:hi], photon_weighted=True,
+                             interpolate=True, units=default_flux_unit)
+    fluxunits = 1e-17 * units.erg / units.s / units.cm**2 / units.Angstrom
+    scale = fluxunits.to(default_flux_unit) / filt.ab_zeropoint.value
+
+    n = hi - lo
+    weights = np.zeros(n)
+    for i in range(0, n, chunksize):
+        unit = np.zeros((min(chunksize, n-i), n))
+        unit[np.arange(unit.shape[0]), i+np.arange(unit.shape[0])] = 1.0
+        weights[i:i+unit.shape[0]] = conv(unit, axis=-1) * scale
+
+    return lo, hi, weights
+
+def get_spectro_table(self, iiband, qframes, fmap, night, expid, spectro, stars, qsos):
+    """Returns Table of QASNR metrics for all fibers of one spectrograph, the
+    same as get_dico for each fiber, using whole-frame array operations.
+    Args:
+        self: QASNR
+        iiband: output wavelength ranges in self.rwave for the cameras
+        qframes: dictionary of QFrame objects by camera
+    """
+    nfiber = len(fmap)
+    columns = collections.OrderedDict()
+    columns["NIGHT"] = np.full(nfiber, night)
+    columns["EXPID"] = np.full(nfiber, expid)
+    columns["SPECTRO"] = np.full(nfiber, spectro)
+    columns["FIBER"] = np.asarray(fmap["FIBER"])
+    for k in ["FLUX_G","FLUX_R","FLUX_Z"] :
+        columns[k] = np.asarray(fmap[k])
+
+    morphtype = np.char.strip(np.asarray(fmap["MORPHTYPE"]).astype(bytes)).astype("S5")
+    empty = (morphtype == b"") # not filled in some sims
+    morphtype[empty & (stars | qsos)] = b"PSF"
+    morphtype[empty & ~(stars | qsos)] = b"OTHER"
+    morphtype[np.char.strip(np.asarray(fmap["OBJTYPE"]).astype(str)) == "SKY"] = b"SKY"
+    columns["MORPHTYPE"] = morphtype
+
+    photsys = np.char.strip(np.asarray(fmap["PHOTSYS"]).astype(str))
+
+    #- accumulate the resampled cameras on the part of rwave they cover
+    ii = np.concatenate([np.where(iiband[c])[0] for c in iiband] + [np.zeros(0, dtype=int)])
+    wlo, whi = (ii.min(), ii.max()+1) if ii.size > 0 else (0, 0)
+    sw  = np.zeros((nfiber, whi-wlo))
+    swf = np.zeros((nfiber, whi-wlo))
+
+    for c in ["B","R","Z"] :
+        if c in qframes :
+            qframe = qframes[c]
+            columns["SNR_"+c] = np.median(qframe.flux * np.sqrt(qframe.ivar), axis=1)
+            ii = np.where(iiband[c])[0]
+            if ii.size > 1:
+                resampler = FluxResampler(self.rwave[ii], qframe.wave)
+                cf, cw = resampler(qframe.flux, qframe.ivar)
+                sw[:, ii-wlo]  += cw
+                swf[:, ii-wlo] += cw*cf
+        else :
+            columns["SNR_"+c] = np.zeros(nfiber)
+
+    rflux = swf/(sw+(sw==0))
+    # interpolate over masked pixels
+    rwave = self.rwave[wlo:whi]
+    for f in range(nfiber):
+        good = sw[f] > 0
+        if np.count_nonzero(good) > 2 and not np.all(good):
+            rflux[f, ~good] = np.interp(rwave[~good], rwave[good], rflux[f, good], left=0, right=0)
+
+    weights = self.filter_weights()
+    for c in ["G","R","Z"] :
+        specflux = np.zeros(nfiber)
+        for p in ["N","S"]:
+            selection = (photsys == p)
+            if not np.any(selection):
+                continue
+            lo, hi, w = weights[c+p]
+            #- rflux is zero outside of [wlo:whi]
+            i, j = max(lo, wlo), min(hi, whi)
+            if i < j:
+                specflux[selection] = rflux[selection, i-wlo:j-wlo].dot(w[i-lo:j-lo])*1e9 # nano maggies
+        columns["SPECFLUX_"+c] = specflux
+
+    for c in ["B","R","Z"] :
+        thru = np.zeros(nfiber)
+        if c in qframes and "CALVALUE" in qframes[c].meta :
+            meta = qframes[c].meta
+            photometric_band = "G" if c == "B" else c
+            photflux = columns["FLUX_"+photometric_band]
+            ok = (photflux >= 10.)
+            # the throughput is proportional to the calibration value used in qproc ( flux = electrons/calvalue)
+            thru0 = meta["CALVALUE"]*self.thru_conversion_factor_ergs_per_cm2 * self.thru_conversion_wavelength / meta["CALWAVE"] / meta["EXPTIME"]
+            # multiply by ratio of calibrated spec flux to photom flux
+            thru[ok] = thru0 * columns["SPECFLUX_"+photometric_band][ok] / photflux[ok]
+        columns["THRU_{}".format(c)] = thru
+
+    return Table(columns)
 
 def get_fiber_data(qframes, fmap, f, fiber, night, expid, spectro, stars, qsos):
     '''Returns data needed for snr qa for a *single* fiber.
@@ -1,4 +1,4 @@
-from .base import QA
+from .base import QA, stack_columns
 import glob
 import os
 import collections
@@ -6,7 +6,6 @@ import collections
 import numpy as np
 import fitsio
 
-from astropy.table import Table
 
 import desiutil.log
 from desispec.qproc.io import read_qframe
@@ -22,20 +21,23 @@ class QASpecscore(QA):
         '''PER_AMP QA metrics work for all qframe files'''
         return (obstype.upper() in ["ARC", "FLAT", "SCIENCE", "SKY", "TWILIGHT", "TESTARC", "TESTFLAT"])
 
-    def run(self, indir):
+    per_camera = True
+    uses_data = True
+
+    def run(self, indir, camera=None, data=None):
         '''TODO: document'''
 
         log = desiutil.log.get_logger()
 
         results = list()
 
-        infiles = glob.glob(os.path.join(indir, 'qframe-*.fits'))
+        infiles = glob.glob(os.path.join(indir, 'qframe-{}-*.fits'.format(camera or '*')))
         if len(infiles) == 0 :
             log.error("no qframe in {}".format(indir))
             return None
     
         for filename in infiles:
-            qframe = read_qframe(filename)
+            qframe = data.qframe(filename) if data is not None else read_qframe(filename)
             night = int(qframe.meta['NIGHT'])
             expid = int(qframe.meta['EXPID'])
             cam = qframe.meta['CAMERA'][0].upper()
@@ -48,30 +50,24 @@ class QASpecscore(QA):
             has_calib_frame = False
             cfilename=filename.replace("qframe","qcframe")
             if os.path.isfile(cfilename) : # add scores of calibrated sky-subtracted frame
-                qcframe = read_qframe(cfilename)
+                qcframe = data.qframe(cfilename) if data is not None else read_qframe(cfilename)
                 cscores,comments = compute_frame_scores(qcframe,suffix="CALIB",flux_per_angstrom=True)
                 for k in cscores.keys() :
                     scores[k] = cscores[k]
                 has_calib_frame = True
 
             nfibers=scores['INTEG_RAW_FLUX_'+cam].size
-            for f in range(nfibers) :
-                fiber = int(qframe.fibermap["FIBER"][f])
-                if has_calib_frame :
-                    results.append(collections.OrderedDict(
-                        NIGHT=night, EXPID=expid, SPECTRO=spectro, CAM=cam, FIBER=fiber,
-                        INTEG_RAW_FLUX=scores['INTEG_RAW_FLUX_'+cam][f],
-                        MEDIAN_RAW_FLUX=scores['MEDIAN_RAW_FLUX_'+cam][f],
-                        MEDIAN_RAW_SNR=scores['MEDIAN_RAW_SNR_'+cam][f],
-                        INTEG_CALIB_FLUX=scores['INTEG_CALIB_FLUX_'+cam][f],
-                        MEDIAN_CALIB_FLUX=scores['MEDIAN_CALIB_FLUX_'+cam][f],
-                        MEDIAN_CALIB_SNR=scores['MEDIAN_CALIB_SNR_'+cam][f]))
-                else :
-                    results.append(collections.OrderedDict(
-                        NIGHT=night, EXPID=expid, SPECTRO=spectro, CAM=cam, FIBER=fiber,
-                        INTEG_RAW_FLUX=scores['INTEG_RAW_FLUX_'+cam][f],
-                        MEDIAN_RAW_FLUX=scores['MEDIAN_RAW_FLUX_'+cam][f],
-                        MEDIAN_RAW_SNR=scores['MEDIAN_RAW_SNR_'+cam][f]))
-        if len(results)==0 :
-            return None
-        return Table(results, names=results[0].keys())
+            keys = ['INTEG_RAW_FLUX', 'MEDIAN_RAW_FLUX', 'MEDIAN_RAW_SNR']
+            if has_calib_frame :
+                keys += ['INTEG_CALIB_FLUX', 'MEDIAN_CALIB_FLUX', 'MEDIAN_CALIB_SNR']
+
+            #- one block of columns per camera, straight from the score arrays
+            block = collections.OrderedDict(
+                NIGHT=np.full(nfibers, night), EXPID=np.full(nfibers, expid),
+                SPECTRO=np.full(nfibers, spectro), CAM=np.full(nfibers, cam),
+                FIBER=np.asarray(qframe.fibermap["FIBER"][:nfibers]).astype(int))
+            for key in keys :
+                block[key] = np.asarray(scores[key+'_'+cam])
+            results.append(block)
+
+        return stack_columns(results)
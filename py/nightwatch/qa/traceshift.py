@@ -21,10 +21,13 @@ class QATraceShift(QA):
         # trace shift measured for all exposure except zero and dark
         return (obstype.upper() != "ZERO") and (obstype.upper() != "DARK")
 
-    def run(self, indir):
+    per_camera = True
+    uses_data = True
+
+    def run(self, indir, camera=None, data=None):
         '''TODO: document'''
         log = desiutil.log.get_logger()
-        infiles = glob.glob(os.path.join(indir, 'psf-*.fits'))
+        infiles = glob.glob(os.path.join(indir, 'psf-{}-*.fits'.format(camera or '*')))
         if len(infiles) == 0:
             log.error('No {}/psf*.fits files found'.format(indir))
             return None
@@ -32,7 +35,7 @@ class QATraceShift(QA):
         results = list()
         for filename in infiles:
             log.debug(filename)
-            hdr = fitsio.read_header(filename)
+            hdr = data.header(filename) if data is not None else fitsio.read_header(filename)
             night = hdr['NIGHT']
             expid = hdr['EXPID']
             cam = hdr['CAMERA'][0].upper()
@@ -0,0 +1,139 @@
+'''
+Check that incoming raw data files are completely written before processing
+
+A raw data file is considered ready when
+  * its size and mtime/ctime haven't changed for `settle` seconds,
+  * its size is a whole number of FITS blocks and every HDU in its index
+    ends within the file, and
+  * optional companion files (e.g. coordinates-EXPID.fits) exist.
+
+The stat-based test costs a single os.stat per poll, and the HDU index is
+only read once the file has settled, and only once per size/mtime.
+'''
+
+import os, time
+import glob
+
+import fitsio
+
+import desiutil.log
+
+FITS_BLOCK = 2880
+
+
+def check_hdu_index(rawfile, filesize=None):
+    '''
+    Returns True if rawfile has a complete HDU index
+
+    Args:
+        rawfile : path to FITS file
+
+    Options:
+        filesize : size of rawfile in bytes, to avoid another stat call
+
+    Checks that the file is a whole number of FITS blocks and that the data
+    of every HDU ends within the file.
+    '''
+    if filesize is None:
+        filesize = os.path.getsize(rawfile)
+
+    if filesize == 0 or filesize % FITS_BLOCK != 0:
+        return False
+
+    try:
+        with fitsio.FITS(rawfile) as fx:
+            if len(fx) == 0:
+                return False
+            for hdu in fx:
+                if hdu.get_offsets()['data_end'] > filesize:
+                    return False
+    except (OSError, IOError, ValueError):
+        return False
+
+    return True
+
+
+class ReadinessChecker(object):
+    '''Track incoming raw data files until they are completely written'''
+
+    def __init__(self, settle=5.0, check_hdus=True, companions=None, timeout=600):
+        '''
+        Options:
+            settle : seconds that size/mtime/ctime must be unchanged
+            check_hdus : if True, require a complete HDU index
+            companions : list of filename patterns relative to the exposure
+                directory that must also exist, with {expid} replaced by
+                the 8-digit exposure ID; globs are allowed
+            timeout : seconds after which a file is declared ready anyway,
+                so that truncated data still gets processed (and recorded as
+                failed if it can't be)
+        '''
+        self.settle = settle
+        self.check_hdus = check_hdus
+        self.companions = list() if companions is None else list(companions)
+        self.timeout = timeout
+        self._state = dict()  #- rawfile -> dict of tracking information
+
+    def check(self, rawfile):
+        '''
+        Check whether rawfile is ready to be processed
+
+        Args:
+            rawfile : path to indir/YEARMMDD/EXPID/desi-EXPID.fits.fz
+
+        Returns (ready, reason) where ready is True/False and reason is a
+        string explaining why a file isn't ready (or was declared ready
+        after the timeout), or None
+        '''
+        log = desiutil.log.get_logger()
+        now = time.time()
+
+        try:
+            st = os.stat(rawfile)
+        except OSError:
+            return False, 'missing'
+
+        state = self._state.get(rawfile)
+        if state is None:
+            state = dict(first_seen=now, stat=None, hdus_ok=None)
+            self._state[rawfile] = state
+
+        key = (st.st_size, st.st_mtime, st.st_ctime)
+        if state['stat'] != key:
+            state['stat'] = key
+            state['hdus_ok'] = None
+
+        reason = None
+        age = now - max(st.st_mtime, st.st_ctime)
+        if age < self.settle:
+            reason = 'still being written ({:.0f} sec since last change)'.format(age)
+        elif self.check_hdus:
+            if state['hdus_ok'] is None:
+                state['hdus_ok'] = check_hdu_index(rawfile, filesize=st.st_size)
+            if not state['hdus_ok']:
+                reason = 'incomplete HDU index'
+
+        if reason is None and len(self.companions) > 0:
+            expdir = os.path.dirname(rawfile)
+            expid = os.path.basename(expdir)
+            missing = list()
+            for pattern in self.companions:
+                pattern = os.path.join(expdir, pattern.format(expid=expid))
+                if len(glob.glob(pattern)) == 0:
+                    missing.append(os.path.basename(pattern))
+            if len(missing) > 0:
+                reason = 'missing {}'.format(', '.join(missing))
+
+        if reason is None:
+            return True, None
+
+        if self.timeout is not None and now - state['first_seen'] > self.timeout:
+            reason = 'timed out waiting for completion: ' + reason
+            log.warning('{} {}; processing anyway'.format(rawfile, reason))
+            return True, reason
+
+        return False, reason
+
+    def forget(self, rawfile):
+        '''Stop tracking rawfile, e.g. after it has been dispatched'''
+        self._state.pop(rawfile, None)
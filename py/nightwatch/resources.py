@@ -0,0 +1,383 @@
+'''
+CPU and memory budget for nightwatch worker processes
+
+The number of worker processes is derived from what this process is
+actually allowed to use rather than from the number of CPUs in the node:
+
+  * the CPU affinity mask (taskset, numactl, Slurm task binding),
+  * cgroup v1/v2 CPU quotas and memory limits (containers, Slurm cgroups),
+  * the Slurm allocation (SLURM_CPUS_PER_TASK, SLURM_CPUS_ON_NODE,
+    SLURM_MEM_PER_NODE, SLURM_MEM_PER_CPU), and
+  * a per-task memory estimate plus each worker's calibration cache, so
+    that e.g. 30 workers each holding a full preproc image don't run the
+    node out of memory.
+
+All stages share one pool of that many workers (see nightwatch.workers), so
+the budget is never oversubscribed by concurrent stages; the worker
+environment also limits OpenMP/BLAS threads so that each worker uses one
+core.  Memory used outside the workers, i.e. exposure outputs staged in
+/dev/shm (see nightwatch.staging), is reserved from what the workers leave.
+'''
+
+import os
+import math
+import threading
+
+import desiutil.log
+
+#- default memory estimate per worker task in bytes; preproc holds image,
+#- ivar, and mask for a full CCD plus qproc extraction intermediates
+DEFAULT_TASK_MEMORY = 1.5e9
+
+#- environment variables that limit threads spawned by numerical libraries
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS')
+
+_lock = threading.Lock()
+_budget = None
+
+
+def _read(filename):
+    '''Returns stripped contents of filename, or None if it can't be read'''
+    try:
+        with open(filename) as fx:
+            return fx.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+def affinity_cpus():
+    '''Returns number of CPUs in this process's affinity mask'''
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+def cgroup_cpus(root='/sys/fs/cgroup'):
+    '''
+    Returns CPU limit from the cgroup CPU quota, or None if unlimited
+
+    Options:
+        root : cgroup filesystem mount point
+
+    Rounds fractional quotas up, e.g. a quota of 2.5 CPUs returns 3
+    '''
+    #- cgroup v2: "quota period" or "max period"
+    cpumax = _read(os.path.join(root, 'cpu.max'))
+    if cpumax is not None:
+        fields = cpumax.split()
+        if len(fields) == 2 and fields[0] != 'max':
+            return max(1, math.ceil(int(fields[0]) / int(fields[1])))
+        return None
+
+    #- cgroup v1: quota is -1 if unlimited
+    for subdir in ('cpu', 'cpu,cpuacct', 'cpuacct,cpu'):
+        quota = _read(os.path.join(root, subdir, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(root, subdir, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None:
+            if int(quota) > 0 and int(period) > 0:
+                return max(1, math.ceil(int(quota) / int(period)))
+            return None
+
+    return None
+
+
+def cgroup_memory(root='/sys/fs/cgroup'):
+    '''
+    Returns cgroup memory limit in bytes, or None if unlimited
+
+    Options:
+        root : cgroup filesystem mount point
+    '''
+    memmax = _read(os.path.join(root, 'memory.max'))
+    if memmax is not None:
+        return None if memmax == 'max' else int(memmax)
+
+    limit = _read(os.path.join(root, 'memory', 'memory.limit_in_bytes'))
+    if limit is not None:
+        limit = int(limit)
+        #- v1 reports "unlimited" as a huge page-aligned number
+        if limit < 2**60:
+            return limit
+
+    return None
+
+
+def slurm_cpus(environ=None):
+    '''
+    Returns number of CPUs allocated to this Slurm task, or None if not in
+    a Slurm job
+
+    Options:
+        environ : dict of environment variables; default os.environ
+    '''
+    if environ is None:
+        environ = os.environ
+
+    if 'SLURM_JOB_ID' not in environ and 'SLURM_JOBID' not in environ:
+        return None
+
+    for key in ('SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE'):
+        if key in environ:
+            try:
+                return int(environ[key])
+            except ValueError:
+                pass
+
+    return None
+
+
+def slurm_memory(environ=None):
+    '''
+    Returns memory in bytes allocated to this Slurm job on this node, or
+    None if not in a Slurm job or not specified
+
+    Options:
+        environ : dict of environment variables; default os.environ
+    '''
+    if environ is None:
+        environ = os.environ
+
+    if 'SLURM_JOB_ID' not in environ and 'SLURM_JOBID' not in environ:
+        return None
+
+    MB = 1024**2
+    try:
+        if 'SLURM_MEM_PER_NODE' in environ:
+            return int(environ['SLURM_MEM_PER_NODE']) * MB
+        if 'SLURM_MEM_PER_CPU' in environ:
+            ncpu = slurm_cpus(environ) or 1
+            return int(environ['SLURM_MEM_PER_CPU']) * ncpu * MB
+    except ValueError:
+        pass
+
+    return None
+
+
+def available_memory():
+    '''Returns MemAvailable from /proc/meminfo in bytes, or None'''
+    meminfo = _read('/proc/meminfo')
+    if meminfo is None:
+        return None
+
+    for line in meminfo.split('\n'):
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) * 1024
+
+    return None
+
+
+def threads_per_core():
+    '''Returns number of hardware threads per core, assuming 2 if unknown'''
+    siblings = _read('/sys/devices/system/cpu/cpu0/topology/thread_siblings_list')
+    if siblings is None:
+        return 2
+
+    n = 0
+    for item in siblings.split(','):
+        if '-' in item:
+            lo, hi = item.split('-')
+            n += int(hi) - int(lo) + 1
+        else:
+            n += 1
+
+    return max(1, n)
+
+
+class CPUBudget(object):
+    '''Number of CPUs and bytes of memory available to nightwatch'''
+
+    def __init__(self, ncpu=None, memory=None, task_memory=DEFAULT_TASK_MEMORY,
+                 cache_memory=None, cgroup_root='/sys/fs/cgroup', environ=None):
+        '''
+        Options:
+            ncpu : CPUs available; default derived from affinity, cgroup, and
+                Slurm limits
+            memory : bytes of memory available; default derived from cgroup,
+                Slurm, and /proc/meminfo
+            task_memory : estimated peak memory per worker task in bytes
+            cache_memory : bytes each worker keeps between tasks; default
+                the calibration cache size (see nightwatch.calibcache)
+            cgroup_root, environ : where to look for cgroup and Slurm limits
+        '''
+        if environ is None:
+            environ = os.environ
+
+        self.environ = environ
+        self.limits = dict(affinity=affinity_cpus(),
+                           cgroup=cgroup_cpus(cgroup_root),
+                           slurm=slurm_cpus(environ))
+        if ncpu is None:
+            ncpu = min([n for n in self.limits.values() if n is not None])
+        self.cpus = max(1, ncpu)
+
+        if memory is None:
+            memlimits = [cgroup_memory(cgroup_root), slurm_memory(environ),
+                         available_memory()]
+            memlimits = [m for m in memlimits if m is not None]
+            memory = min(memlimits) if len(memlimits) > 0 else None
+        self.memory = memory
+        self.task_memory = task_memory
+        if cache_memory is None:
+            from . import calibcache
+            cache_memory = calibcache.cache_size() * 1e9
+        self.cache_memory = cache_memory
+
+        #- memory reserved outside the workers, e.g. staged outputs in /dev/shm
+        self.reserved = 0
+        self._reserved_cond = threading.Condition()
+
+    def default_ncpu(self):
+        '''
+        Returns default number of worker processes, i.e. the number of
+        physical cores available, with site-specific adjustments
+        '''
+        restricted = self.cpus < (os.cpu_count() or 1)
+        if restricted:
+            #- allocation is explicitly ours; assume it is what we should use
+            ncpu = self.cpus
+        else:
+            ncpu = max(1, self.cpus // threads_per_core())
+
+        # Attempt to use 30 cores at KPNO.
+        if os.path.exists('/data/dts/exposures'):
+            if 30 < self.cpus:
+                ncpu = 30
+
+        return ncpu
+
+    def memory_slots(self, task_memory=None):
+        '''
+        Returns number of tasks that fit in memory, or None if unknown
+
+        Options:
+            task_memory : bytes per task; default self.task_memory
+        '''
+        if task_memory is None:
+            task_memory = self.task_memory
+        if self.memory is None or task_memory is None or task_memory <= 0:
+            return None
+
+        return max(1, int(self.memory // self.worker_memory(task_memory)))
+
+    def worker_memory(self, task_memory=None):
+        '''
+        Returns estimated peak memory per worker process in bytes: a task
+        plus what the worker keeps between tasks, e.g. its calibration cache
+
+        Options:
+            task_memory : bytes per task; default self.task_memory
+        '''
+        if task_memory is None:
+            task_memory = self.task_memory
+        return task_memory + self.cache_memory
+
+    def ncpu(self, requested=None, task_memory=None):
+        '''
+        Returns number of worker processes to use
+
+        Options:
+            requested : number requested, or None for the default
+            task_memory : bytes per task; default self.task_memory
+
+        The result never exceeds the CPUs available or the number of tasks
+        that fit in memory.
+        '''
+        if requested is None:
+            ncpu = self.default_ncpu()
+        else:
+            ncpu = min(max(1, requested), self.cpus)
+
+        # Throttle to 8 cores on the NERSC login nodes.
+        if ('NERSC_HOST' in self.environ) and ('SLURM_JOBID' not in self.environ) \
+                and ('SLURM_JOB_ID' not in self.environ):
+            ncpu = min(8, ncpu)
+
+        nmem = self.memory_slots(task_memory)
+        if nmem is not None and nmem < ncpu:
+            log = desiutil.log.get_logger()
+            log.debug('Limiting to {} workers to fit {:.1f} GB memory'.format(
+                nmem, self.memory/1e9))
+            ncpu = nmem
+
+        return ncpu
+
+    def reserve(self, nbytes, nworkers):
+        '''
+        Reserve memory used outside the worker processes, e.g. by outputs
+        staged in /dev/shm
+
+        Args:
+            nbytes : bytes to reserve
+            nworkers : number of worker processes, whose tasks use the
+                rest of the memory
+
+        Blocks until nbytes fit in memory next to nworkers tasks and any
+        other reservations; a reservation is always granted when nothing
+        else is reserved, so that one large request can't wait forever.
+        Returns the bytes reserved (0 if memory is unknown), to be passed
+        to `release` when no longer used.
+        '''
+        if self.memory is None or nbytes <= 0:
+            return 0
+
+        available = self.memory - nworkers * self.worker_memory()
+        with self._reserved_cond:
+            if self.reserved > 0 and self.reserved + nbytes > available:
+                log = desiutil.log.get_logger()
+                log.info('Waiting for {:.1f} GB of memory; {:.1f} GB already reserved'.format(
+                    nbytes/1e9, self.reserved/1e9))
+            while self.reserved > 0 and self.reserved + nbytes > available:
+                self._reserved_cond.wait()
+            self.reserved += nbytes
+
+        return nbytes
+
+    def release(self, nbytes):
+        '''Release memory reserved with `reserve`'''
+        with self._reserved_cond:
+            self.reserved = max(0, self.reserved - nbytes)
+            self._reserved_cond.notify_all()
+
+    def worker_environ(self):
+        '''
+        Returns dict of environment variables for worker processes, limiting
+        numerical libraries to one thread per worker unless already set
+        '''
+        env = dict()
+        for key in THREAD_ENV_VARS:
+            if key not in self.environ:
+                env[key] = '1'
+        return env
+
+    def __repr__(self):
+        if self.memory is None:
+            mem = 'unknown'
+        else:
+            mem = '{:.1f} GB'.format(self.memory/1e9)
+        return 'CPUBudget(cpus={}, memory={}, task_memory={:.1f} GB, cache_memory={:.1f} GB)'.format(
+            self.cpus, mem, self.task_memory/1e9, self.cache_memory/1e9)
+
+
+def configure(ncpu=None, memory=None, task_memory=DEFAULT_TASK_MEMORY, cache_memory=None):
+    '''
+    Replace the process-wide CPUBudget returned by `get_budget`
+
+    Options:
+        ncpu, memory, task_memory, cache_memory : see CPUBudget
+    '''
+    global _budget
+    with _lock:
+        _budget = CPUBudget(ncpu=ncpu, memory=memory, task_memory=task_memory,
+                            cache_memory=cache_memory)
+    return _budget
+
+
+def get_budget():
+    '''Returns the process-wide CPUBudget, creating it if needed'''
+    global _budget
+    with _lock:
+        if _budget is None:
+            _budget = CPUBudget()
+        return _budget
@@ -1,7 +1,9 @@
 from copy import deepcopy
 import os, re, time
 import sys
-import multiprocessing as mp
+import signal
+import threading
+import contextlib
 import subprocess
 import time
 import glob
@@ -20,8 +22,11 @@ import desiutil.log
 import desispec.scripts.preproc
 from nightwatch.qa.base import QA
 
+from . import workers, resources, timing, calibcache
+from .timing import timed
+from .manifest import DONE, FAILED
 from .thresholds import write_threshold_json, get_outdir
-from .io import get_night_expid_header
+from .io import get_night_expid_header, get_raw_exposure
 from nightwatch.threshold_files.calcnominalnoise import calcnominalnoise
 
 
@@ -31,7 +36,8 @@ def timestamp():
 
 def get_ncpu(ncpu):
     """
-    Get number of CPU cores to use, throttling to 8 for NERSC login nodes.
+    Get number of CPU cores to use, within the CPU and memory budget of
+    this process; see nightwatch.resources.CPUBudget
 
     Args:
         ncpu : number you would like to use, or None to auto-derive
@@ -39,28 +45,30 @@ def get_ncpu(ncpu):
     Returns:
         number of CPU cores to use
     """
-    if ncpu is None:
-        ncpu = max(1, mp.cpu_count()//2)  #- no hyperthreading
-    else:
-        ncpu = min(max(1, ncpu), mp.cpu_count()//2)
+    return resources.get_budget().ncpu(ncpu)
+
 
-    # Throttle to 8 cores on the NERSC login nodes.
-    if ('NERSC_HOST' in os.environ) and ('SLURM_JOBID' not in os.environ):
-        ncpu = min(8, ncpu)
+def _noraw_changed(nightdir, indexed):
+    '''
+    Returns True if any expdir in nightdir that was indexed without raw
+    data (NORAW) has changed since, e.g. because its raw file arrived
+
+    Args:
+        nightdir : datadir/YEARMMDD
+        indexed : dict of expid -> (status, mtime) from ExposureIndex.get_night
+    '''
+    from . import index as nwindex
 
-    # Attempt to use 30 cores at KPNO.
-#    if 'HOSTNAME' in os.environ:
-#        if 'desi-7' == os.environ['HOSTNAME']:
-#            if 30 < mp.cpu_count():
-#                ncpu = min(30, mp.cpu_count())
-    if os.path.exists('/data/dts/exposures'):
-        if 30 < mp.cpu_count():
-            ncpu = min(30, mp.cpu_count())
+    for expid, (status, mtime) in indexed.items():
+        if status == nwindex.NORAW:
+            expdir = os.path.join(nightdir, '{:08d}'.format(expid))
+            if os.path.isdir(expdir) and os.path.getmtime(expdir) != mtime:
+                return True
 
-    return ncpu
+    return False
 
 
-def find_unprocessed_expdir(datadir, outdir, processed, startdate=None):
+def find_unprocessed_expdir(datadir, outdir, processed, startdate=None, index=None):
     '''
     Returns the earliest outdir/YEARMMDD/EXPID that has not yet been processed
     in outdir/YEARMMDD/EXPID.
@@ -70,33 +78,73 @@ def find_unprocessed_expdir(datadir, outdir, processed, startdate=None):
         outdir : directory of processed nights data
     Options:
         startdate : the earliest night to consider processing YYYYMMDD
+        index : nightwatch.index.ExposureIndex of previously processed data
 
     Returns directory, of None if no unprocessed directories were found
     (either because no inputs exist, or because all inputs have been processed)
 
-    Warning: traverses the whole tree every time.
-    TODO: cache previously identified already-processed data and don't rescan.
+    Warning: without an index, traverses the whole tree every time.  With an
+    index, nights whose directory and expdirs without raw data haven't
+    changed since they were fully indexed are skipped, and indexed exposures
+    aren't checked again.
     '''
+    from . import index as nwindex
+
     if startdate:
         startdate = str(startdate)
     else:
         startdate = ''
-    all_nights = sorted(os.listdir(datadir))
+    all_nights = [n for n in sorted(os.listdir(datadir))
+                  if re.match(r'20\d{6}', n) and n >= startdate]
     #- Search for the earliest unprocessed datadir/YYYYMMDD
     for night in all_nights:
         nightdir = os.path.join(datadir, night)
-        if re.match(r'20\d{6}', night) and os.path.isdir(nightdir) and \
-                night >= startdate:
-            for expid in sorted(os.listdir(nightdir)):
-                expdir = os.path.join(nightdir, expid)
-                if re.match(r'\d{8}', expid) and os.path.isdir(expdir):
-                    fits_fz_exists = np.any([re.match(r'desi-\d{8}.fits.fz', file) for file in os.listdir(expdir)])
-                    if fits_fz_exists:
-                        qafile = os.path.join(outdir, night, expid, f'qa-{expid}.fits')
-                        if (not os.path.exists(qafile)) and (expdir not in processed):
-                            return expdir
+        if not os.path.isdir(nightdir):
+            continue
+
+        #- raw files can still arrive in existing expdirs, which doesn't
+        #- update the night directory mtime, so always check the latest
+        #- night, and the expdirs without raw data in the other nights
+        if index is not None:
+            night_mtime = os.path.getmtime(nightdir)
+            indexed = index.get_night(night)
+            if night != all_nights[-1] and index.night_mtime(night) == night_mtime \
+                    and not _noraw_changed(nightdir, indexed):
+                continue
+        else:
+            indexed = dict()
+
+        night_complete = True
+        for expid in sorted(os.listdir(nightdir)):
+            expdir = os.path.join(nightdir, expid)
+            if re.match(r'\d{8}', expid) and os.path.isdir(expdir):
+                entry = indexed.get(int(expid))
+                if entry is not None:
+                    status, mtime = entry
+                    if status == nwindex.NORAW:
+                        if os.path.getmtime(expdir) == mtime:
+                            continue
+                    elif nwindex.entry_is_done(entry, os.path.join(expdir, f'desi-{expid}.fits.fz')):
+                        continue
+
+                fits_fz_exists = np.any([re.match(r'desi-\d{8}.fits.fz', file) for file in os.listdir(expdir)])
+                if fits_fz_exists:
+                    qafile = os.path.join(outdir, night, expid, f'qa-{expid}.fits')
+                    if os.path.exists(qafile):
+                        if index is not None:
+                            index.record(night, expid, nwindex.PROCESSED)
+                    elif expdir not in processed:
+                        return expdir
                     else:
-                        print(f'Skipping {night}/{expid} with no desi*.fits.fz data')
+                        night_complete = False
+                else:
+                    print(f'Skipping {night}/{expid} with no desi*.fits.fz data')
+                    if index is not None:
+                        index.record(night, expid, nwindex.NORAW,
+                                     mtime=os.path.getmtime(expdir))
+
+        if index is not None and night_complete:
+            index.set_night_mtime(night, night_mtime)
 
     return None
 
@@ -116,6 +164,28 @@ def find_latest_expdir(basedir, processed, startdate=None):
     Note: if you want the first unprocessed directory, use
     `find_unprocessed_expdir` instead
     '''
+    log = desiutil.log.get_logger(level='DEBUG')
+    expdirs = find_latest_expdirs(basedir, processed, startdate=startdate)
+    if len(expdirs) > 0:
+        log.debug('{} selected {}'.format(timestamp(), expdirs[0]))
+        return expdirs[0]
+    else:
+        return None
+
+
+def find_latest_expdirs(basedir, processed, startdate=None):
+    '''
+    finds all unprocessed basedir/YEARMMDD/EXPID from the latest YEARMMDD
+    without traversing the whole tree
+    Args:
+        basedir : a directory of nights with exposures
+        processed : set of exposure directories already processed
+    Options:
+        startdate : the earliest night to consider processing YYYYMMDD
+
+    Returns sorted list of directories, which is empty if no matching
+    directories are found
+    '''
     if startdate:
         startdate = str(startdate)
     else:
@@ -133,7 +203,7 @@ def find_latest_expdir(basedir, processed, startdate=None):
     #- if for loop completes without finding nightdir to break, run this else
     else:
         log.debug(f'No YEARMMDD dirs found in {basedir}')
-        return None
+        return list()
 
     night = dirname
     log.debug(f'{timestamp()} Looking for exposures in {nightdir}')
@@ -145,33 +215,82 @@ def find_latest_expdir(basedir, processed, startdate=None):
             os.path.basename(spectrofiles[-1])))
     else:
         log.debug('{} no new spectro files yet'.format(timestamp()))
-        return None
+        return list()
 
+    expdirs = list()
     for filename in spectrofiles:
         dirname = os.path.dirname(filename)
-        if dirname not in processed:
-            log.debug('{} selected {}'.format(timestamp(), filename))
-            return dirname
-    else:
+        if dirname not in processed and dirname not in expdirs:
+            expdirs.append(dirname)
+
+    if len(expdirs) == 0:
         log.debug('{} no new spectro files found'.format(timestamp()))
-        return None
+
+    return expdirs
 
 
 def which_cameras(rawfile):
     '''
-    Returns list of cameras found in rawfile
+    Returns list of cameras found in rawfile (path or RawExposure)
     '''
-    cameras = list()
-    with fitsio.FITS(rawfile) as fx:
-        for hdu in fx:
-            extname = hdu.get_extname().upper()
-            if re.match('[BRZ][0-9]', extname):
-                cameras.append(extname.lower())
+    return list(get_raw_exposure(rawfile).cameras)
 
-    return sorted(cameras)
 
+#- error code of a command killed after its timeout, like coreutils timeout
+TIMEOUT_ERRORCODE = 124
 
-def runcmd(command, logfile, msg, env=dict(os.environ)):
+#- error code for a camera whose pool worker died, e.g. in a segfault or
+#- from the OOM killer; like a shell reports a process killed by SIGKILL
+WORKER_LOST_ERRORCODE = 137
+
+#- errorcodes file key mapping logfile -> why that camera was dropped
+DROPPED_KEY = 'dropped'
+
+#- seconds past the qproc timeout before the parent kills a pool worker
+#- whose qproc didn't stop at its own deadline, e.g. stuck in C code
+QPROC_KILL_GRACE = 10
+
+
+class QprocTimeout(BaseException):
+    '''
+    Raised within in-process qproc when it passes its deadline
+
+    Derived from BaseException like KeyboardInterrupt, so that it isn't
+    caught by the `except Exception` handlers within qproc; it should only
+    be caught where the camera is given up, i.e. in `run_qproc_camera`.
+    '''
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    '''
+    Context manager raising QprocTimeout if the enclosed block runs longer
+    than `seconds`
+
+    Uses SIGALRM, so it only applies in the main thread, e.g. of a pool
+    worker; elsewhere, or if seconds is None, the block runs without one.
+    The signal handler only runs between Python bytecodes, so code blocked
+    in a C extension isn't interrupted; `run_qproc` therefore also has the
+    parent kill a pool worker that passes its deadline.
+    '''
+    if seconds is None or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _timeout(signum, frame):
+        raise QprocTimeout('Timeout after {:.0f} sec'.format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, _timeout)
+    signal.setitimer(signal.ITIMER_REAL, max(seconds, 0.001))
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def runcmd(command, logfile, msg, env=dict(os.environ), timeout=None):
     '''Runs a given command and writes a logfile, returns a SUCCESS or ERROR message.
 
     Args:
@@ -179,6 +298,8 @@ def runcmd(command, logfile, msg, env=dict(os.environ)):
         logfile: path to file where logs should be written (string)
         msg: name of the process (str)
         env: dictionary of environment variables. Default is current environment.
+        timeout: kill the command after this many seconds, returning
+            TIMEOUT_ERRORCODE. Default no timeout.
 
     Returns:
         dictionary of error codes: {logfile: returncode}. Prints status messages to the console
@@ -189,7 +310,15 @@ def runcmd(command, logfile, msg, env=dict(os.environ)):
         t0 = time.time()
         print('Starting at {}'.format(time.asctime()), file=logfx)
         print('RUNNING {}'.format(command), file=logfx)
-        err = subprocess.call(args, stdout=logfx, stderr=logfx, env=env)
+        logfx.flush()
+        proc = subprocess.Popen(args, stdout=logfx, stderr=logfx, env=env)
+        try:
+            err = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            print('KILLED after {:.0f} sec timeout'.format(timeout), file=logfx)
+            err = TIMEOUT_ERRORCODE
         dt = time.time() - t0
         print('Done at {} ({:0f} sec)'.format(time.asctime(), dt), file=logfx)
 
@@ -202,23 +331,180 @@ def runcmd(command, logfile, msg, env=dict(os.environ)):
     return {os.path.basename(logfile):err}
 
 
+@contextlib.contextmanager
+def redirect_output(logfx):
+    '''
+    Context manager to redirect this process's stdout and stderr to logfx
+
+    Args:
+        logfx: open file object
+
+    Redirects at the file descriptor level so that output from C extensions
+    and from loggers holding a reference to sys.stderr is captured too.
+    This affects every thread of the process, so only use it in processes
+    that aren't doing anything else, e.g. pool workers.
+    '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    logfx.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    try:
+        os.dup2(logfx.fileno(), 1)
+        os.dup2(logfx.fileno(), 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+
+
+def run_qproc_camera(options, logfile, msg, timeout=None):
+    '''Runs qproc in this process and writes a logfile, returns a SUCCESS or ERROR message.
+
+    Args:
+        options: list of desi_qproc command line options
+        logfile: path to file where logs should be written (string)
+        msg: name of the process (str)
+        timeout: interrupt qproc after this many seconds, returning
+            TIMEOUT_ERRORCODE; only applies in the main thread (see `deadline`)
+
+    Returns:
+        dictionary of error codes: {logfile: returncode}, like `runcmd`
+    '''
+    print('Logging {} to {}'.format(msg, logfile))
+    cache = calibcache.install()
+    with open(logfile, 'w') as logfx:
+        t0 = time.time()
+        print('Starting at {}'.format(time.asctime()), file=logfx)
+        print('RUNNING desi_qproc {} (in process {})'.format(' '.join(options), os.getpid()), file=logfx)
+        with redirect_output(logfx):
+            try:
+                import desispec.scripts.qproc
+                with deadline(timeout):
+                    err = desispec.scripts.qproc.main(desispec.scripts.qproc.parse(options))
+                err = 0 if err is None else int(err)
+            except QprocTimeout as e:
+                print('KILLED: {}'.format(e), file=sys.stderr)
+                err = TIMEOUT_ERRORCODE
+            except SystemExit as e:
+                if e.code is None:
+                    err = 0
+                elif isinstance(e.code, int):
+                    err = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    err = 1
+            except Exception:
+                traceback.print_exc()
+                err = 1
+        dt = time.time() - t0
+        if cache is not None:
+            print('Using {}'.format(cache), file=logfx)
+        print('Done at {} ({:0f} sec)'.format(time.asctime(), dt), file=logfx)
+
+    if err == 0:
+        print('SUCCESS {}'.format(msg))
+    if err != 0:
+        print('ERROR {} while running {}'.format(err, msg))
+        print('See {}'.format(logfile))
+
+    return {os.path.basename(logfile):err}
+
+
+def run_preproc_camera(args):
+    '''Runs desispec preproc with args in this process, with cached calibrations'''
+    calibcache.install()
+    return desispec.scripts.preproc.main(args)
+
+
+def run_qproc_task(mode, options, logfile, msg, outdir, camera, camera_qa=None, timeout=None):
+    '''Runs qproc for one camera, followed by per-camera QA if requested
+
+    Args:
+        mode: 'inprocess' or 'subprocess', see `run_qproc`
+        options: list of desi_qproc command line options
+        logfile: path to file where logs should be written (string)
+        msg: name of the process (str)
+        outdir: directory with qproc outputs
+        camera: camera being processed, e.g. b0
+
+    Options:
+        camera_qa: function(outdir, camera) to run right after qproc
+        timeout: kill qproc after this many seconds
+
+    Returns (camera, {logfile: returncode}, camera_qa results or None,
+    list of timing records for qproc and camera_qa)
+    '''
+    timings = list()
+    with timing.measure() as usage:
+        if mode == 'inprocess':
+            err = run_qproc_camera(options, logfile, msg, timeout=timeout)
+        else:
+            err = runcmd('desi_qproc ' + ' '.join(options), logfile, msg, timeout=timeout)
+    errcode = list(err.values())[0]
+    timings.append(dict(stage='qproc', name=camera, ok=errcode == 0, **usage))
+    workers.end_deadline()
+
+    #- a killed qproc leaves partial outputs that aren't worth QA
+    qa_results = None
+    if camera_qa is not None and errcode != TIMEOUT_ERRORCODE:
+        with timing.measure() as usage:
+            try:
+                qa_results = camera_qa(outdir, camera)
+            except Exception as e:
+                log = desiutil.log.get_logger()
+                log.warning('Per-camera QA failed for {}: {}'.format(camera, e))
+        timings.append(dict(stage='camera_qa', name=camera, ok=qa_results is not None, **usage))
+
+    return camera, err, qa_results, timings
+
+
+def _lost_qproc_task(args, err):
+    '''
+    Returns run_qproc_task result for a camera whose pool worker died
+
+    Args:
+        args : arguments of run_qproc_task
+        err : workers.TaskTimeout if the worker was killed after the qproc
+            timeout, otherwise BrokenProcessPool
+    '''
+    logfile, msg, camera = args[2], args[3], args[5]
+    if isinstance(err, workers.TaskTimeout):
+        errcode = TIMEOUT_ERRORCODE
+        reason = str(err)
+    else:
+        errcode = WORKER_LOST_ERRORCODE
+        reason = 'worker process died: {}'.format(err)
+    print('ERROR {} while running {}'.format(reason, msg))
+    print('See {}'.format(logfile))
+    with open(logfile, 'a') as logfx:
+        print('KILLED: {}'.format(reason), file=logfx)
+
+    return camera, {os.path.basename(logfile): errcode}, None, list()
+
+
 def run_assemble_fibermap(rawfile, outdir):
     '''Run assemble_fibermap using NIGHT, EXPID, and TILE from input raw data file
 
     Args:
-        rawfile: input desi-EXPID.fits.fz raw data file
+        rawfile: input desi-EXPID.fits.fz raw data file, or its RawExposure
         outdir: directory to write fibermap-EXPID.fits files
 
     Returns:
         path to written fibermap
     '''
-    hdr = fitsio.read_header(rawfile, 1)
-    night, expid = get_night_expid_header(hdr)
+    raw = get_raw_exposure(rawfile)
+    rawfile = raw.filename
+    night, expid = get_night_expid_header(raw.headers[1])
 
     log = desiutil.log.get_logger()
     log.info(f'Running assemble_fibermap on {rawfile}')
 
-    if 'TILEID' in hdr:
+    if 'TILEID' in raw.headers[1]:
 
         if not os.path.isdir(outdir):
             log.info('Creating {}'.format(outdir))
@@ -245,7 +531,7 @@ def run_preproc(rawfile, outdir, fibermap=None, ncpu=None, cameras=None):
     '''Runs preproc on the input raw data file, outputting to outdir
 
     Args:
-        rawfile: input desi-EXPID.fits.fz raw data file
+        rawfile: input desi-EXPID.fits.fz raw data file, or its RawExposure
         outdir: directory to write preproc-CAM-EXPID.fits files
 
     Options:
@@ -255,9 +541,11 @@ def run_preproc(rawfile, outdir, fibermap=None, ncpu=None, cameras=None):
 
     Returns header of HDU 0 of the input raw data file
     '''
-    if not os.path.exists(rawfile):
+    if isinstance(rawfile, str) and not os.path.exists(rawfile):
         raise ValueError("{} doesn't exist".format(rawfile))
 
+    raw = get_raw_exposure(rawfile)
+    rawfile = raw.filename
     log = desiutil.log.get_logger()
 
     if not os.path.isdir(outdir):
@@ -265,9 +553,9 @@ def run_preproc(rawfile, outdir, fibermap=None, ncpu=None, cameras=None):
         os.makedirs(outdir, exist_ok=True)
 
     if cameras is None:
-        cameras = which_cameras(rawfile)
+        cameras = which_cameras(raw)
 
-    header = fitsio.read_header(rawfile, 0)
+    header = raw.primary_header
 
     arglist = list()
 
@@ -280,29 +568,55 @@ def run_preproc(rawfile, outdir, fibermap=None, ncpu=None, cameras=None):
     if ncpu > 1:
         log.info('Running preproc in parallel on {} cores for {} cameras'.format(
             ncpu, len(cameras) ))
-        pool = mp.Pool(ncpu)
-        pool.map(desispec.scripts.preproc.main, arglist)
-        pool.close()
-        pool.join()
     else:
         log.info('Running preproc serially for {} cameras'.format(len(cameras)))
-        for args in arglist:
-            desispec.scripts.preproc.main(args)
+
+    workers.starmap(run_preproc_camera, [(args,) for args in arglist], ncpu=ncpu)
 
     return header
 
 
-def run_qproc(rawfile, outdir, ncpu=None, cameras=None):
+QPROC_MODES = ('inprocess', 'subprocess')
+
+def run_qproc(rawfile, outdir, ncpu=None, cameras=None, mode='inprocess',
+              camera_qa=None, on_camera=None, manifest=None, timer=None,
+              timeout=None, retries=0):
     '''
     Determine the obstype of the rawfile, and run qproc with appropriate options
 
     Args:
-        rawfile: input desi-EXPID.fits.fz raw data file
+        rawfile: input desi-EXPID.fits.fz raw data file, or its RawExposure
         outdir: directory to write qproc-CAM-EXPID.fits files
 
     Options:
         ncpu: number of CPU cores to use for parallelism; serial if ncpu<=1
         cameras: list of cameras to process; default all found in rawfile
+        mode: 'inprocess' to call qproc directly in the shared worker
+            processes, or 'subprocess' to run a desi_qproc command per camera.
+            inprocess falls back to subprocess when it would have to run in
+            a process with other active threads.
+        camera_qa: picklable function(outdir, camera) run in the same worker
+            as soon as qproc for that camera finishes, e.g. QARunner.camera_qa
+        on_camera: function(camera, errorcode, camera_qa_results) called in
+            this process as each camera finishes
+        manifest: ExposureManifest; if given, skip cameras whose qproc
+            inputs and outputs haven't changed since they last succeeded
+        timer: ExposureTimer to record the time of each camera
+        timeout: kill qproc for a camera after this many seconds
+        retries: number of times to rerun a camera that timed out, once the
+            other cameras have finished and freed their cores
+
+    Cameras that still time out are dropped: the exposure continues with
+    the cameras that finished, and the errorcodes file records
+    TIMEOUT_ERRORCODE for them plus the reason under DROPPED_KEY.
+    In-process qproc that doesn't stop at its deadline within
+    QPROC_KILL_GRACE seconds, e.g. because it is blocked in C code, has its
+    pool worker killed by this process and counts as timed out.
+
+    If a pool worker dies, the cameras it took down (possibly including
+    cameras in other workers) are rerun as subprocesses, which contain a
+    crash; cameras still lost after that are recorded with
+    WORKER_LOST_ERRORCODE and dropped the same way.
 
     Returns header of HDU 0 of the input raw data file, plus dictionary of return codes for each qproc process run.
     '''
@@ -311,24 +625,18 @@ def run_qproc(rawfile, outdir, ncpu=None, cameras=None):
         log.info('Creating {}'.format(outdir))
         os.makedirs(outdir, exist_ok=True)
 
-    hdr = fitsio.read_header(rawfile, 0)
-    if ( 'OBSTYPE' not in hdr ) and ( 'FLAVOR' not in hdr ) :
-        log.warning("no obstype nor flavor keyword in first hdu header, moving to the next one")
-        try:
-            hdr = fitsio.read_header(rawfile, 1)
-        except OSError as err:
-            log.error("fitsio error reading HDU 1, trying 2 then giving up")
-            hdr = fitsio.read_header(rawfile, 2)
-    try :
-        if 'OBSTYPE' in hdr :
-            obstype = hdr['OBSTYPE'].rstrip().upper()
-        else :
-            log.warning('Use FLAVOR instead of missing OBSTYPE')
-            obstype = hdr['FLAVOR'].rstrip().upper()
-        night, expid = get_night_expid_header(hdr)
-    except KeyError as e :
-        log.error(str(e))
-        raise(e)
+    #- headers and cameras are read once and shared with the other stages
+    raw = get_raw_exposure(rawfile)
+    rawfile = raw.filename
+    hdr = raw.header
+    if raw.obstype is None:
+        msg = 'No OBSTYPE or FLAVOR keyword in {} HDUs 0-2'.format(rawfile)
+        log.error(msg)
+        raise KeyError(msg)
+    elif 'OBSTYPE' not in hdr:
+        log.warning('Use FLAVOR instead of missing OBSTYPE')
+    obstype = raw.obstype
+    night, expid = get_night_expid_header(hdr)
 
     #- copy coordfile to new folder for pos accuracy
     indir = os.path.abspath(os.path.dirname(rawfile))
@@ -353,16 +661,21 @@ def run_qproc(rawfile, outdir, ncpu=None, cameras=None):
         else:
             raise RuntimeError('Unable to derive NIGHT for {}'.format(rawfile))
 
+    if mode not in QPROC_MODES:
+        raise ValueError('Unknown qproc mode {}; expected one of {}'.format(mode, QPROC_MODES))
+
     cmdlist = list()
     loglist = list()
     msglist = list()
-    rawcameras = which_cameras(rawfile)
+    dropped = dict()
+    rawcameras = which_cameras(raw)
     if cameras is None :
         cameras = rawcameras
     elif len(set(cameras) - set(rawcameras)) > 0:
         missing_cameras = set(cameras) - set(rawcameras)
         for cam in sorted(missing_cameras):
             log.error('{} missing camera {}'.format(os.path.basename(rawfile), cam))
+            dropped['qproc-{}-{:08d}.log'.format(cam, expid)] = 'camera not in raw data'
         cameras = sorted(set(cameras) & set(rawcameras))
 
 
@@ -376,42 +689,136 @@ def run_qproc(rawfile, outdir, ncpu=None, cameras=None):
         )
 
         # Set up the qproc command call.
-        cmd = "desi_qproc -i {rawfile} --fibermap {fibermap} --auto --auto-output-dir {outdir} --cam {camera} --fallback-on-dark-not-found".format(**outfiles)
-        cmdlist.append(cmd)
+        cmd = "-i {rawfile} --fibermap {fibermap} --auto --auto-output-dir {outdir} --cam {camera} --fallback-on-dark-not-found".format(**outfiles)
+        cmdlist.append(cmd.split())
 
         # Set up qproc logging.
         loglist.append(outfiles['logfile'])
         msglist.append('qproc {}/{} {}'.format(night, expid, camera))
 
+    jsonfile = '{}/errorcodes-{:08d}.txt'.format(outdir, expid)
+    errorcodes = dict()
+    inputs = [rawfile, '{}/fibermap-{:08d}.fits'.format(outdir, expid)]
+    if manifest is not None:
+        #- only rerun qproc for cameras that are stale or failed
+        if os.path.exists(jsonfile):
+            with open(jsonfile) as fx:
+                previous_errorcodes = json.load(fx)
+        else:
+            previous_errorcodes = dict()
+
+        todo = [i for i, camera in enumerate(cameras)
+                if not manifest.is_current('qproc-'+camera, inputs)]
+        for i in sorted(set(range(len(cameras))) - set(todo)):
+            logname = os.path.basename(loglist[i])
+            errorcodes[logname] = previous_errorcodes.get(logname, 0)
+
+        if len(todo) < len(cameras):
+            log.info('Skipping qproc for {} cameras unchanged since {}'.format(
+                len(cameras)-len(todo), os.path.basename(manifest.filename)))
+
+        cmdlist = [cmdlist[i] for i in todo]
+        loglist = [loglist[i] for i in todo]
+        msglist = [msglist[i] for i in todo]
+        cameras = [cameras[i] for i in todo]
+
     ncpu = min(len(cmdlist), get_ncpu(ncpu))
 
+    #- in-process qproc redirects stdout/stderr of the whole process to the
+    #- camera logfile, which is only safe without other threads printing
+    if mode == 'inprocess' and not (workers.parallel(len(cmdlist), ncpu) or
+            workers.in_worker() or threading.active_count() == 1):
+        log.info('Running qproc as subprocesses since this process has other active threads')
+        mode = 'subprocess'
+
     if ncpu > 1 and len(cameras)>1 :
-        log.info('Running qproc in parallel on {} cores for {} cameras'.format(ncpu, len(cameras) ))
-        pool = mp.Pool(ncpu)
-        errs = pool.starmap(runcmd, zip(cmdlist, loglist, msglist))
-        pool.close()
-        pool.join()
+        log.info('Running qproc {} in parallel on {} cores for {} cameras'.format(mode, ncpu, len(cameras) ))
+    else:
+        log.info('Running qproc {} serially for {} cameras'.format(mode, len(cameras)))
+
+    if timeout is not None:
+        log.info('qproc {} timeout {:.0f} sec per camera'.format(obstype, timeout))
+
+    argslist = [(mode, options, logfile, msg, outdir, camera, camera_qa, timeout)
+                for options, logfile, msg, camera in zip(cmdlist, loglist, msglist, cameras)]
+
+    if timeout is None:
+        kill_timeout = None
     else:
-        errs = []
-        log.info('Running qproc serially for {} cameras'.format(len(cameras)))
-        for cmd, logfile, msg in zip(cmdlist, loglist, msglist):
-            err = runcmd(cmd, logfile, msg)
+        kill_timeout = timeout + QPROC_KILL_GRACE
+
+    errs = list()
+    attempt = 0
+    while len(argslist) > 0:
+        #- run cameras that timed out again, after the others are done
+        taskargs = {args[5]: args for args in argslist}
+        argslist = list()
+        if attempt > 0:
+            log.warning('Retrying qproc for timed out or lost cameras {} (retry {})'.format(
+                ','.join(sorted(taskargs.keys())), attempt))
+
+        for camera, err, qa_results, timings in workers.imap_unordered(
+                run_qproc_task, taskargs.values(), ncpu=ncpu,
+                on_error=_lost_qproc_task, timeout=kill_timeout):
+            if timer is not None:
+                timer.extend(timings)
+            errcode = list(err.values())[0]
+            logname = list(err.keys())[0]
+            if errcode == TIMEOUT_ERRORCODE:
+                if attempt < retries:
+                    #- retry as a subprocess, which can be killed from any thread
+                    argslist.append(('subprocess',) + taskargs[camera][1:])
+                    continue
+                dropped[logname] = 'qproc timed out after {:.0f} sec ({} attempts)'.format(
+                    timeout, attempt+1)
+                log.error('Dropping camera {} from {}/{}: {}'.format(
+                    camera, night, expid, dropped[logname]))
+            elif errcode == WORKER_LOST_ERRORCODE:
+                #- the worker may have died because of another camera; rerun
+                #- at least once, as a subprocess
+                if attempt <= retries:
+                    argslist.append(('subprocess',) + taskargs[camera][1:])
+                    continue
+                dropped[logname] = 'qproc worker process died ({} attempts)'.format(attempt+1)
+                log.error('Dropping camera {} from {}/{}: {}'.format(
+                    camera, night, expid, dropped[logname]))
+
+            _qproc_done(camera, err, qa_results, outdir, expid, inputs, manifest, on_camera)
             errs.append(err)
 
-    errorcodes = dict()
+        attempt += 1
+
     for err in errs:
         for key in err.keys():
             errorcodes[key] = err[key]
+    if len(dropped) > 0:
+        errorcodes[DROPPED_KEY] = dropped
 
-    jsonfile = '{}/errorcodes-{:08d}.txt'.format(outdir, expid)
-    with open(jsonfile, 'w') as outfile:
-        json.dump(errorcodes, outfile)
-        print('Wrote {}'.format(jsonfile))
+    #- leave an unchanged errorcodes file alone so that downstream QA
+    #- isn't considered stale by the manifest
+    if manifest is not None and errorcodes == previous_errorcodes:
+        log.info('{} unchanged'.format(jsonfile))
+    else:
+        with open(jsonfile, 'w') as outfile:
+            json.dump(errorcodes, outfile)
+            print('Wrote {}'.format(jsonfile))
 
     return hdr
 
 
-def run_qa(indir, outfile=None, qalist=None):
+def _qproc_done(camera, err, qa_results, outdir, expid, inputs, manifest, on_camera):
+    '''Record a finished qproc camera in the manifest and pass it on'''
+    errcode = list(err.values())[0]
+    if manifest is not None:
+        logfile = '{}/qproc-{}-{:08d}.log'.format(outdir, camera, expid)
+        outputs = glob.glob('{}/*-{}-{:08d}.fits'.format(outdir, camera, expid)) + [logfile,]
+        manifest.record('qproc-'+camera, inputs, outputs,
+                        status=DONE if errcode == 0 else FAILED)
+    if on_camera is not None:
+        on_camera(camera, errcode, qa_results)
+
+
+def run_qa(indir, outfile=None, qalist=None, concurrency=1):
     """
     Run QA analysis of qproc files in indir, writing output to outfile
 
@@ -421,15 +828,17 @@ def run_qa(indir, outfile=None, qalist=None):
     Options:
         outfile: write QA output to this FITS file
         qalist: list of QA objects to include; default QARunner.qalist
+        concurrency: max number of QA classes to run at once
 
     Returns dictionary of QA results, keyed by PER_AMP, PER_CCD, PER_FIBER, ...
     """
     from .qa.runner import QARunner
-    qarunner = QARunner(qalist)
+    qarunner = QARunner(qalist, concurrency=concurrency)
     return qarunner.run(indir, outfile=outfile)
 
 
-def make_plots(infile, basedir, preprocdir=None, logdir=None, rawdir=None, cameras=None):
+def make_plots(infile, basedir, preprocdir=None, logdir=None, rawdir=None, cameras=None,
+               timer=None):
     '''Make plots for a single exposure
 
     Args:
@@ -448,6 +857,7 @@ def make_plots(infile, basedir, preprocdir=None, logdir=None, rawdir=None, camer
         cameras: list of cameras (strings) to generate image files of. If not
             provided, will generate a cameras list from parcing through the
             preproc fits files in the preprocdir
+        timer: ExposureTimer to record the time of each page
     '''
 
     from nightwatch.webpages import amp as web_amp
@@ -483,85 +893,93 @@ def make_plots(infile, basedir, preprocdir=None, logdir=None, rawdir=None, camer
         os.makedirs(expdir, exist_ok=True)
 
     #- Amp QA page: CCD readnoise, cosmic rates, etc.
-    if 'PER_AMP' in qadata:
-        htmlfile = f'{expdir}/qa-amp-{expid:08d}.html'
-        pc = web_amp.write_amp_html(htmlfile, qadata['PER_AMP'], header)
-        print(f'Wrote {htmlfile}')
-    else:
-        htmlfile = f'{expdir}/qa-amp-{expid:08d}.html'
-        pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_AMP")
+    with timed(timer, 'plots', 'amp'):
+        if 'PER_AMP' in qadata:
+            htmlfile = f'{expdir}/qa-amp-{expid:08d}.html'
+            pc = web_amp.write_amp_html(htmlfile, qadata['PER_AMP'], header)
+            print(f'Wrote {htmlfile}')
+        else:
+            htmlfile = f'{expdir}/qa-amp-{expid:08d}.html'
+            pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_AMP")
 
     #- Camfiber QA page: flux vs fiber number for all cameras.
-    htmlfile = f'{expdir}/qa-camfiber-{expid:08d}.html'
-    if 'PER_CAMFIBER' in qadata:
-        try:
-            pc = web_camfiber.write_camfiber_html(htmlfile, qadata['PER_CAMFIBER'], header)
-            print(f'Wrote {htmlfile}')
-        except Exception as err:
-            web_placeholder.handle_failed_plot(htmlfile, header, "PER_CAMFIBER")
-    else:
-        pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_CAMFIBER")
-        fp_file = f'{expdir}/qa-camfiber-{expid:08d}-focalplane_plots.html'
-        pc = web_placeholder.write_placeholder_html(fp_file, header, "PER_CAMFIBER")
-        pa_file = f'{expdir}/qa-camfiber-{expid:08d}-posacc_plots.html'
-        pc = web_placeholder.write_placeholder_html(pa_file, header, "PER_CAMFIBER")
+    with timed(timer, 'plots', 'camfiber'):
+        htmlfile = f'{expdir}/qa-camfiber-{expid:08d}.html'
+        if 'PER_CAMFIBER' in qadata:
+            try:
+                pc = web_camfiber.write_camfiber_html(htmlfile, qadata['PER_CAMFIBER'], header)
+                print(f'Wrote {htmlfile}')
+            except Exception as err:
+                web_placeholder.handle_failed_plot(htmlfile, header, "PER_CAMFIBER")
+        else:
+            pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_CAMFIBER")
+            fp_file = f'{expdir}/qa-camfiber-{expid:08d}-focalplane_plots.html'
+            pc = web_placeholder.write_placeholder_html(fp_file, header, "PER_CAMFIBER")
+            pa_file = f'{expdir}/qa-camfiber-{expid:08d}-posacc_plots.html'
+            pc = web_placeholder.write_placeholder_html(pa_file, header, "PER_CAMFIBER")
 
     #- Camera QA page: plots of qproc trace shifts, etc.
-    htmlfile = f'{expdir}/qa-camera-{expid:08d}.html'
-    if 'PER_CAMERA' in qadata:
-        try:
-            pc = web_camera.write_camera_html(htmlfile, qadata['PER_CAMERA'], header)
-            print(f'Wrote {htmlfile}')
-        except Exception as err:
-            web_placeholder.handle_failed_plot(htmlfile, header, "PER_CAMERA")
-    else:
-        pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_CAMERA")
+    with timed(timer, 'plots', 'camera'):
+        htmlfile = f'{expdir}/qa-camera-{expid:08d}.html'
+        if 'PER_CAMERA' in qadata:
+            try:
+                pc = web_camera.write_camera_html(htmlfile, qadata['PER_CAMERA'], header)
+                print(f'Wrote {htmlfile}')
+            except Exception as err:
+                web_placeholder.handle_failed_plot(htmlfile, header, "PER_CAMERA")
+        else:
+            pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_CAMERA")
 
     #- Spectra QA page.
-    htmlfile = f'{expdir}/qa-spectro-{expid:08d}.html'
-    if 'PER_SPECTRO' in qadata or 'PER_CAMFIBER' in qadata:
-        try:
-            #pc = web_spectra.write_spectra_html(htmlfile, qadata['PER_SPECTRO'], header)
-            qfdir = os.path.join(os.path.abspath(basedir), dirnight)
-            pc = web_spectra.write_spectra_html(htmlfile, qadata, header, qfdir)
-            print(f'Wrote {htmlfile}')
-        except Exception as err:
-            web_placeholder.handle_failed_plot(htmlfile, header, 'PER_SPECTRO')
-    else:
-        pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_SPECTRO")
+    with timed(timer, 'plots', 'spectro'):
+        htmlfile = f'{expdir}/qa-spectro-{expid:08d}.html'
+        if 'PER_SPECTRO' in qadata or 'PER_CAMFIBER' in qadata:
+            try:
+                #pc = web_spectra.write_spectra_html(htmlfile, qadata['PER_SPECTRO'], header)
+                qfdir = os.path.join(os.path.abspath(basedir), dirnight)
+                pc = web_spectra.write_spectra_html(htmlfile, qadata, header, qfdir)
+                print(f'Wrote {htmlfile}')
+            except Exception as err:
+                web_placeholder.handle_failed_plot(htmlfile, header, 'PER_SPECTRO')
+        else:
+            pc = web_placeholder.write_placeholder_html(htmlfile, header, "PER_SPECTRO")
 
     #- QA summary page.
-    htmlfile = f'{expdir}/qa-summary-{expid:08d}.html'
-    web_summary.write_summary_html(htmlfile, qadata, preprocdir)
-    print(f'Wrote {htmlfile}')
+    with timed(timer, 'plots', 'summary'):
+        htmlfile = f'{expdir}/qa-summary-{expid:08d}.html'
+        web_summary.write_summary_html(htmlfile, qadata, preprocdir)
+        print(f'Wrote {htmlfile}')
 
     #- Note: last exposure goes in basedir, not expdir=basedir/NIGHT/EXPID
-    htmlfile = f'{basedir}/qa-lastexp.html'
-    web_lastexp.write_lastexp_html(htmlfile, qadata, preprocdir)
-    print(f'Wrote {htmlfile}')
+    with timed(timer, 'plots', 'lastexp'):
+        htmlfile = f'{basedir}/qa-lastexp.html'
+        web_lastexp.write_lastexp_html(htmlfile, qadata, preprocdir)
+        print(f'Wrote {htmlfile}')
 
     if rawdir:
         #- plot guide metric plots
-        try:
-            guidedata = io.get_guide_data(night, expid, rawdir)
-            htmlfile = f'{expdir}/qa-guide-{expid:08d}.html'
-            web_guide.write_guide_html(htmlfile, header, guidedata)
-            print(f'Wrote {htmlfile}')
-        except (FileNotFoundError, OSError, IOError):
-            print('Unable to find guide data, not plotting guide plots')
-            htmlfile = f'{expdir}/qa-guide-{expid:08d}.html'
-            pc = web_placeholder.write_placeholder_html(htmlfile, header, "GUIDING")
+        with timed(timer, 'plots', 'guide'):
+            try:
+                guidedata = io.get_guide_data(night, expid, rawdir)
+                htmlfile = f'{expdir}/qa-guide-{expid:08d}.html'
+                web_guide.write_guide_html(htmlfile, header, guidedata)
+                print(f'Wrote {htmlfile}')
+            except (FileNotFoundError, OSError, IOError):
+                print('Unable to find guide data, not plotting guide plots')
+                htmlfile = f'{expdir}/qa-guide-{expid:08d}.html'
+                pc = web_placeholder.write_placeholder_html(htmlfile, header, "GUIDING")
 
         #- plot guide image movies
-        try:
-            htmlfile = f'{expdir}/guide-image-{expid:08d}.html'
-            image_data = io.get_guide_images(night, expid, rawdir)
-            web_guideimage.write_guide_image_html(image_data, htmlfile, night, expid)
-            print(f'Wrote {htmlfile}')
-        except (FileNotFoundError, OSError, IOError):
-            print('Unable to find guide data, not plotting guide image plots')
-            htmlfile = f'{expdir}/guide-image-{expid:08d}.html'
-            pc = web_placeholder.write_placeholder_html(htmlfile, header, "GUIDE_IMAGES")
+        with timed(timer, 'plots', 'guideimage'):
+            try:
+                htmlfile = f'{expdir}/guide-image-{expid:08d}.html'
+                image_data = io.get_guide_images(night, expid, rawdir)
+                web_guideimage.write_guide_image_html(image_data, htmlfile, night, expid)
+                print(f'Wrote {htmlfile}')
+            except (FileNotFoundError, OSError, IOError):
+                print('Unable to find guide data, not plotting guide image plots')
+                htmlfile = f'{expdir}/guide-image-{expid:08d}.html'
+                pc = web_placeholder.write_placeholder_html(htmlfile, header, "GUIDE_IMAGES")
 
     #- regardless of if logdir or preprocdir, identifying failed qprocs by comparing
     #- generated preproc files to generated logfiles
@@ -592,38 +1010,31 @@ def make_plots(infile, basedir, preprocdir=None, logdir=None, rawdir=None, camer
 
         argslist = [(pinput.format(cam, expid), output.format(cam, expid), downsample, night) for cam in cameras]
 
-        if ncpu > 1:
-            mp.set_start_method("spawn", force=True)
-            pool = mp.Pool(ncpu)
-            pool.starmap(web_plotimage.write_image_html, argslist)
-            pool.close()
-            pool.join()
+        with timed(timer, 'plots', 'preproc_images'):
+            workers.starmap(web_plotimage.write_image_html, argslist, ncpu=ncpu)
 
-        else:
-            for args in argslist:
-                web_plotimage.write_image_html(*args)
-
-        #- plot preproc nav table
-        navtable_output = f'{expdir}/qa-amp-{expid:08d}-preproc_table.html'
-        web_plotimage.write_preproc_table_html(preprocdir, night, expid, downsample, navtable_output)
+            #- plot preproc nav table
+            navtable_output = f'{expdir}/qa-amp-{expid:08d}-preproc_table.html'
+            web_plotimage.write_preproc_table_html(preprocdir, night, expid, downsample, navtable_output)
 
     if (logdir is not None):
         #- plot logfiles
         log.debug(f'Log directory: {logdir}')
 
-        error_colors = dict()
-        for log_cam in log_cams:
-            qinput = os.path.join(logdir, f'qproc-{log_cam}-{expid:08d}.log')
-            output = os.path.join(expdir, f'qproc-{log_cam}-{expid:08d}-logfile.html')
-            log.debug(f'qproc log: {qinput}')
-            e = web_summary.write_logfile_html(qinput, output, night)
+        with timed(timer, 'plots', 'logfiles'):
+            error_colors = dict()
+            for log_cam in log_cams:
+                qinput = os.path.join(logdir, f'qproc-{log_cam}-{expid:08d}.log')
+                output = os.path.join(expdir, f'qproc-{log_cam}-{expid:08d}-logfile.html')
+                log.debug(f'qproc log: {qinput}')
+                e = web_summary.write_logfile_html(qinput, output, night)
 
-            error_colors[log_cam] = e
+                error_colors[log_cam] = e
 
-        #- plot logfile nav table
-        htmlfile = f'{expdir}/qa-summary-{expid:08d}-logfiles_table.html'
-        web_summary.write_logtable_html(htmlfile, logdir, night, expid, available=log_cams,
-                                        error_colors=error_colors)
+            #- plot logfile nav table
+            htmlfile = f'{expdir}/qa-summary-{expid:08d}-logfiles_table.html'
+            web_summary.write_logtable_html(htmlfile, logdir, night, expid, available=log_cams,
+                                            error_colors=error_colors)
 
 
 def write_tables(indir, outdir, expnights=None):
@@ -1035,14 +1446,9 @@ def write_summaryqa(infile, name_dict, tiles, rawdir, outdir, nights=None, show_
 
     if ncpu > 1:
         print(f'Running surveyqa in parallel on {ncpu} cores for {nights_sub} nights')
-        pool = mp.Pool(ncpu)
-        pool.starmap(web_nightlyqa.get_nightlyqa_html, argslist)
-        pool.close()
-        pool.join()
-
     else:
         print(f'Running surveyqa serially for {nights_sub} nights')
-        for night in nights_sub:
-            web_nightlyqa.get_nightlyqa_html(night, exposures_sub, fine_data_sub, tiles, outdir, link_dict)
+
+    workers.starmap(web_nightlyqa.get_nightlyqa_html, argslist, ncpu=ncpu)
 
     print('Done')
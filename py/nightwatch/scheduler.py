@@ -0,0 +1,152 @@
+'''
+Priority scheduling of live exposures and background backfill
+
+The scheduler wraps an exposure finder (see nightwatch.discovery) and always
+serves the newest unprocessed exposure of the current night first, ordered
+by a configurable priority per OBSTYPE.  When there is nothing new to do in
+the current night it optionally fills the idle time with the oldest
+unprocessed exposure in the whole tree, so that one long-running monitor
+keeps the live night fresh while draining a historical backlog.
+'''
+
+import os
+
+import desiutil.log
+
+from . import run
+from .io import get_raw_exposure
+
+
+def parse_priorities(spec):
+    '''
+    Parse an OBSTYPE priority specification like "SCIENCE=0,ARC=1,FLAT=1"
+
+    Args:
+        spec : comma separated list of OBSTYPE=priority, or None
+
+    Returns dict of upper case OBSTYPE -> int priority; lower numbers are
+    processed first and OBSTYPEs that aren't listed get the `*` entry if
+    given, otherwise one more than the largest priority
+    '''
+    priorities = dict()
+    if spec is None or spec.strip() == '':
+        return priorities
+
+    for item in spec.split(','):
+        try:
+            obstype, priority = item.split('=')
+            priorities[obstype.strip().upper()] = int(priority)
+        except ValueError:
+            raise ValueError(f'Unable to parse priority "{item}"; expected OBSTYPE=N')
+
+    return priorities
+
+
+def get_obstype(rawfile):
+    '''
+    Returns upper case OBSTYPE (or FLAVOR) of rawfile, or None if unknown,
+    e.g. because the file is still being written
+    '''
+    try:
+        obstype = get_raw_exposure(rawfile).obstype
+    except (OSError, IOError, ValueError):
+        return None
+
+    return None if obstype is None else obstype.strip()
+
+
+class ExposureScheduler(object):
+    '''Order live exposures by priority and backfill older exposures'''
+
+    def __init__(self, finder, outdir=None, priorities=None, backfill=False,
+                 index=None):
+        '''
+        Args:
+            finder : PollingFinder or InotifyFinder for the live night
+
+        Options:
+            outdir : directory of processed nights data, needed for backfill
+            priorities : dict of OBSTYPE -> priority; lower numbers first
+            backfill : if True, process the oldest unprocessed exposures in
+                the tree when there are no live exposures to process
+            index : ExposureIndex used to speed up backfill scans
+        '''
+        if backfill and outdir is None:
+            raise ValueError('outdir is required for backfill')
+
+        self.finder = finder
+        self.outdir = outdir
+        self.priorities = dict() if priorities is None else priorities
+        self.backfill = backfill
+        self.index = index
+        self._obstypes = dict()  #- expdir -> OBSTYPE cache
+
+    def priority(self, expdir):
+        '''Returns priority of the exposure in expdir; lower is sooner'''
+        if len(self.priorities) == 0:
+            return 0
+
+        if self._obstypes.get(expdir) is None:
+            expid = os.path.basename(expdir)
+            rawfile = os.path.join(expdir, f'desi-{expid}.fits.fz')
+            self._obstypes[expdir] = get_obstype(rawfile)
+
+        obstype = self._obstypes[expdir]
+        if obstype in self.priorities:
+            return self.priorities[obstype]
+        elif '*' in self.priorities:
+            return self.priorities['*']
+        else:
+            return max(self.priorities.values()) + 1
+
+    def _sortkey(self, expdir):
+        night, expid = expdir.split('/')[-2:]
+        #- priority first, then newest first
+        return (self.priority(expdir), -int(night), -int(expid))
+
+    def next_expdir(self, processed):
+        '''
+        Returns the next indir/YEARMMDD/EXPID to process, or None
+
+        Args:
+            processed : set of exposure directories already processed
+        '''
+        log = desiutil.log.get_logger()
+        for expdir in list(self._obstypes.keys()):
+            if expdir in processed:
+                del self._obstypes[expdir]
+
+        #- --catchup scans the whole tree in order before live exposures are
+        #- prioritized; InotifyFinder clears catchup once the tree is done
+        if getattr(self.finder, 'catchup', False):
+            return self.finder.next_expdir(processed)
+
+        live = self.finder.latest_expdirs(processed)
+        if len(live) > 0:
+            expdir = min(live, key=self._sortkey)
+            log.debug('{} scheduling live exposure {} (priority {})'.format(
+                run.timestamp(), expdir, self.priority(expdir)))
+            return expdir
+
+        if self.backfill:
+            expdir = run.find_unprocessed_expdir(self.finder.indir, self.outdir,
+                    processed, startdate=self.finder.startdate, index=self.index)
+            if expdir is not None:
+                log.debug('{} scheduling backfill exposure {}'.format(
+                    run.timestamp(), expdir))
+                return expdir
+
+        return None
+
+    def requeue(self, expdir):
+        self.finder.requeue(expdir)
+
+    def wait(self, timeout):
+        self.finder.wait(timeout)
+
+    def close(self):
+        self._obstypes.clear()
+        self.finder.close()
+
+    def __repr__(self):
+        return 'ExposureScheduler({})'.format(self.finder)
@@ -4,19 +4,25 @@ nightwatch command line script
 
 import os, sys, time, glob
 import argparse
-import traceback
-import subprocess
 from desimodel.io import load_tiles
 import desispec.io
 
-from . import run, plots, io
+from . import run, plots, io, discovery, workers, resources, staging, timing, calibcache
+from .index import ExposureIndex, default_indexfile, PROCESSED, SKIPPED, FAILED
+from .pipeline import ExposurePipeline, ExposureJob, parse_stage_workers
+from .scheduler import ExposureScheduler, parse_priorities
+from .readiness import ReadinessChecker
+from .manifest import ExposureManifest, fibermap_inputs, qa_inputs, plot_outputs
+from .batch import ExposurePacker, read_packfile
+from .staging import ExposureStaging
+from .timing import ExposureTimer
+from .executors import EXECUTORS, LocalExecutor, SubprocessExecutor, SlurmExecutor, DryRunExecutor
 from .run import timestamp, get_ncpu
 from .qa.runner import QARunner
 from desiutil.log import get_logger
 
-import tempfile
-import shutil
 import contextlib
+import collections
 
 import multiprocessing as mp
 
@@ -26,6 +32,10 @@ def print_help():
 Supported commands are:
     monitor    Monitor input directory and run qproc, qa, and generate plots
     run        Run qproc, qa, and generate plots for a single exposure
+    runpack    Run qproc, qa, and plots for a list of exposures in a batch job
+    staging-benchmark
+               Compare writing exposure outputs directly vs. staged in scratch
+    timing     Summarize per-stage timing of processed exposures
     assemble_fibermap
                Run assemble_fibermap using data from input raw data file
     preproc    Run only preprocessing on an input raw data file
@@ -55,6 +65,12 @@ def main():
         main_monitor()
     if command == 'run':
         main_run()
+    elif command == 'runpack':
+        main_runpack()
+    elif command == 'staging-benchmark':
+        main_staging_benchmark()
+    elif command == 'timing':
+        main_timing()
     elif command == 'assemble_fibermap':
         main_assemble_fibermap()
     elif command == 'preproc':
@@ -92,18 +108,82 @@ def main_monitor(options=None):
     parser.add_argument("--plotdir", type=str, help="QA plot output directory")
     parser.add_argument("--cameras", type=str, help="comma separated list of cameras (for debugging)")
     parser.add_argument("--catchup", action="store_true", help="Catch up on processing all unprocessed data")
+    parser.add_argument("--backfill", action="store_true",
+                        help="Process the newest exposures first, and the oldest unprocessed data when idle")
+    parser.add_argument("--priorities", type=str, default=None,
+                        help="OBSTYPE priorities for new exposures, lower first, e.g. SCIENCE=0,ARC=1,FLAT=1,*=2")
     parser.add_argument("--waittime", type=int, default=10, help="Seconds to wait between checks for new data")
     parser.add_argument("--startdate", type=int, default=None, help="Earliest startdate to check for unprocessed nights (YYYYMMDD)")
-    parser.add_argument("--batch", "-b", action='store_true', help="spawn qproc data processing to batch job")
+    parser.add_argument("--discovery", type=str, default="auto", choices=["auto", "inotify", "poll"],
+                        help="How to discover new exposures; auto uses inotify if indir supports it, otherwise polling")
+    parser.add_argument("--rescan", type=int, default=300, help="Seconds between safety-net rescans of indir when using inotify")
+    parser.add_argument("--index", type=str, default=None, help="SQLite index of processed exposures (default outdir/nightwatch_index.db)")
+    parser.add_argument("--no-index", action="store_true", help="Don't use an index of processed exposures")
+    parser.add_argument("--retry-failed", action="store_true", help="Retry exposures that are marked as failed in the index")
+    parser.add_argument("--settle", type=float, default=5, help="Seconds a raw file must be unchanged before it is processed")
+    parser.add_argument("--no-hdu-check", action="store_true", help="Don't check that raw files have a complete HDU index before processing")
+    parser.add_argument("--require", type=str, default=None,
+                        help="Comma separated companion files that must exist in the exposure directory, e.g. coordinates-{expid}.fits")
+    parser.add_argument("--ready-timeout", type=float, default=600,
+                        help="Seconds after which incomplete raw data is processed anyway")
+    parser.add_argument("--pipeline", action="store_true", help="Overlap qproc, qa, plots, and tables stages of consecutive exposures")
+    parser.add_argument("--stage-workers", type=str, default=None,
+                        help="Concurrent exposures per pipeline stage, e.g. qproc=1,qa=1,plots=2 (default 1 each)")
+    parser.add_argument("--queue-size", type=int, default=2, help="Max exposures waiting in front of each pipeline stage")
+    parser.add_argument("-N", "--ncpu", type=int, default=None, help="Number of worker processes shared by all stages")
+    parser.add_argument("--task-memory", type=float, default=resources.DEFAULT_TASK_MEMORY/1e9,
+                        help="Estimated peak memory per worker task in GB, used to limit the number of workers")
+    parser.add_argument("--calib-cache", type=float, default=calibcache.DEFAULT_CACHE_SIZE,
+                        help="GB of calibration products each worker keeps in memory between exposures (0 to disable)")
+    parser.add_argument("--start-method", type=str, default=None, choices=workers.START_METHODS,
+                        help="How to start worker processes (default forkserver if available)")
+    parser.add_argument("--preload", type=str, default=None,
+                        help="Comma separated modules to import in workers before their first task; prefix with + to add to the defaults")
+    parser.add_argument("--qproc-mode", type=str, default="inprocess", choices=run.QPROC_MODES,
+                        help="Run qproc within the worker processes or as a desi_qproc subprocess per camera")
+    parser.add_argument("--qproc-timeout", type=str, default="auto",
+                        help="Per-camera qproc timeout in seconds, auto (from the timing history of each OBSTYPE), or none")
+    parser.add_argument("--qproc-retries", type=int, default=1,
+                        help="Number of times to retry cameras whose qproc timed out")
+    parser.add_argument("--qa-concurrency", type=int, default=4,
+                        help="Max number of QA classes to run at once for each exposure")
+    parser.add_argument("--force", action="store_true",
+                        help="Rerun all stages even if the exposure manifest says they are up to date")
+    parser.add_argument("--scratch", type=str, default=None,
+                        help="Write outputs to a staging directory in SCRATCH (auto: /dev/shm or $TMPDIR), then publish them to outdir")
+    parser.add_argument("--executor", type=str, default="local", choices=EXECUTORS,
+                        help="How to process exposures: in this process, as nightwatch run subprocesses, in Slurm batch jobs, or a dry run that only reports estimated costs")
+    parser.add_argument("--max-running", type=int, default=1,
+                        help="Max exposures processed at once by the subprocess executor")
+    parser.add_argument("--dryrun-file", type=str, default=None,
+                        help="Append dry run records to this JSON lines file")
+    parser.add_argument("--batch", "-b", action='store_true', help="spawn qproc data processing to batch job; same as --executor slurm")
     parser.add_argument("--batch-queue", "-q", type=str, default="realtime", help="batch queue to use")
     parser.add_argument("--batch-time", "-t", type=int, default=15, help="batch job time limit [minutes]")
     parser.add_argument("--batch-opts", type=str, default="-N 1 -C haswell -A desi", help="Additional batch options")
+    parser.add_argument("--batch-pack", type=int, default=8, help="Max exposures packed into one batch job")
+    parser.add_argument("--batch-wait", type=float, default=120,
+                        help="Max seconds to hold a partially filled batch job while more exposures arrive")
+    parser.add_argument("--batch-concurrent", type=int, default=4,
+                        help="Exposures processed at once within each batch job")
 
     if options is None:
         options = sys.argv[2:]
 
     args = parser.parse_args(options)
 
+    if args.catchup and args.backfill:
+        print('ERROR: use either --catchup or --backfill, not both')
+        sys.exit(2)
+
+    budget = resources.configure(task_memory=args.task_memory*1e9,
+                                 cache_memory=args.calib_cache*1e9)
+    calibcache.configure(args.calib_cache)
+    log = get_logger()
+    log.info('Using {}'.format(budget))
+    workers.configure(args.ncpu, start_method=args.start_method,
+                      preload=workers.parse_preload(args.preload))
+
     if args.cameras is not None:
         cameras = args.cameras.split(',')
     else:
@@ -116,26 +196,121 @@ def main_monitor(options=None):
     tmp = os.path.join(args.indir, 'YEARMMDD', 'EXPID')
     log.info('Monitoring {}/ for new raw data'.format(tmp))
 
-    qarunner = QARunner()
+    qarunner = QARunner(concurrency=args.qa_concurrency)
     processed = set()
 
+    if args.no_index:
+        expindex = None
+    else:
+        if args.index is None:
+            args.index = default_indexfile(args.outdir)
+        expindex = ExposureIndex(args.index)
+        if args.retry_failed:
+            n = expindex.reset_failed()
+            log.info('Retrying {} previously failed exposures'.format(n))
+        processed |= expindex.done_expdirs(args.indir)
+        log.info('Loaded {} processed exposures from {}'.format(len(processed), args.index))
+
+    finder = discovery.get_finder(args.discovery, args.indir, outdir=args.outdir,
+                                  catchup=args.catchup, startdate=args.startdate,
+                                  index=expindex, rescan=args.rescan)
+    if args.backfill or args.priorities is not None:
+        finder = ExposureScheduler(finder, outdir=args.outdir,
+                                   priorities=parse_priorities(args.priorities),
+                                   backfill=args.backfill, index=expindex)
+    log.info('Using {} to discover new exposures'.format(finder))
+
+    checker = ReadinessChecker(settle=args.settle, check_hdus=not args.no_hdu_check,
+                               companions=args.require.split(',') if args.require else None,
+                               timeout=args.ready_timeout)
+    deferred = dict()               #- expdir -> time to check again
+    requeued = collections.deque()  #- expdirs to retry, from pipeline threads
+
+    def record_job(job):
+        if job.failed and job.raw_mtime is not None and os.path.exists(job.rawfile) \
+                and os.path.getmtime(job.rawfile) != job.raw_mtime:
+            print('{} {} changed while processing {}/{}; will retry'.format(
+                timestamp(), os.path.basename(job.rawfile), job.night, job.expid))
+            requeued.append(job.rawdir)
+            return
+        if expindex is None:
+            return
+        if job.failed:
+            expindex.record(job.night, job.expid, FAILED, mtime=job.raw_mtime,
+                            message='{}: {}'.format(job.failed_stage, job.error))
+        else:
+            expindex.record(job.night, job.expid, PROCESSED, mtime=job.raw_mtime)
+
+    if args.batch:
+        args.executor = 'slurm'
+
+    #- options passed on to `nightwatch run` and `nightwatch runpack`
+    run_options = ['--qproc-mode', args.qproc_mode, '--qproc-timeout', args.qproc_timeout,
+                   '--qproc-retries', str(args.qproc_retries), '--task-memory', str(args.task_memory),
+                   '--calib-cache', str(args.calib_cache), '--qa-concurrency', str(args.qa_concurrency)]
+    if args.scratch is not None:
+        run_options += ['--scratch', args.scratch]
+    if args.force:
+        run_options.append('--force')
+
+    if args.executor == 'slurm':
+        packer = ExposurePacker(args.outdir, plotdir=args.plotdir, cameras=cameras,
+                                max_exposures=args.batch_pack, max_wait=args.batch_wait,
+                                concurrent=args.batch_concurrent, queue=args.batch_queue,
+                                max_time=args.batch_time, batchopts=args.batch_opts,
+                                run_options=' '.join(run_options))
+        executor = SlurmExecutor(packer)
+    elif args.executor == 'subprocess':
+        ncpu = max(1, workers.get_ncpu() // max(1, args.max_running))
+        executor = SubprocessExecutor(on_done=record_job, max_running=args.max_running,
+                                      ncpu=ncpu, run_options=run_options)
+    elif args.executor == 'dryrun':
+        executor = DryRunExecutor(outfile=args.dryrun_file, ncpu=workers.get_ncpu())
+    else:
+        stage_workers = parse_stage_workers(args.stage_workers)
+        workers.warmup()
+        executor = LocalExecutor(qarunner, on_done=record_job, workers=stage_workers,
+                                 queue_size=args.queue_size, serial=not args.pipeline,
+                                 qproc_mode=args.qproc_mode,
+                                 qproc_timeout=timing.parse_qproc_timeout(args.qproc_timeout, args.outdir),
+                                 qproc_retries=args.qproc_retries)
+        if args.pipeline:
+            log.info('Pipelining exposures with stage workers {}'.format(stage_workers))
+
+    log.info('Processing exposures with {}'.format(executor))
+
     #- TODO: figure out a way to print how many nights are being skipped before startdate
     while True:        
 
         if os.path.exists('stop.nightwatch'):
-            print("Found stop.nightwatch file; exiting now")
+            print("Found stop.nightwatch file; finishing current exposures then exiting")
+            executor.close()
+            log.info('Executor stats: {}'.format(executor.stats()))
+            finder.close()
+            workers.shutdown()
             sys.exit(0)
 
-        if args.catchup:
-            expdir = run.find_unprocessed_expdir(args.indir, args.outdir, processed, startdate=args.startdate)
-        else:
-            expdir = run.find_latest_expdir(args.indir, processed, startdate=args.startdate)
+        #- make deferred exposures candidates again once their time is up
+        now = time.time()
+        while len(requeued) > 0:
+            deferred[requeued.popleft()] = now
+        for expdir in [e for e, t in deferred.items() if t <= now]:
+            del deferred[expdir]
+            processed.discard(expdir)
+            finder.requeue(expdir)
+
+        expdir = finder.next_expdir(processed)
+
+        executor.poll(idle=expdir is None)
 
         if expdir is None:
-            print('{} No new exposures found; sleeping {} sec'.format(
-                    timestamp(), args.waittime))
+            waittime = args.waittime
+            if len(deferred) > 0:
+                waittime = max(0, min(waittime, min(deferred.values()) - now))
+            print('{} No new exposures found; waiting up to {:.0f} sec'.format(
+                    timestamp(), waittime))
             sys.stdout.flush()
-            time.sleep(args.waittime)
+            finder.wait(waittime)
             continue
 
         night, expid = expdir.split('/')[-2:]
@@ -145,168 +320,38 @@ def main_monitor(options=None):
 
         if expdir not in processed and os.path.exists(rawfile):
             processed.add(expdir)
+            raw_mtime = os.path.getmtime(rawfile)
+            if expindex is not None and expindex.is_done(night, expid, rawfile):
+                print('Skipping {}/{} marked as done in {}'.format(night, expid, args.index))
+                continue
+
             outdir = '{}/{}/{}'.format(args.outdir, night, expid)
             if os.path.exists(outdir) and len(glob.glob(outdir+'/qa-*.fits'))>0:
                 print('Skipping previously processed {}/{}'.format(night, expid))
-                processed.add(expdir)
+                if expindex is not None:
+                    expindex.record(night, expid, SKIPPED, mtime=raw_mtime)
+                continue
+
+            #- don't start on partially transferred raw data
+            ready, reason = checker.check(rawfile)
+            if not ready:
+                print('{} {}/{} not ready: {}'.format(timestamp(), night, expid, reason))
+                deferred[expdir] = time.time() + max(1, args.settle)
                 continue
-            else:
-                os.makedirs(outdir, exist_ok=True)
+            checker.forget(rawfile)
 
-            time_start = time.time()
             print('\n{} Found new exposure {}/{}'.format(timestamp(), night, expid))
             sys.stdout.flush()
-            try :
-                if args.batch:
-                    print('{} Submitting batch job for {}'.format(time.strftime('%H:%M'), rawfile))
-                    batch_run(rawfile, args.outdir, cameras, args.batch_queue, args.batch_time, args.batch_opts)
-                else:
-                    print('{} Running assemble_fibermap'.format(time.strftime('%H:%M')))
-                    fibermap = run.run_assemble_fibermap(rawfile, outdir)
-
-                    print('{} Running qproc on {}'.format(time.strftime('%H:%M'), rawfile))
-                    sys.stdout.flush()
-                    header = run.run_qproc(rawfile, outdir, cameras=cameras)
-
-                    print('{} Running QA on {}/{}'.format(timestamp(), night, expid))
-                    sys.stdout.flush()
-                    qafile = "{}/qa-{}.fits".format(outdir,expid)
-
-                    caldir = os.path.join(args.plotdir, "static")
-                    jsonfile = os.path.join(caldir, "timeseries_dropdown.json")
-
-                    if not os.path.isdir(caldir):
-                        os.makedirs(caldir)
-                    qarunner.run(indir=outdir, outfile=qafile, jsonfile=jsonfile)
-
-                    print('Generating plots for {}/{}'.format(night, expid))
-                    tmpdir = '{}/{}/{}'.format(args.plotdir, night, expid)
-                    if not os.path.isdir(tmpdir) :
-                        os.makedirs(tmpdir)
-                    run.make_plots(infile=qafile, basedir=args.plotdir, preprocdir=outdir, logdir=outdir, rawdir=rawdir, cameras=cameras)
-
-                    print('{} Updating night/exposure summary tables'.format(time.strftime('%H:%M')))
-                    run.write_tables(args.outdir, args.plotdir, expnights=[night,])
-
-                    time_end = time.time()
-                    dt = (time_end - time_start) / 60
-                    print('{} Finished exposure {}/{} ({:.1f} min)'.format(
-                        timestamp(), night, expid, dt))
-
-            except Exception as e :
-                print("Failed to process or QA or plot exposure {}".format(expid))
-                print("Error message: {}".format(str(e)))
-                exc_info = sys.exc_info()
-                traceback.print_exception(*exc_info)
-                del exc_info
-                print("Now moving on ...")
-                sys.stdout.flush()
-
-            processed.add(expdir)
+            #- only the local executor writes outputs from this process
+            scratch = args.scratch if args.executor == 'local' else None
+            job = ExposureJob(rawfile, args.outdir, plotdir=args.plotdir, cameras=cameras,
+                              force=args.force, scratch=scratch)
+            executor.submit(job)
 
         else:
             sys.stdout.flush()
-            time.sleep(args.waittime)
-        
-class TempDirManager():
-    '''Custom context manager that creates a temporary directory, and upon exiting the context copies all files (regardless if the code written inside the context runs properly or exits with some error) into a specified output directory.'''
-    def __init__(self, outdir):
-        '''Initializes TempDirManager with the directory specified to copy all files written.'''
-        self.outdir = outdir
-        self.tempdir = None
-    def __enter__(self):
-        self.tempdir = tempfile.TemporaryDirectory().name
-        return self.tempdir
-    def __exit__(self, *exc):
-        '''Copies files over when context is exited.'''
-        outdir = self.outdir
-        tempdir = self.tempdir
-        
-        print('{} Copying files from temporary directory to {}'.format(
-            time.strftime('%H:%M'), outdir))
-
-        src = []
-        for dirpath, dirnames, files in os.walk(tempdir, topdown=True):
-            for file_name in files:
-                src.append(os.path.join(dirpath, file_name))
-        dest = [file.replace(tempdir, outdir) for file in src]
-        argslist = list(zip(src, dest))
-
-        #- Check what output directories need to be made, but cache list
-        #- so that we don't check existence for the same dir N>>1 times
-        fullpath_outdirs = set()
-        for (src, dest) in argslist:
-            dirpath = os.path.dirname(dest)
-            if dirpath not in fullpath_outdirs:
-                if not os.path.exists(dirpath):
-                    os.makedirs(dirpath)
+            finder.wait(args.waittime)
         
-        #- using shutil.move in place of shutil.copytree, for instance, because copytree requires that the directory/file being copied to does not exist prior to the copying (option to supress this requirement only available in python 3.8+)
-        #- parallel copying performs better than copying serially
-        ncpu = get_ncpu(None)
-        if ncpu > 1:
-            pool = mp.Pool(ncpu)
-            pool.starmap(shutil.move, argslist)
-            pool.close()
-            pool.join()
-        else:
-            for args in argslist:
-                shutil.move(**args)
-        
-        print('{} Done copying {} files'.format(
-            time.strftime('%H:%M'), len(argslist)))
-
-def batch_run(infile, outdir, cameras, queue, batchtime, batchopts):
-    """Submits batch job to `nightwatch run infile outdir ...`
-
-    Args:
-        infile (str): input DESI raw data file
-        outdir (str): base output directory
-        cameras (list or None): None, or list of cameras to include
-        queue (str): slurm queue name
-        batchtime (int): batch job time limit [minutes]
-        batchopts (str): additional batch options
-
-    Returns error code from sbatch submission
-
-    Note: this is a non-blocking call and will return before the batch
-    processing is finished
-    """
-    night, expid = io.get_night_expid(infile)
-    expdir = io.findfile('expdir', night=night, expid=expid, basedir=outdir)
-
-    infile = os.path.abspath(infile)
-    expdir = os.path.abspath(expdir)
-    outdir = os.path.abspath(outdir)
-
-    if cameras is None:
-        camera_options = ""
-    elif isinstance(cameras, (list, tuple)):
-        camera_options = "--cameras {}".format(','.join(cameras))
-    elif isinstance(cameras, str):
-        camera_options = f"--cameras {cameras}"
-    else:
-        raise ValueError('Unable to parse cameras {}'.format(cameras))
-
-    jobname = f'nightwatch-{expid:08d}'
-    batchfile = f'{expdir}/{jobname}.slurm'
-    with open(batchfile, 'w') as fx:
-        fx.write(f"""#!/bin/bash -l
-
-#SBATCH {batchopts}
-#SBATCH --qos {queue}
-#SBATCH --time {batchtime}
-#SBATCH --job-name {jobname}
-#SBATCH --output {expdir}/{jobname}-%j.joblog
-#SBATCH --exclusive
-
-nightwatch run --infile {infile} --outdir {outdir} {camera_options}
-""")
-
-    err = subprocess.call(["sbatch", batchfile])
-
-    return err
-
 def main_run(options=None):
     parser = argparse.ArgumentParser(usage = "{prog} run [options]")
     parser.add_argument('-N', '--ncpu', type=int, required=False,
@@ -315,16 +360,43 @@ def main_run(options=None):
         help="input raw data file")
     parser.add_argument("-o", "--outdir", type=str, required=True,
         help="output base directory")
+    parser.add_argument("--plotdir", type=str, default=None,
+        help="QA plot output directory (default outdir)")
     parser.add_argument("--cameras", type=str, help="comma separated list of cameras (for debugging)")
     parser.add_argument('-n', '--night', type=int,
         help="YEARMMDD night")
     parser.add_argument('-e', '--expid', type=int,
         help="Exposure ID")
+    parser.add_argument("--qproc-mode", type=str, default="inprocess", choices=run.QPROC_MODES,
+        help="Run qproc within the worker processes or as a desi_qproc subprocess per camera")
+    parser.add_argument("--qproc-timeout", type=str, default="auto",
+        help="Per-camera qproc timeout in seconds, auto (from the timing history of each OBSTYPE), or none")
+    parser.add_argument("--qproc-retries", type=int, default=1,
+        help="Number of times to retry cameras whose qproc timed out")
+    parser.add_argument("--qa-concurrency", type=int, default=4,
+        help="Max number of QA classes to run at once for each exposure")
+    parser.add_argument("--task-memory", type=float, default=resources.DEFAULT_TASK_MEMORY/1e9,
+        help="Estimated peak memory per worker task in GB, used to limit the number of workers")
+    parser.add_argument("--calib-cache", type=float, default=calibcache.DEFAULT_CACHE_SIZE,
+        help="GB of calibration products each worker keeps in memory between exposures (0 to disable)")
+    parser.add_argument("--start-method", type=str, default=None, choices=workers.START_METHODS,
+        help="How to start worker processes (default forkserver if available)")
+    parser.add_argument("--preload", type=str, default=None,
+        help="Comma separated modules to import in workers before their first task; prefix with + to add to the defaults")
+    parser.add_argument("--force", action="store_true",
+        help="Rerun all stages even if the exposure manifest says they are up to date")
+    parser.add_argument("--scratch", type=str, default=None,
+        help="Write outputs to a staging directory in SCRATCH (auto: /dev/shm or $TMPDIR), then publish them to outdir")
 
     if options is None:
         options = sys.argv[2:]
 
     args = parser.parse_args(options)
+    resources.configure(task_memory=args.task_memory*1e9,
+                        cache_memory=args.calib_cache*1e9)
+    calibcache.configure(args.calib_cache)
+    workers.configure(args.ncpu, start_method=args.start_method,
+                      preload=workers.parse_preload(args.preload))
 
     if args.cameras is not None:
         cameras = args.cameras.split(',')
@@ -338,36 +410,239 @@ def main_run(options=None):
 
         args.infile = desispec.io.findfile('raw', args.night, args.expid)
         
-    night, expid = io.get_night_expid(args.infile)
+    #- read the raw data headers and camera list once for all steps
+    raw = io.get_raw_exposure(args.infile)
+    night, expid = io.get_night_expid(raw)
     rawdir = os.path.dirname(os.path.dirname(os.path.dirname(args.infile)))
 
-    #- Using a tempdir sometimes is better, and sometimes is way worse;
-    #- turn off for now
-    # with TempDirManager(args.outdir) as tempdir:
-    tempdir = args.outdir
-    if True:
+    if args.plotdir is None:
+        args.plotdir = args.outdir
+
+    timer = ExposureTimer(io.findfile('timing', night=night, expid=expid, basedir=args.outdir),
+                          night, expid, obstype=raw.obstype)
+
+    #- optionally write everything to scratch, then publish the exposure
+    #- directory to outdir in one go, even if processing fails
+    if args.scratch is not None:
+        stage = ExposureStaging(args.outdir, night, expid, plotdir=args.plotdir,
+                                scratch=args.scratch)
+        tempdir, plotdir = stage.basedir, stage.plotdir
+    else:
+        stage = contextlib.nullcontext()
+        tempdir, plotdir = args.outdir, args.plotdir
+
+    with stage:
         expdir = io.findfile('expdir', night=night, expid=expid, basedir=tempdir)
+        manifest = ExposureManifest(io.findfile('manifest', night=night, expid=expid,
+                                                basedir=tempdir), force=args.force)
 
         time_start = time.time()
         print('{} Running assemble_fibermap'.format(time.strftime('%H:%M')))
-        fibermap = run.run_assemble_fibermap(args.infile, expdir)
-
-        print('{} Running qproc'.format(time.strftime('%H:%M')))
-        header = run.run_qproc(args.infile, expdir, cameras=cameras, ncpu=args.ncpu)
+        fibermap = '{}/fibermap-{:08d}.fits'.format(expdir, expid)
+        with timer.time('fibermap'):
+            manifest.run_stage('fibermap', fibermap_inputs(args.infile),
+                    lambda: run.run_assemble_fibermap(raw, expdir), [fibermap,])
+
+        print('{} Running qproc and per-camera QA'.format(time.strftime('%H:%M')))
+        qarunner = QARunner(concurrency=args.qa_concurrency)
+        header = run.run_qproc(raw, expdir, cameras=cameras, ncpu=args.ncpu,
+                               mode=args.qproc_mode, camera_qa=qarunner.camera_qa,
+                               on_camera=lambda cam, err, res: qarunner.add_camera_results(expdir, cam, res),
+                               manifest=manifest, timer=timer,
+                               timeout=timing.parse_qproc_timeout(args.qproc_timeout, args.outdir)(raw.obstype),
+                               retries=args.qproc_retries)
 
         print('{} Running QA analysis'.format(time.strftime('%H:%M')))
         qafile = io.findfile('qa', night=night, expid=expid, basedir=tempdir)
-        qaresults = run.run_qa(expdir, outfile=qafile)
+        manifest.run_stage('qa', qa_inputs(expdir, expid),
+                lambda: qarunner.run(expdir, outfile=qafile, timer=timer,
+                                     dbdir=os.path.join(args.outdir, 'historyqa')),
+                [qafile,])
+        qarunner.forget(expdir)
 
         print('{} Making plots'.format(time.strftime('%H:%M')))
-        run.make_plots(qafile, tempdir, preprocdir=expdir, logdir=expdir, rawdir=rawdir, cameras=cameras)
+        manifest.run_stage('plots', [qafile,],
+                lambda: run.make_plots(qafile, plotdir, preprocdir=expdir, logdir=expdir,
+                                       rawdir=rawdir, cameras=cameras, timer=timer),
+                plot_outputs(plotdir, night, expid))
         
     print('{} Updating night/exposure summary tables'.format(time.strftime('%H:%M')))
-    run.write_tables(args.outdir, args.outdir, expnights=[night,])
+    with timer.time('tables'):
+        run.write_tables(args.outdir, args.plotdir, expnights=[night,])
+    workers.shutdown()
 
+    timer.add('exposure', None, ok=True, start=time_start, wall=time.time() - time_start)
+    timer.write()
     dt = (time.time() - time_start) / 60.0
     print('{} Done ({:.1f} min)'.format(time.strftime('%H:%M'), dt))
 
+def main_runpack(options=None):
+    parser = argparse.ArgumentParser(usage = "{prog} runpack [options]")
+    parser.add_argument("--packfile", type=str, required=True,
+        help="file listing input raw data files, one per line")
+    parser.add_argument("-o", "--outdir", type=str, required=True,
+        help="output base directory")
+    parser.add_argument("--plotdir", type=str, default=None,
+        help="QA plot output directory (default outdir)")
+    parser.add_argument("--cameras", type=str, help="comma separated list of cameras (for debugging)")
+    parser.add_argument('-N', '--ncpu', type=int, required=False,
+        help='Number of worker processes shared by all exposures')
+    parser.add_argument("--concurrent", type=int, default=4,
+        help="Number of exposures to process at once")
+    parser.add_argument("--qproc-mode", type=str, default="inprocess", choices=run.QPROC_MODES,
+        help="Run qproc within the worker processes or as a desi_qproc subprocess per camera")
+    parser.add_argument("--qproc-timeout", type=str, default="auto",
+        help="Per-camera qproc timeout in seconds, auto (from the timing history of each OBSTYPE), or none")
+    parser.add_argument("--qproc-retries", type=int, default=1,
+        help="Number of times to retry cameras whose qproc timed out")
+    parser.add_argument("--qa-concurrency", type=int, default=4,
+        help="Max number of QA classes to run at once for each exposure")
+    parser.add_argument("--task-memory", type=float, default=resources.DEFAULT_TASK_MEMORY/1e9,
+        help="Estimated peak memory per worker task in GB, used to limit the number of workers")
+    parser.add_argument("--calib-cache", type=float, default=calibcache.DEFAULT_CACHE_SIZE,
+        help="GB of calibration products each worker keeps in memory between exposures (0 to disable)")
+    parser.add_argument("--force", action="store_true",
+        help="Rerun all stages even if the exposure manifest says they are up to date")
+    parser.add_argument("--scratch", type=str, default=None,
+        help="Write outputs to a staging directory in SCRATCH (auto: /dev/shm or $TMPDIR), then publish them to outdir")
+
+    if options is None:
+        options = sys.argv[2:]
+
+    args = parser.parse_args(options)
+    budget = resources.configure(task_memory=args.task_memory*1e9,
+                                 cache_memory=args.calib_cache*1e9)
+    calibcache.configure(args.calib_cache)
+    log = get_logger()
+    log.info('Using {}'.format(budget))
+    workers.configure(args.ncpu)
+    workers.warmup()
+
+    if args.cameras is not None:
+        cameras = args.cameras.split(',')
+    else:
+        cameras = None
+
+    if args.plotdir is None:
+        args.plotdir = args.outdir
+
+    rawfiles = read_packfile(args.packfile)
+    time_start = time.time()
+    print('{} Processing {} exposures from {}, {} at a time'.format(
+        timestamp(), len(rawfiles), args.packfile, args.concurrent))
+
+    #- every stage runs up to `concurrent` exposures at once; their
+    #- qproc cameras and QA tasks all share the same worker pool
+    failed = list()
+    def record_job(job):
+        if job.failed:
+            failed.append(job)
+
+    n = max(1, args.concurrent)
+    pipeline = ExposurePipeline(QARunner(concurrency=args.qa_concurrency), workers=dict(qproc=n, qa=n, plots=n),
+                                queue_size=len(rawfiles), on_done=record_job,
+                                qproc_mode=args.qproc_mode,
+                                qproc_timeout=timing.parse_qproc_timeout(args.qproc_timeout, args.outdir),
+                                qproc_retries=args.qproc_retries)
+    with pipeline:
+        for rawfile in rawfiles:
+            pipeline.submit(ExposureJob(rawfile, args.outdir, plotdir=args.plotdir,
+                                        cameras=cameras, force=args.force,
+                                        scratch=args.scratch))
+
+    workers.shutdown()
+
+    dt = (time.time() - time_start) / 60.0
+    print('{} Done with {} exposures, {} failed ({:.1f} min)'.format(
+        timestamp(), len(rawfiles), len(failed), dt))
+    for job in failed:
+        print('  {}/{} failed in {}: {}'.format(job.night, job.expid, job.failed_stage, job.error))
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+def main_staging_benchmark(options=None):
+    parser = argparse.ArgumentParser(usage = "{prog} staging-benchmark [options]")
+    parser.add_argument("-o", "--outdir", type=str, required=True,
+        help="output base directory to benchmark, e.g. on CFS")
+    parser.add_argument("--scratch", type=str, default=None,
+        help="scratch directory (default /dev/shm or $TMPDIR)")
+    parser.add_argument("--template", type=str, default=None,
+        help="processed exposure directory whose file sizes to mimic (default synthetic full exposure)")
+    parser.add_argument("--ncameras", type=int, default=30,
+        help="number of cameras for the synthetic exposure")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="number of times to repeat each test")
+
+    if options is None:
+        options = sys.argv[2:]
+
+    args = parser.parse_args(options)
+
+    if args.template is not None:
+        filesizes = staging.exposure_filesizes(args.template)
+    else:
+        filesizes = staging.synthetic_filesizes(args.ncameras)
+
+    scratch = args.scratch if args.scratch is not None else staging.default_scratch()
+    results = staging.benchmark(args.outdir, scratch=scratch, filesizes=filesizes,
+                                repeat=args.repeat)
+
+    nbytes = results['nbytes']
+    print('{} files, {:.1f} GB per exposure; outdir {}, scratch {}'.format(
+        results['nfiles'], nbytes/1e9, args.outdir, scratch))
+    for key, label in [('direct', 'direct to outdir'), ('staged', 'to scratch'),
+                       ('published', 'to scratch + publish')]:
+        times = results[key]
+        best = min(times)
+        print('  {:22s} best {:6.2f} s  mean {:6.2f} s  {:7.1f} MB/s'.format(
+            label, best, sum(times)/len(times), nbytes/1e6/best))
+
+def main_timing(options=None):
+    parser = argparse.ArgumentParser(usage = "{prog} timing [options]")
+    parser.add_argument("-i", "--indir", type=str, required=True,
+        help="nightwatch output base directory with YEARMMDD/EXPID/timing-EXPID.json files")
+    parser.add_argument("-n", "--nights", type=str, default=None,
+        help="comma separated nights, or FIRST:LAST range (default all)")
+    parser.add_argument("--by", type=str, default="name", choices=('stage', 'name', 'obstype'),
+        help="group by stage, stage and name (e.g. camera or QA class), or stage and OBSTYPE")
+    parser.add_argument("-o", "--outfile", type=str, default=None,
+        help="also write the summary table to this file (e.g. .fits, .csv, .ecsv)")
+
+    if options is None:
+        options = sys.argv[2:]
+
+    args = parser.parse_args(options)
+
+    nights = timing.select_nights(args.indir, args.nights)
+    filenames = timing.find_timing_files(args.indir, nights)
+    records = timing.read_timing(filenames)
+    if len(records) == 0:
+        print('No timing records found in {} for {} nights'.format(args.indir, len(nights)))
+        return
+
+    by = dict(stage=('stage',), name=('stage', 'name'), obstype=('stage', 'obstype'))[args.by]
+    summary = timing.summarize(records, by=by)
+
+    #- percentages of the total time, excluding whole-exposure records that
+    #- would double count their steps
+    steps = summary['STAGE'] != 'exposure'
+    total = summary['WALL_TOTAL'][steps].sum()
+    print('{} exposures on {} nights; {:.1f} hours of processing steps'.format(
+        len(filenames), len(set([r['night'] for r in records])), total/3600))
+    print('{:36s} {:>6s} {:>10s} {:>6s} {:>8s} {:>8s} {:>8s} {:>10s} {:>8s}'.format(
+        ' '.join(by).upper(), 'NSTEP', 'WALL[s]', '%', 'P50[s]', 'P90[s]', 'MAX[s]', 'CPU[s]', 'RSS[GB]'))
+    for row in summary:
+        label = ' '.join([str(row[k.upper()]) for k in by if str(row[k.upper()]) != 'None'])
+        pct = 100 * row['WALL_TOTAL'] / total if total > 0 and row['STAGE'] != 'exposure' else 0.0
+        print('{:36s} {:6d} {:10.1f} {:6.1f} {:8.2f} {:8.2f} {:8.2f} {:10.1f} {:8.2f}'.format(
+            label[0:36], row['NSTEP'], row['WALL_TOTAL'], pct, row['WALL_P50'],
+            row['WALL_P90'], row['WALL_MAX'], row['CPU_TOTAL'], row['MAXRSS']/1e9))
+
+    if args.outfile is not None:
+        summary.write(args.outfile, overwrite=True)
+        print('Wrote {}'.format(args.outfile))
+
 def main_assemble_fibermap(options=None):
     parser = argparse.ArgumentParser(usage = "{prog} preproc [options]")
     parser.add_argument("-i", "--infile", type=str, required=True,
@@ -420,31 +695,44 @@ def main_qproc(options=None):
     parser.add_argument("-o", "--outdir", type=str, required=True,
         help="output directory")
     parser.add_argument("--cameras", type=str, help="comma separated list of cameras (for debugging)")
+    parser.add_argument("--qproc-mode", type=str, default="inprocess", choices=run.QPROC_MODES,
+        help="Run qproc within the worker processes or as a desi_qproc subprocess per camera")
+    parser.add_argument("--qproc-timeout", type=str, default="auto",
+        help="Per-camera qproc timeout in seconds, auto (from the timing history of each OBSTYPE), or none")
+    parser.add_argument("--qproc-retries", type=int, default=1,
+        help="Number of times to retry cameras whose qproc timed out")
 
     if options is None:
         options = sys.argv[2:]
 
     args = parser.parse_args(options)
+    workers.configure(args.ncpu)
 
     if args.cameras is not None:
         cameras = args.cameras.split(',')
     else:
         cameras = None
 
-    header = run.run_qproc(args.infile, args.outdir, cameras=cameras, ncpu=args.ncpu)
+    #- standalone qproc outputs aren't in a nightwatch tree with timing
+    #- history, so auto uses the default timeout
+    timeout = timing.parse_qproc_timeout(args.qproc_timeout, args.outdir)
+    header = run.run_qproc(args.infile, args.outdir, cameras=cameras, ncpu=args.ncpu,
+                           mode=args.qproc_mode, timeout=timeout(io.get_raw_exposure(args.infile).obstype),
+                           retries=args.qproc_retries)
     print("Done running qproc on {}; wrote outputs to {}".format(args.infile, args.outdir))
 
 def main_qa(options=None):
     parser = argparse.ArgumentParser(usage = "{prog} qa [options]")
     parser.add_argument("-i", "--indir", type=str, required=True, help="input directory with qproc outputs")
     parser.add_argument("-o", "--outfile", type=str, required=True, help="output qa fits file name")
+    parser.add_argument("--qa-concurrency", type=int, default=4, help="max number of QA classes to run at once")
 
     if options is None:
         options = sys.argv[2:]
 
     args = parser.parse_args(options)
 
-    qaresults = run.run_qa(args.indir, outfile=args.outfile)
+    qaresults = run.run_qa(args.indir, outfile=args.outfile, concurrency=args.qa_concurrency)
     print("Done running QA on {}; wrote outputs to {}".format(args.indir, args.outfile))
 
 def main_plot(options=None):
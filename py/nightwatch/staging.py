@@ -0,0 +1,351 @@
+'''
+Stage exposure outputs on node-local scratch and publish them atomically
+
+qproc, QA, and plots write many files, and writing them directly to a
+shared filesystem (e.g. CFS at NERSC) is slow and lets the webapp and
+other readers see half-written exposures.  ExposureStaging instead writes
+an exposure's outputs to a scratch directory (e.g. /dev/shm or a node-local
+disk) with the same OUTDIR/YEARMMDD/EXPID/ layout, then publishes each
+exposure directory by copying it to a hidden sibling of its final location
+in one bulk copy and renaming it into place.  Readers see either the
+previous version of the exposure directory or the complete new one.
+
+Only exposure directories and files directly in the base directories are
+published; outputs shared by all exposures, e.g. the historyqa/ summary
+database, must be written to the final base directory instead.
+
+Existing outputs for the exposure are copied to scratch first, preserving
+their modification times, so that the per-exposure manifest can still skip
+stages that are up to date.
+
+`benchmark` compares writing a full exposure's worth of files directly to
+the output directory with writing them to scratch and publishing them.
+'''
+
+import os, time
+import shutil
+import tempfile
+
+import desiutil.log
+
+#- environment variable overriding the default scratch directory
+SCRATCH_ENV = 'NIGHTWATCH_SCRATCH'
+
+
+def default_scratch():
+    '''
+    Returns default scratch directory: $NIGHTWATCH_SCRATCH, else /dev/shm
+    if it exists, else $TMPDIR or the system temporary directory
+    '''
+    if SCRATCH_ENV in os.environ:
+        return os.environ[SCRATCH_ENV]
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def in_memory(path, mounts='/proc/mounts'):
+    '''
+    Returns True if path is on a memory-backed filesystem (tmpfs or ramfs),
+    e.g. /dev/shm, whose files count against the node's memory
+
+    Options:
+        mounts : file listing mounted filesystems
+    '''
+    path = os.path.realpath(path)
+    mountpoint, fstype = '', None
+    try:
+        with open(mounts) as fx:
+            for line in fx:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mnt = fields[1].replace('\\040', ' ')
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) \
+                        and len(mnt) > len(mountpoint):
+                    mountpoint, fstype = mnt, fields[2]
+    except OSError:
+        return False
+
+    return fstype in ('tmpfs', 'ramfs')
+
+
+def staged_bytes(basedir, night, expid, plotdir=None, ncameras=30):
+    '''
+    Returns estimated scratch bytes needed to stage one exposure
+
+    Args:
+        basedir : final output base directory
+        night : YEARMMDD
+        expid : exposure ID
+
+    Options:
+        plotdir : final plot base directory; default basedir
+        ncameras : number of cameras to be processed
+
+    This is the size of its existing outputs, which are copied to scratch,
+    or of a full exposure of ncameras (see synthetic_filesizes) if larger.
+    '''
+    existing = 0
+    for base in set([basedir, plotdir or basedir]):
+        expdir = os.path.join(base, str(night), '{:08d}'.format(int(expid)))
+        existing += sum([size for _, size in exposure_filesizes(expdir)])
+
+    expected = sum([size for _, size in synthetic_filesizes(ncameras)])
+    return max(existing, expected)
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _mkdtemp(prefix, dir):
+    '''Like tempfile.mkdtemp, but with normal permissions instead of 0700'''
+    tmpdir = tempfile.mkdtemp(prefix=prefix, dir=dir)
+    os.chmod(tmpdir, 0o777 & ~_umask())
+    return tmpdir
+
+
+def publish_dir(srcdir, destdir):
+    '''
+    Copy srcdir to destdir, replacing any existing destdir
+
+    The copy is written to a hidden temporary directory next to destdir,
+    then renamed into place, so that destdir never contains a partial copy.
+    File modification times are preserved.
+    '''
+    parent = os.path.dirname(os.path.abspath(destdir))
+    os.makedirs(parent, exist_ok=True)
+    name = os.path.basename(os.path.normpath(destdir))
+    tmpdir = _mkdtemp(prefix='.{}.publish-'.format(name), dir=parent)
+    try:
+        shutil.copytree(srcdir, tmpdir, dirs_exist_ok=True)
+        if os.path.exists(destdir):
+            #- rename can't replace a non-empty directory, so move the old
+            #- one aside first; readers only miss it between the two renames
+            olddir = _mkdtemp(prefix='.{}.old-'.format(name), dir=parent)
+            os.rename(destdir, os.path.join(olddir, name))
+            os.rename(tmpdir, destdir)
+            shutil.rmtree(olddir)
+        else:
+            os.rename(tmpdir, destdir)
+    except Exception:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+def publish_file(srcfile, destfile):
+    '''Copy srcfile to destfile via a temporary file and an atomic rename'''
+    os.makedirs(os.path.dirname(os.path.abspath(destfile)), exist_ok=True)
+    tmpfile = '{}.publish-{}'.format(destfile, os.getpid())
+    shutil.copy2(srcfile, tmpfile)
+    os.replace(tmpfile, destfile)
+
+
+class ExposureStaging(object):
+    '''Scratch directories for one exposure's outputs, and their publication'''
+
+    def __init__(self, basedir, night, expid, plotdir=None, scratch=None):
+        '''
+        Args:
+            basedir : final output base directory, i.e. outputs go to
+                basedir/YEARMMDD/EXPID/
+            night : YEARMMDD
+            expid : exposure ID
+
+        Options:
+            plotdir : final plot base directory; default basedir
+            scratch : directory in which to create the staging directory;
+                default from default_scratch()
+
+        After creation, self.basedir and self.plotdir are the scratch
+        equivalents of basedir and plotdir to write outputs to.
+        '''
+        if scratch is None or scratch == 'auto':
+            scratch = default_scratch()
+
+        self.night = int(night)
+        self.expid = int(expid)
+        self.final_basedir = os.path.abspath(basedir)
+        if plotdir is None:
+            plotdir = basedir
+        self.final_plotdir = os.path.abspath(plotdir)
+
+        os.makedirs(scratch, exist_ok=True)
+        self.tmpdir = _mkdtemp(prefix='nightwatch-{:08d}-'.format(self.expid), dir=scratch)
+        self.basedir = os.path.join(self.tmpdir, 'out')
+        if self.final_plotdir == self.final_basedir:
+            self.plotdir = self.basedir
+        else:
+            self.plotdir = os.path.join(self.tmpdir, 'plots')
+
+        self.published = False
+        self.time_publish = None
+
+        #- start from the existing outputs, if any
+        for final, staged in self._expdirs():
+            if os.path.isdir(final):
+                shutil.copytree(final, staged, dirs_exist_ok=True)
+            else:
+                os.makedirs(staged, exist_ok=True)
+
+    def _expdir(self, basedir):
+        return os.path.join(basedir, str(self.night), '{:08d}'.format(self.expid))
+
+    def _expdirs(self):
+        '''Returns list of (final, staged) exposure directories'''
+        pairs = [(self._expdir(self.final_basedir), self._expdir(self.basedir)),]
+        if self.plotdir != self.basedir:
+            pairs.append((self._expdir(self.final_plotdir), self._expdir(self.plotdir)))
+        return pairs
+
+    def publish(self):
+        '''
+        Publish staged exposure directories, plus any files written directly
+        in the staged plot base directory (e.g. qa-lastexp.html), then
+        remove the scratch directory
+        '''
+        if self.published:
+            return
+
+        log = desiutil.log.get_logger()
+        t0 = time.time()
+        nfiles = 0
+        try:
+            for final, staged in self._expdirs():
+                if os.path.isdir(staged):
+                    nfiles += sum([len(files) for _, _, files in os.walk(staged)])
+                    publish_dir(staged, final)
+
+            for base, final_base in set([(self.basedir, self.final_basedir),
+                                         (self.plotdir, self.final_plotdir)]):
+                if not os.path.isdir(base):
+                    continue
+                for name in os.listdir(base):
+                    filename = os.path.join(base, name)
+                    if os.path.isfile(filename):
+                        publish_file(filename, os.path.join(final_base, name))
+                        nfiles += 1
+        finally:
+            self.cleanup()
+
+        self.published = True
+        self.time_publish = time.time() - t0
+        log.info('Published {} files for {}/{:08d} in {:.1f} sec'.format(
+            nfiles, self.night, self.expid, self.time_publish))
+
+    def cleanup(self):
+        '''Remove the scratch directory without publishing'''
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        '''Publish outputs even if processing failed, e.g. for its logs'''
+        self.publish()
+
+    def __repr__(self):
+        return 'ExposureStaging({}/{:08d} in {})'.format(self.night, self.expid, self.tmpdir)
+
+
+def exposure_filesizes(expdir):
+    '''Returns list of (relative path, size) for the files in expdir'''
+    sizes = list()
+    for dirpath, dirnames, files in os.walk(expdir):
+        for name in files:
+            filename = os.path.join(dirpath, name)
+            sizes.append((os.path.relpath(filename, expdir), os.path.getsize(filename)))
+    return sizes
+
+
+def synthetic_filesizes(ncameras=30):
+    '''
+    Returns list of (relative path, size) roughly matching the outputs of
+    a full science exposure
+    '''
+    MB = 1024**2
+    sizes = list()
+    for i in range(ncameras):
+        cam = 'brz'[i % 3] + str(i // 3)
+        sizes.append(('preproc-{}-00000001.fits'.format(cam), 160*MB))
+        for prefix in ('qframe', 'qcframe', 'qsky'):
+            sizes.append(('{}-{}-00000001.fits'.format(prefix, cam), 24*MB))
+        sizes.append(('qproc-{}-00000001.log'.format(cam), 50*1024))
+        sizes.append(('preproc-{}-00000001-4x.html'.format(cam), 2*MB))
+    for name in ('amp', 'camfiber', 'camera', 'spectro', 'summary', 'guide'):
+        sizes.append(('qa-{}-00000001.html'.format(name), 4*MB))
+    sizes.append(('qa-00000001.fits', 8*MB))
+    return sizes
+
+
+def _write_files(expdir, filesizes, chunksize=4*1024**2):
+    '''Write files of the given sizes in expdir, in chunks like FITS writers'''
+    chunk = os.urandom(min(chunksize, max([size for _, size in filesizes] + [1])))
+    for relpath, size in filesizes:
+        filename = os.path.join(expdir, relpath)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as fx:
+            remaining = size
+            while remaining > 0:
+                n = min(remaining, len(chunk))
+                fx.write(chunk[0:n])
+                remaining -= n
+
+
+def benchmark(outdir, scratch=None, filesizes=None, repeat=1):
+    '''
+    Time writing one exposure's outputs directly to outdir vs. staging them
+    in scratch and publishing them to outdir
+
+    Args:
+        outdir : output base directory to benchmark, e.g. on CFS
+
+    Options:
+        scratch : scratch directory; default from default_scratch()
+        filesizes : list of (relative path, size) to write; default
+            synthetic_filesizes()
+        repeat : number of times to repeat each test
+
+    Returns dict with lists of seconds for direct, staged (write to scratch),
+    and published (write to scratch + publish) for each repeat, plus the
+    number of files and bytes per exposure.  The test exposures written to
+    outdir are removed afterwards.
+    '''
+    if filesizes is None:
+        filesizes = synthetic_filesizes()
+
+    results = dict(nfiles=len(filesizes), nbytes=sum([size for _, size in filesizes]),
+                   direct=list(), staged=list(), published=list())
+    night = 20000101
+    for i in range(repeat):
+        expid = 99999000 + i
+        expdir = os.path.join(outdir, str(night), '{:08d}'.format(expid))
+        try:
+            t0 = time.time()
+            _write_files(expdir, filesizes)
+            os.sync()
+            results['direct'].append(time.time() - t0)
+        finally:
+            shutil.rmtree(expdir, ignore_errors=True)
+
+        try:
+            t0 = time.time()
+            staging = ExposureStaging(outdir, night, expid, scratch=scratch)
+            _write_files(staging._expdir(staging.basedir), filesizes)
+            t1 = time.time()
+            staging.publish()
+            os.sync()
+            t2 = time.time()
+            results['staged'].append(t1 - t0)
+            results['published'].append(t2 - t0)
+        finally:
+            shutil.rmtree(expdir, ignore_errors=True)
+
+    nightdir = os.path.join(outdir, str(night))
+    if os.path.isdir(nightdir) and len(os.listdir(nightdir)) == 0:
+        os.rmdir(nightdir)
+
+    return results
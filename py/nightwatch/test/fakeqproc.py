@@ -0,0 +1,40 @@
+'''
+Stand-in for desispec.scripts.qproc in worker processes, for tests
+
+Importing this module, e.g. as a worker preload, replaces
+desispec.scripts.qproc.  $FAKEQPROC lists what qproc does per camera, e.g.
+"b0=crash" kills the process as a segfault in a C extension would, and
+"b0=hang" blocks like C code that no SIGALRM handler interrupts; other
+cameras succeed without writing anything.
+'''
+
+import os, sys, time
+import signal
+import types
+
+def actions():
+    '''Returns dict of camera -> action from $FAKEQPROC'''
+    spec = os.getenv('FAKEQPROC', '')
+    return dict([item.split('=') for item in spec.split(',') if item != ''])
+
+def parse(options):
+    return options
+
+def main(args):
+    camera = args[args.index('--cam')+1]
+    action = actions().get(camera)
+    if action == 'crash':
+        os._exit(1)
+    elif action == 'hang':
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+        time.sleep(60)
+    return 0
+
+qproc = types.ModuleType('desispec.scripts.qproc')
+qproc.parse = parse
+qproc.main = main
+for name in ('read_xytraceset', 'read_fiberflat', 'read_average_flux_calibration'):
+    setattr(qproc, name, None)
+
+import desispec.scripts
+sys.modules['desispec.scripts.qproc'] = desispec.scripts.qproc = qproc
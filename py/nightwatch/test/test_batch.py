@@ -0,0 +1,76 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from nightwatch.batch import ExposurePacker, FakeSbatchBackend, read_packfile
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        self.rawfiles = [os.path.join(self.tmpdir.name, 'raw', '20260101', f'{i:08d}',
+                                      f'desi-{i:08d}.fits.fz') for i in range(10)]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_packing(self):
+        backend = FakeSbatchBackend()
+        packer = ExposurePacker(self.outdir, backend=backend, max_exposures=4,
+                                max_wait=60, concurrent=2, max_time=30)
+        self.assertEqual(packer.pack_size(), 4)
+        for rawfile in self.rawfiles:
+            packer.add(rawfile, now=0)
+            packer.flush(now=1)
+
+        #- two full packs submitted, partial pack waits until idle or max_wait
+        self.assertEqual(len(backend.jobs), 2)
+        self.assertEqual(len(packer.pending), 2)
+        packer.flush(now=30)
+        self.assertEqual(len(backend.jobs), 2)
+        packer.flush(now=61)
+        self.assertEqual(len(backend.jobs), 3)
+
+        packed = list()
+        for job in backend.jobs:
+            packfile = job['directives']['--job-name'] + '.txt'
+            packed.extend(read_packfile(os.path.join(packer.batchdir, packfile)))
+            self.assertTrue(job['directives']['--exclusive'])
+        self.assertEqual(packed, self.rawfiles)
+        self.assertEqual(backend.jobs[0]['directives']['--time'], '12')
+        self.assertEqual(backend.jobs[2]['directives']['--time'], '7')
+
+        #- time limit also caps the pack size
+        packer = ExposurePacker(self.outdir, backend=backend, max_exposures=100,
+                                concurrent=2, max_time=15)
+        self.assertEqual(packer.pack_size(), 4)
+
+    def test_execute(self):
+        #- fake nightwatch command that records its arguments
+        bindir = os.path.join(self.tmpdir.name, 'bin')
+        os.makedirs(bindir)
+        script = os.path.join(bindir, 'nightwatch')
+        with open(script, 'w') as fx:
+            fx.write('#!/bin/bash\necho "$SLURM_JOB_ID $@"\n')
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = bindir + os.pathsep + path
+        try:
+            backend = FakeSbatchBackend(execute=True, first_jobid=42)
+            packer = ExposurePacker(self.outdir, backend=backend, cameras=['b0', 'r0'])
+            packer.add(self.rawfiles[0])
+            self.assertEqual(packer.flush(idle=True), ['42'])
+        finally:
+            os.environ['PATH'] = path
+
+        job = backend.jobs[0]
+        self.assertEqual(job['returncode'], 0)
+        joblog = job['directives']['--output'].replace('%j', '42')
+        with open(joblog) as fx:
+            output = fx.read().split()
+        self.assertEqual(output[0:2], ['42', 'runpack'])
+        self.assertIn('b0,r0', output)
+        self.assertEqual(packer.submitted['42'], self.rawfiles[0:1])
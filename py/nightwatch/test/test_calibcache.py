@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from astropy.io import fits
+
+from nightwatch import calibcache
+from nightwatch.calibcache import CalibCache
+
+class TestCalibCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.nread = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, data, mtime=None):
+        filename = os.path.join(self.tmpdir.name, name)
+        fits.writeto(filename, data, overwrite=True)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def reader(self, filename, scale=1):
+        self.nread += 1
+        return np.array(fits.getdata(filename)) * scale
+
+    def test_cache(self):
+        cache = CalibCache(max_bytes=1e6)
+        filename = self.write('bias-b0.fits', np.ones((10, 10)), mtime=1000)
+        a = cache.get('bias', filename, self.reader)
+        b = cache.get('bias', filename, self.reader)
+        self.assertEqual(self.nread, 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        #- callers get independent copies
+        a[0, 0] = 99
+        c = cache.get('bias', filename, self.reader)
+        self.assertEqual(c[0, 0], 1)
+
+        #- different arguments are different entries
+        d = cache.get('bias', filename, self.reader, scale=2)
+        self.assertEqual(d[0, 0], 2)
+        self.assertEqual(self.nread, 2)
+
+        #- a replaced file is reread and replaces its old entries
+        self.write('bias-b0.fits', np.zeros((10, 10)), mtime=2000)
+        e = cache.get('bias', filename, self.reader)
+        self.assertEqual(e[0, 0], 0)
+        self.assertEqual(self.nread, 3)
+        self.assertEqual(len(cache.entries), 1)
+
+    def test_eviction(self):
+        cache = CalibCache(max_bytes=2000)
+        files = [self.write('mask-b{}.fits'.format(i), np.ones((10, 10))) for i in range(3)]
+        for filename in files:
+            cache.get('mask', filename, self.reader)
+        self.assertLessEqual(cache.nbytes, 2000)
+        self.assertEqual(len(cache.entries), 2)
+
+        #- the least recently used entry was evicted
+        cache.get('mask', files[0], self.reader)
+        self.assertEqual(self.nread, 4)
+
+    def test_memmap(self):
+        filename = self.write('pixflat-b0.fits', np.ones((100, 100), dtype=np.float32))
+        data = calibcache.read_image(filename)
+        self.assertTrue(calibcache._is_memmap(data))
+        self.assertEqual(calibcache._nbytes(data), 0)
+
+        cache = CalibCache(max_bytes=1000)
+        cache.get('pixflat', filename, calibcache.read_image)
+        self.assertEqual(len(cache.entries), 1)
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_wrapper(self):
+        filename = self.write('bias-b0.fits', np.ones((10, 10)))
+        os.environ[calibcache.CACHE_ENV] = '0.001'
+        calibcache._cache = None
+        try:
+            read_bias = calibcache._cached('read_bias', calibcache._image_reader)
+            read_bias(filename=filename)
+            read_bias(filename)
+            self.assertEqual(calibcache.get_cache().stats()['hits'], 1)
+        finally:
+            del os.environ[calibcache.CACHE_ENV]
+            calibcache._cache = None
+
+if __name__ == '__main__':
+    unittest.main()
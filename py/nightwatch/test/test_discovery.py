@@ -0,0 +1,161 @@
+import os
+import time
+import tempfile
+import unittest
+
+from nightwatch import discovery
+from nightwatch.discovery import PollingFinder, InotifyFinder
+
+def inotify_available():
+    try:
+        InotifyFinder(tempfile.gettempdir()).close()
+    except OSError:
+        return False
+    return True
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.indir = os.path.join(self.tmpdir.name, 'raw')
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        os.makedirs(self.indir)
+        os.makedirs(self.outdir)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def expdir(self, night, expid):
+        return os.path.join(self.indir, str(night), f'{expid:08d}')
+
+    def add_exposure(self, night, expid, raw=True):
+        expdir = self.expdir(night, expid)
+        os.makedirs(expdir, exist_ok=True)
+        if raw:
+            with open(os.path.join(expdir, f'desi-{expid:08d}.fits.fz'), 'w') as fx:
+                fx.write('raw')
+        return expdir
+
+    def test_polling(self):
+        self.add_exposure(20260101, 1)
+        self.add_exposure(20260102, 3)
+        self.add_exposure(20260102, 2)
+        self.add_exposure(20260102, 4, raw=False)
+
+        finder = PollingFinder(self.indir)
+        self.assertEqual(finder.latest_expdirs(set()),
+                         [self.expdir(20260102, 2), self.expdir(20260102, 3)])
+        self.assertEqual(finder.next_expdir(set()), self.expdir(20260102, 2))
+        self.assertEqual(finder.next_expdir({self.expdir(20260102, 2)}), self.expdir(20260102, 3))
+
+        #- catchup starts from the earliest night
+        finder = PollingFinder(self.indir, outdir=self.outdir, catchup=True)
+        self.assertEqual(finder.next_expdir(set()), self.expdir(20260101, 1))
+        finder = PollingFinder(self.indir, outdir=self.outdir, catchup=True, startdate=20260102)
+        self.assertEqual(finder.next_expdir(set()), self.expdir(20260102, 2))
+        with self.assertRaises(ValueError):
+            PollingFinder(self.indir, catchup=True)
+
+    def test_get_finder(self):
+        with self.assertRaises(ValueError):
+            discovery.get_finder('blat', self.indir)
+        self.assertIsInstance(discovery.get_finder('poll', self.indir), PollingFinder)
+
+        #- falls back to polling without inotify
+        load_libc = discovery._load_libc
+        discovery._load_libc = lambda: None
+        try:
+            for method in ('auto', 'inotify'):
+                finder = discovery.get_finder(method, self.indir)
+                self.assertIs(type(finder), PollingFinder)
+        finally:
+            discovery._load_libc = load_libc
+
+    def test_read_events(self):
+        #- parse events written to a pipe instead of an inotify fd
+        night = os.path.join(self.indir, '20260101')
+        expdir = self.add_exposure(20260101, 7, raw=False)
+        finder = InotifyFinder.__new__(InotifyFinder)
+        finder.indir = self.indir
+        finder.night = None
+        finder.pending = set()
+        finder.watches = {1: self.indir, 2: night, 3: expdir}
+        finder._last_scan = 0
+        finder._libc = None
+        finder._add_watch = lambda path, mask: finder.watches.setdefault(len(finder.watches)+1, path)
+        rfd, wfd = os.pipe()
+        os.set_blocking(rfd, False)
+        finder.fd = rfd
+
+        def event(wd, mask, name=''):
+            name = os.fsencode(name)
+            if len(name) > 0:
+                name += b'\0' * (16 - len(name) % 16)
+            return discovery._EVENT_HEADER.pack(wd, mask, 0, len(name)) + name
+
+        try:
+            os.write(wfd, event(3, discovery.IN_CREATE, 'desi-00000007.fits.fz') +
+                          event(3, discovery.IN_CLOSE_WRITE, 'other.fits') +
+                          event(9, discovery.IN_CLOSE_WRITE, 'desi-00000009.fits.fz'))
+            finder._read_events()
+            self.assertEqual(finder.pending, set())
+
+            os.write(wfd, event(3, discovery.IN_CLOSE_WRITE, 'desi-00000007.fits.fz'))
+            finder._read_events()
+            self.assertEqual(finder.pending, {expdir})
+
+            #- new exposure directory in the night is watched and checked
+            #- for raw data that landed before the watch
+            expdir8 = self.add_exposure(20260101, 8)
+            os.write(wfd, event(2, discovery.IN_CREATE | discovery.IN_ISDIR, '00000008') +
+                          event(3, discovery.IN_IGNORED) +
+                          event(1, discovery.IN_Q_OVERFLOW))
+            finder._read_events()
+            self.assertEqual(finder.pending, {expdir, expdir8})
+            self.assertIn(expdir8, finder.watches.values())
+            self.assertNotIn(3, finder.watches)
+            self.assertIsNone(finder._last_scan)
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    @unittest.skipUnless(inotify_available(), 'inotify is not available')
+    def test_inotify(self):
+        expdir1 = self.add_exposure(20260101, 1)
+        with InotifyFinder(self.indir, rescan=3600) as finder:
+            self.assertEqual(finder.next_expdir(set()), expdir1)
+            processed = {expdir1}
+            self.assertIsNone(finder.next_expdir(processed))
+
+            #- new exposure in the watched night, then in a new night
+            expdir2 = self.add_exposure(20260101, 2)
+            self.assertEqual(self.wait_for(finder, processed), expdir2)
+            processed.add(expdir2)
+            expdir3 = self.add_exposure(20260102, 3)
+            self.assertEqual(self.wait_for(finder, processed), expdir3)
+            processed.add(expdir3)
+            self.assertEqual(finder.night, '20260102')
+
+            #- deferred exposures are returned again once requeued
+            processed.discard(expdir1)
+            self.assertIsNone(finder.next_expdir(processed))
+            finder.requeue(expdir1)
+            self.assertEqual(finder.next_expdir(processed), expdir1)
+
+            expdir5 = self.add_exposure(20260102, 5)
+            expdir4 = self.add_exposure(20260102, 4)
+            self.wait_for(finder, processed | {expdir1})
+            finder.requeue(expdir1)
+            self.assertEqual(finder.latest_expdirs(processed), [expdir1, expdir4, expdir5])
+
+    def wait_for(self, finder, processed, timeout=5):
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            finder.wait(0.1)
+            expdir = finder.next_expdir(processed)
+            if expdir is not None:
+                return expdir
+        return None
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import stat
+import time
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from nightwatch.pipeline import ExposureJob
+from nightwatch.executors import DryRunExecutor, SubprocessExecutor, estimate_cost, \
+    QPROC_CAMERA_COST, EXPOSURE_COST
+
+class TestExecutors(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        self.rawfiles = list()
+        for expid in (1, 2):
+            expdir = os.path.join(self.tmpdir.name, 'raw', '20260101', f'{expid:08d}')
+            os.makedirs(expdir)
+            rawfile = os.path.join(expdir, f'desi-{expid:08d}.fits.fz')
+            with fitsio.FITS(rawfile, 'rw') as fx:
+                fx.write(None, header=dict(EXPID=expid))
+                for camera in ('B0', 'R0', 'Z0'):
+                    fx.write(np.zeros((4, 4), dtype=np.int16), extname=camera,
+                             header=dict(OBSTYPE='ARC' if expid == 1 else 'ZERO'))
+            self.rawfiles.append(rawfile)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_dryrun(self):
+        cost = estimate_cost(self.rawfiles[0])
+        self.assertEqual(cost['obstype'], 'ARC')
+        self.assertEqual(cost['ncameras'], 3)
+        self.assertEqual(cost['core_seconds'], 3*QPROC_CAMERA_COST['ARC'] + EXPOSURE_COST)
+        self.assertEqual(estimate_cost(self.rawfiles[1], cameras=['b0'])['ncameras'], 1)
+
+        outfile = os.path.join(self.tmpdir.name, 'dryrun.jsonl')
+        executor = DryRunExecutor(outfile=outfile, ncpu=2)
+        for rawfile in self.rawfiles:
+            executor.submit(ExposureJob(rawfile, self.outdir))
+        executor.close()
+
+        stats = executor.stats()
+        self.assertEqual(stats['submitted'], 2)
+        self.assertEqual(stats['finished'], 0)
+        self.assertEqual(len(open(outfile).readlines()), 2)
+        self.assertFalse(os.path.exists(self.outdir))
+
+    def test_subprocess(self):
+        #- fake nightwatch that fails for expid 2
+        bindir = os.path.join(self.tmpdir.name, 'bin')
+        os.makedirs(bindir)
+        script = os.path.join(bindir, 'nightwatch')
+        with open(script, 'w') as fx:
+            fx.write('#!/bin/bash\necho "$@"\n[[ "$@" != *00000002* ]]\n')
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+
+        done = list()
+        path = os.environ['PATH']
+        os.environ['PATH'] = bindir + os.pathsep + path
+        try:
+            executor = SubprocessExecutor(on_done=done.append, max_running=1, ncpu=3)
+            for rawfile in self.rawfiles:
+                executor.submit(ExposureJob(rawfile, self.outdir, cameras=['b0']))
+            self.assertEqual(len(executor.running), 1)
+            executor.close()
+        finally:
+            os.environ['PATH'] = path
+
+        self.assertTrue(executor.idle())
+        self.assertEqual([job.expid for job in done], ['00000001', '00000002'])
+        self.assertFalse(done[0].failed)
+        self.assertTrue(done[1].failed)
+        self.assertEqual(executor.stats()['failed'], 1)
+        with open(os.path.join(done[0].outdir, 'nightwatch-run-00000001.log')) as fx:
+            args = fx.read().split()
+        self.assertEqual(args[0], 'run')
+        self.assertIn('--ncpu', args)
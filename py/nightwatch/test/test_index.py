@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+
+from nightwatch import run
+from nightwatch.index import ExposureIndex, PROCESSED, FAILED, NORAW
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.indir = os.path.join(self.tmpdir.name, 'raw')
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        for night, expid in [(20260101, 1), (20260101, 2), (20260102, 3)]:
+            expdir = os.path.join(self.indir, str(night), f'{expid:08d}')
+            os.makedirs(expdir)
+            open(os.path.join(expdir, f'desi-{expid:08d}.fits.fz'), 'w').close()
+
+        os.makedirs(os.path.join(self.indir, '20260101', '00000009'))
+        self.index = ExposureIndex(os.path.join(self.outdir, 'index.db'))
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def expdir(self, night, expid):
+        return os.path.join(self.indir, str(night), f'{expid:08d}')
+
+    def test_record(self):
+        self.index.record(20260101, 1, PROCESSED, mtime=1.0)
+        self.assertEqual(self.index.get(20260101, 1), (PROCESSED, 1.0))
+        self.assertIsNone(self.index.get(20260101, 2))
+        self.assertEqual(self.index.done_expdirs(self.indir),
+                         {self.expdir(20260101, 1)})
+        with self.assertRaises(ValueError):
+            self.index.record(20260101, 1, 'blat')
+
+    def test_failed(self):
+        rawfile = os.path.join(self.expdir(20260101, 1), 'desi-00000001.fits.fz')
+        self.index.record(20260101, 1, FAILED, mtime=os.path.getmtime(rawfile))
+        self.assertTrue(self.index.is_done(20260101, 1, rawfile))
+        self.assertNotIn(self.expdir(20260101, 1), self.index.done_expdirs(self.indir))
+
+        #- updated raw file should be retried
+        os.utime(rawfile, (0, 0))
+        self.assertFalse(self.index.is_done(20260101, 1, rawfile))
+
+        self.assertEqual(self.index.reset_failed(), 1)
+        self.assertIsNone(self.index.get(20260101, 1))
+
+    def test_find_unprocessed(self):
+        processed = set()
+        expdir = run.find_unprocessed_expdir(self.indir, self.outdir, processed, index=self.index)
+        self.assertEqual(expdir, self.expdir(20260101, 1))
+
+        self.index.record(20260101, 1, PROCESSED)
+        self.index.record(20260101, 2, PROCESSED)
+        expdir = run.find_unprocessed_expdir(self.indir, self.outdir, processed, index=self.index)
+        self.assertEqual(expdir, self.expdir(20260102, 3))
+        self.assertEqual(self.index.get(20260101, 9)[0], NORAW)
+
+        #- first night is now complete and can be skipped without listing it
+        nightdir = os.path.join(self.indir, '20260101')
+        self.assertEqual(self.index.night_mtime(20260101), os.path.getmtime(nightdir))
+
+        processed.add(expdir)
+        self.assertIsNone(run.find_unprocessed_expdir(self.indir, self.outdir, processed, index=self.index))
+
+    def test_late_raw(self):
+        #- raw data arriving in an expdir indexed without raw data is found
+        #- even though the night was complete and its mtime is unchanged
+        processed = set()
+        for night, expid in [(20260101, 1), (20260101, 2), (20260102, 3)]:
+            self.index.record(night, expid, PROCESSED)
+        self.assertIsNone(run.find_unprocessed_expdir(self.indir, self.outdir, processed, index=self.index))
+        nightdir = os.path.join(self.indir, '20260101')
+        self.assertEqual(self.index.night_mtime(20260101), os.path.getmtime(nightdir))
+
+        expdir = self.expdir(20260101, 9)
+        open(os.path.join(expdir, 'desi-00000009.fits.fz'), 'w').close()
+        mtime = self.index.get(20260101, 9)[1]
+        os.utime(expdir, (mtime + 10, mtime + 10))
+        self.assertEqual(self.index.night_mtime(20260101), os.path.getmtime(nightdir))
+        self.assertEqual(run.find_unprocessed_expdir(self.indir, self.outdir, processed, index=self.index),
+                         expdir)
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from nightwatch import io, run
+
+class TestRawExposure(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rawfile = os.path.join(self.tmpdir.name, 'desi-00000123.fits.fz')
+        self.write(['Z1', 'B0', 'R0'])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, cameras):
+        with fitsio.FITS(self.rawfile, 'rw', clobber=True) as fx:
+            fx.write(None)
+            fx.write(np.zeros((2, 2), dtype=np.int16), extname='SPEC',
+                     header=dict(NIGHT=20260101, EXPID=123, OBSTYPE='science ',
+                                 PROGRAM='dark tile', TILEID=1000))
+            for camera in cameras:
+                fx.write(np.zeros((4, 4), dtype=np.int16), extname=camera)
+
+    def test_raw_exposure(self):
+        raw = io.get_raw_exposure(self.rawfile)
+        self.assertEqual(raw.cameras, ['b0', 'r0', 'z1'])
+        self.assertEqual((raw.night, raw.expid), (20260101, 123))
+        self.assertEqual(raw.obstype, 'SCIENCE')
+        self.assertEqual(raw.program, 'dark tile')
+        self.assertEqual(raw.tileid, 1000)
+        self.assertEqual(io.get_night_expid(self.rawfile), (20260101, 123))
+        self.assertEqual(run.which_cameras(raw), raw.cameras)
+
+        #- cached until the file changes
+        self.assertIs(io.get_raw_exposure(self.rawfile), raw)
+        self.assertIs(io.get_raw_exposure(raw), raw)
+        self.write(['B0'])
+        os.utime(self.rawfile, (1, 1))
+        self.assertEqual(io.get_raw_exposure(self.rawfile).cameras, ['b0'])
@@ -0,0 +1,73 @@
+import os
+import json
+import tempfile
+import unittest
+
+from nightwatch.manifest import ExposureManifest, DONE, FAILED
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.infile = os.path.join(self.tmpdir.name, 'in.fits')
+        self.outfile = os.path.join(self.tmpdir.name, 'out.fits')
+        self.filename = os.path.join(self.tmpdir.name, 'manifest-00000001.json')
+        self.write(self.infile, 'input')
+        self.nrun = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, filename, contents):
+        with open(filename, 'w') as fx:
+            fx.write(contents)
+
+    def stage(self):
+        self.nrun += 1
+        self.write(self.outfile, 'output')
+
+    def test_skip_unchanged(self):
+        manifest = ExposureManifest(self.filename)
+        self.assertTrue(manifest.run_stage('qa', [self.infile], self.stage, [self.outfile]))
+        self.assertEqual(manifest.status('qa'), DONE)
+
+        #- rereading the manifest skips the stage
+        manifest = ExposureManifest(self.filename)
+        self.assertFalse(manifest.run_stage('qa', [self.infile], self.stage, [self.outfile]))
+        self.assertEqual(self.nrun, 1)
+
+        #- changed input, missing output, or force reruns it
+        self.write(self.infile, 'new input')
+        self.assertTrue(manifest.run_stage('qa', [self.infile], self.stage, [self.outfile]))
+        os.remove(self.outfile)
+        self.assertTrue(manifest.run_stage('qa', [self.infile], self.stage, [self.outfile]))
+        manifest = ExposureManifest(self.filename, force=True)
+        self.assertTrue(manifest.run_stage('qa', [self.infile], self.stage, [self.outfile]))
+        self.assertEqual(self.nrun, 4)
+
+    def test_failed(self):
+        manifest = ExposureManifest(self.filename)
+        def fail():
+            raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            manifest.run_stage('qa', [self.infile], fail, [self.outfile])
+        self.assertEqual(manifest.status('qa'), FAILED)
+
+        #- no output is also a failure, and failed stages are rerun
+        manifest.run_stage('qa', [self.infile], lambda: None, [self.outfile])
+        self.assertEqual(manifest.status('qa'), FAILED)
+        self.assertTrue(manifest.run_stage('qa', [self.infile], self.stage, [self.outfile]))
+        self.assertEqual(manifest.status('qa'), DONE)
+
+    def test_versions(self):
+        manifest = ExposureManifest(self.filename)
+        manifest.run_stage('qa', [self.infile], self.stage, [self.outfile])
+        with open(self.filename) as fx:
+            data = json.load(fx)
+        data['versions']['nightwatch'] = 'old'
+        with open(self.filename, 'w') as fx:
+            json.dump(data, fx)
+
+        manifest = ExposureManifest(self.filename)
+        self.assertIsNone(manifest.status('qa'))
@@ -0,0 +1,81 @@
+import unittest
+
+import numpy as np
+from astropy.table import Table, MaskedColumn, join
+
+from nightwatch.qa import merge
+
+KEYS = ['NIGHT', 'EXPID', 'SPECTRO', 'CAM', 'FIBER']
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tables = list()
+        for i, name in enumerate(['A', 'B', 'C']):
+            rows = [(20260101, 7, spectro, cam, fiber)
+                    for spectro in range(3) for cam in 'BRZ' for fiber in range(20)]
+            #- each table has a different subset of the rows, in random order
+            keep = rng.permutation(len(rows))[0:len(rows)*2//3]
+            t = Table(rows=[rows[j] for j in keep], names=KEYS)
+            t['FIBER'] += 500*t['SPECTRO']
+            t[name] = rng.normal(size=len(t))
+            t[name+'_INT'] = rng.randint(0, 100, size=len(t)).astype(np.int32)
+            t[name+'_VEC'] = rng.normal(size=(len(t), 2))
+            self.tables.append(t)
+
+    def assertSameTable(self, a, b):
+        self.assertEqual(a.colnames, b.colnames)
+        self.assertEqual(len(a), len(b))
+        for name in a.colnames:
+            self.assertEqual(a[name].dtype, b[name].dtype, name)
+            ma = np.ma.getmaskarray(a[name])
+            mb = np.ma.getmaskarray(b[name])
+            self.assertTrue(np.all(ma == mb), name)
+            self.assertTrue(np.all(np.asarray(a[name])[~ma] == np.asarray(b[name])[~mb]), name)
+            self.assertEqual(isinstance(a[name], MaskedColumn), isinstance(b[name], MaskedColumn), name)
+
+    def join_all(self, tables, keys):
+        tx = tables[0]
+        for t in tables[1:]:
+            tx = join(tx, t, keys=keys, join_type='outer')
+        return tx
+
+    def test_merge(self):
+        result = merge.dense_merge(self.tables, KEYS)
+        self.assertSameTable(result, self.join_all(self.tables, KEYS))
+
+        #- sparse key combinations use sorted slots instead of occupancy
+        maxslots = merge.MAX_SLOTS_PER_ROW
+        merge.MAX_SLOTS_PER_ROW = 0
+        try:
+            result = merge.dense_merge(self.tables, KEYS)
+        finally:
+            merge.MAX_SLOTS_PER_ROW = maxslots
+        self.assertSameTable(result, self.join_all(self.tables, KEYS))
+
+        #- fully overlapping tables have no masked columns
+        a = self.tables[0]
+        b = a[['NIGHT', 'EXPID', 'SPECTRO', 'CAM', 'FIBER']]
+        b['D'] = np.arange(len(b))
+        self.assertSameTable(merge.merge([a, b], KEYS), self.join_all([a, b], KEYS))
+
+    def test_fallback(self):
+        #- duplicate keys and shared column names are left to astropy join
+        a, b = self.tables[0], self.tables[1]
+        dup = Table(b[0:2])
+        dup['FIBER'] = a['FIBER'][0]
+        dup['SPECTRO'] = a['SPECTRO'][0]
+        dup['CAM'] = a['CAM'][0]
+        with self.assertRaises(merge.MergeFallback):
+            merge.dense_merge([a, dup], KEYS)
+        self.assertSameTable(merge.merge([a, dup], KEYS), self.join_all([a, dup], KEYS))
+
+        shared = Table(b)
+        shared.rename_column('B', 'A')
+        with self.assertRaises(merge.MergeFallback):
+            merge.dense_merge([a, shared], KEYS)
+        self.assertEqual(len(merge.merge([a, shared], KEYS)), len(self.join_all([a, shared], KEYS)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+
+from nightwatch.qa import noisecorr
+
+class TestNoiseCorr(unittest.TestCase):
+
+    def setUp(self):
+        #- noise correlated with the next row, plus a few hot pixels
+        rng = np.random.RandomState(0)
+        self.img = rng.normal(scale=3.0, size=(300, 200)).astype(np.float32) + 100
+        self.img[1:] += 0.5*(self.img[:-1] - 100)
+        self.img[rng.uniform(size=self.img.shape) < 1e-3] += 1000
+
+    def test_median(self):
+        c1 = noisecorr.corr(self.img, 4, 4, nrand=5000)
+        c2 = noisecorr.corr(self.img, 4, 4, nrand=5000)
+        self.assertEqual(c1.shape, (4, 4))
+        self.assertTrue(np.all(c1 == c2))
+        self.assertEqual(c1[0, 0], 1.0)
+        self.assertGreater(c1[1, 0], 0.1)
+        self.assertLess(abs(c1[0, 1]), 0.1)
+
+        #- all lags at once match one lag at a time on the same sample
+        tmp = (self.img - 100) / 3.0
+        c = noisecorr._median_corr(tmp, 3, 2, 1000, 1)
+        rng = np.random.RandomState(1)
+        ii0 = rng.choice(300-3, size=1000)
+        ii1 = rng.choice(200-2, size=1000)
+        for i0 in range(3):
+            for i1 in range(2):
+                expected = np.median(tmp[ii0, ii1]*tmp[ii0+i0, ii1+i1])
+                self.assertAlmostEqual(c[i0, i1], expected, places=5)
+
+        c8 = noisecorr.corr(self.img, 8, 8, nrand=5000)
+        self.assertEqual(c8.shape, (8, 8))
+
+    def test_fft(self):
+        c = noisecorr.corr(self.img, 8, 8, method='fft')
+        self.assertEqual(c.shape, (8, 8))
+        self.assertEqual(c[0, 0], 1.0)
+
+        #- matches a direct sum over the clipped pixels
+        mean, rms = noisecorr.calc_overscan(self.img, nsigma=5, niter=3)
+        tmp = (self.img - mean) / rms
+        good = np.abs(tmp) < 5
+        tmp[~good] = 0
+        n0, n1 = tmp.shape
+        for i0, i1 in [(1, 0), (0, 1), (3, 5)]:
+            num = np.sum(tmp[:n0-i0, :n1-i1]*tmp[i0:, i1:])
+            npairs = np.sum(good[:n0-i0, :n1-i1] & good[i0:, i1:])
+            direct = (num/npairs) / (np.sum(tmp**2)/np.sum(good))
+            self.assertAlmostEqual(c[i0, i1], direct, places=4)
+
+        #- lag-1 correlation of x[i] + 0.5*x[i-1] is 0.5/1.25
+        self.assertAlmostEqual(c[1, 0], 0.4, delta=0.05)
+
+        with self.assertRaises(ValueError):
+            noisecorr.corr(self.img, method='mean')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+
+from nightwatch.pipeline import ExposureJob, ExposurePipeline, STAGES
+
+class QARunnerStub(object):
+    def forget(self, indir):
+        pass
+
+class StagingStub(object):
+    '''Records when a job's staged outputs are published'''
+    def __init__(self, job, record):
+        self.job = job
+        self.record = record
+        self.published = False
+    def publish(self):
+        self.record('publish', self.job)
+        self.published = True
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.indir = os.path.join(self.tmpdir.name, 'raw')
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        self.calls = list()
+        self.lock = threading.Lock()
+        self.done = list()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def job(self, expid):
+        rawfile = os.path.join(self.indir, '20260101', f'{expid:08d}', f'desi-{expid:08d}.fits.fz')
+        job = ExposureJob(rawfile, self.outdir)
+        job.staging = StagingStub(job, self.record)
+        return job
+
+    def record(self, name, jobs):
+        if isinstance(jobs, ExposureJob):
+            jobs = [jobs,]
+        with self.lock:
+            self.calls.append((name, [int(job.expid) for job in jobs]))
+
+    def pipeline(self, **kwargs):
+        pipeline = ExposurePipeline(QARunnerStub(), on_done=self.done.append, **kwargs)
+        for name in STAGES:
+            pipeline.funcs[name] = lambda jobs, name=name: self.record(name, jobs)
+        return pipeline
+
+    def wait_until(self, condition, timeout=5):
+        t0 = time.time()
+        while not condition() and time.time() - t0 < timeout:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_stages(self):
+        #- each exposure passes through every stage in order
+        with self.pipeline() as pipeline:
+            for expid in (1, 2, 3):
+                pipeline.submit(self.job(expid))
+        self.assertEqual(sorted([int(job.expid) for job in self.done]), [1, 2, 3])
+        for expid in (1, 2, 3):
+            names = [name for name, expids in self.calls if expid in expids]
+            self.assertEqual(names, ['qproc', 'qa', 'plots', 'publish', 'tables'])
+        self.assertFalse(any([job.failed for job in self.done]))
+
+    def test_backpressure(self):
+        #- submit blocks once the queue in front of qproc is full
+        started = threading.Event()
+        release = threading.Event()
+        def run_qproc(job):
+            started.set()
+            release.wait()
+        pipeline = self.pipeline(queue_size=1)
+        pipeline.funcs['qproc'] = run_qproc
+        try:
+            pipeline.submit(self.job(1))
+            self.assertTrue(started.wait(5))
+            pipeline.submit(self.job(2))
+            submitter = threading.Thread(target=pipeline.submit, args=(self.job(3),))
+            submitter.start()
+            submitter.join(0.2)
+            self.assertTrue(submitter.is_alive())
+            self.assertFalse(pipeline.idle())
+        finally:
+            release.set()
+            pipeline.close()
+        submitter.join(5)
+        self.assertFalse(submitter.is_alive())
+        self.assertEqual(len(self.done), 3)
+        self.assertTrue(pipeline.idle())
+
+    def test_coalesce_tables(self):
+        #- exposures waiting for the tables stage are written together
+        started = threading.Event()
+        release = threading.Event()
+        def run_tables(jobs):
+            self.record('tables', jobs)
+            started.set()
+            release.wait()
+        pipeline = self.pipeline(queue_size=2)
+        pipeline.funcs['tables'] = run_tables
+        try:
+            pipeline.submit(self.job(1))
+            self.assertTrue(started.wait(5))
+            pipeline.submit(self.job(2))
+            pipeline.submit(self.job(3))
+            self.wait_until(lambda: pipeline.queues[-1].qsize() == 2)
+        finally:
+            release.set()
+            pipeline.close()
+        tables = [expids for name, expids in self.calls if name == 'tables']
+        self.assertEqual(tables, [[1,], [2, 3]])
+        self.assertEqual(len(self.done), 3)
+
+    def test_failure(self):
+        #- a failed exposure skips later stages but is still published
+        def run_qa(job):
+            if job.expid == '00000002':
+                raise RuntimeError('bad QA')
+            self.record('qa', job)
+        for serial in (True, False):
+            self.calls = list()
+            self.done = list()
+            with self.pipeline(serial=serial) as pipeline:
+                pipeline.funcs['qa'] = run_qa
+                for expid in (1, 2):
+                    pipeline.submit(self.job(expid))
+
+            self.assertEqual(len(self.done), 2)
+            failed = [job for job in self.done if job.failed]
+            self.assertEqual(len(failed), 1)
+            self.assertEqual(failed[0].expid, '00000002')
+            self.assertEqual(failed[0].failed_stage, 'qa')
+            self.assertEqual(str(failed[0].error), 'bad QA')
+            names = [name for name, expids in self.calls if 2 in expids]
+            self.assertEqual(names, ['qproc', 'publish'])
+            names = [name for name, expids in self.calls if 1 in expids]
+            self.assertEqual(names, ['qproc', 'qa', 'plots', 'publish', 'tables'])
+
+if __name__ == '__main__':
+    unittest.main()
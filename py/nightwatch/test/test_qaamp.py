@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+import scipy.ndimage
+
+from desispec.maskbits import ccdmask
+
+from nightwatch.qa.amp import QAAmp, cosmics_plane, get_ccd_dicos
+
+class TestQAAmp(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        self.mask = rng.randint(0, 2**12, size=(40, 60)).astype(np.int32)
+        self.mask[rng.uniform(size=self.mask.shape) < 0.8] &= ~ccdmask.COSMIC
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_cosmics_plane(self):
+        expected = (self.mask & ccdmask.COSMIC) != 0
+        for mask in (self.mask, self.mask.astype('>i4'), self.mask.astype(np.int16),
+                     self.mask[:, 10:30]):
+            plane = cosmics_plane(mask)
+            self.assertEqual(plane.dtype, np.uint8)
+            self.assertEqual(plane.shape, mask.shape)
+            self.assertTrue(np.all((plane != 0) == ((mask & ccdmask.COSMIC) != 0)))
+
+        structure = np.ones((3, 3))
+        nexpected = scipy.ndimage.label(expected, structure=structure)[1]
+        self.assertEqual(QAAmp().count_cosmics(self.mask), nexpected)
+
+    def test_ccd_dicos(self):
+        header = dict(NIGHT=20260101, EXPID=1, CAMERA='b0', EXPTIME=60.0, DIGITIME=60.0)
+        for i, amp in enumerate('ABC'):
+            header['BIASSEC'+amp] = '[1:10,1:10]'
+            header['OBSRDN'+amp] = 3.0 + i
+            header['OVERSCN'+amp] = 1000.0 + i
+        filename = os.path.join(self.tmpdir.name, 'preproc-b0-00000001.fits')
+        fitsio.write(filename, np.zeros((40, 60), dtype=np.float32), extname='IMAGE',
+                     header=header)
+        fitsio.write(filename, self.mask, extname='MASK')
+
+        qa = QAAmp()
+        rows = get_ccd_dicos(qa, filename)
+        self.assertEqual([r['AMP'] for r in rows], ['A', 'B', 'C'])
+        self.assertEqual(rows[2]['READNOISE'], 5.0)
+
+        #- each amp counts cosmics in its own quadrant, per minute
+        ncosmics = qa.count_cosmics(self.mask[20:, 0:30])
+        self.assertAlmostEqual(rows[2]['COSMICS_RATE'], ncosmics/1.5)
+
+        table = qa.run(self.tmpdir.name)
+        self.assertEqual(list(table['AMP']), ['A', 'B', 'C'])
+
+if __name__ == '__main__':
+    unittest.main()
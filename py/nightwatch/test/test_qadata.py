@@ -0,0 +1,92 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import fitsio
+
+from nightwatch.qa.data import ExposureData
+from nightwatch.qa.traceshift import QATraceShift
+from nightwatch.qa.psf import QAPSF
+
+class TestExposureData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.indir = self.tmpdir.name
+        header = [dict(name='NIGHT', value=20260101), dict(name='EXPID', value=1),
+                  dict(name='CAMERA', value='b0')]
+        header += [dict(name=k, value=0.1) for k in
+                   ['MEANDX', 'MINDX', 'MAXDX', 'MEANDY', 'MINDY', 'MAXDY']]
+        self.psffile = os.path.join(self.indir, 'psf-b0-00000001.fits')
+        fitsio.write(self.psffile, np.zeros(1), header=header)
+        xsig = np.arange(20.0).reshape(10, 2)
+        fitsio.write(self.psffile, xsig, extname='XSIG')
+        table = np.zeros(10, dtype=[('FIBER', 'i4'), ('FLUX', 'f4')])
+        table['FIBER'] = np.arange(10)
+        fitsio.write(self.psffile, table, extname='FIBERMAP')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_memoized(self):
+        data = ExposureData(self.indir)
+        self.assertEqual(data.files('psf'), [self.psffile])
+        self.assertEqual(data.files('psf', 'r0'), [])
+
+        xsig = data.read(self.psffile, 'XSIG')
+        self.assertIs(data.read(self.psffile, 'XSIG'), xsig)
+        self.assertEqual(data.header(self.psffile)['CAMERA'], 'b0')
+        data.header(self.psffile)
+        self.assertEqual(data.nread, 2)
+        self.assertEqual(data.nhits, 2)
+
+        #- selections of a loaded product don't read again
+        self.assertTrue(np.all(data.read(self.psffile, 'XSIG', rows=slice(2, 4)) == xsig[2:4]))
+        self.assertEqual(data.nread, 2)
+
+        #- otherwise only the selection is read
+        fibers = data.read(self.psffile, 'FIBERMAP', rows=[1, 3], columns=['FIBER'])
+        self.assertEqual(list(fibers['FIBER']), [1, 3])
+        self.assertEqual(fibers.dtype.names, ('FIBER',))
+        rows = data.read(self.psffile, 'XSIG', rows=slice(2, 4))
+        self.assertEqual(data.nread, 3)
+
+        data2 = ExposureData(self.indir)
+        rows = data2.read(self.psffile, 'XSIG', rows=slice(2, 4))
+        self.assertTrue(np.all(rows == xsig[2:4]))
+
+    def test_eviction(self):
+        data = ExposureData(self.indir, max_bytes=200)
+        data.read(self.psffile, 'XSIG')       #- 160 bytes
+        data.read(self.psffile, 'FIBERMAP')   #- 80 bytes, evicts XSIG
+        self.assertLessEqual(data.nbytes, 200)
+        self.assertEqual(len(data.products), 1)
+        data.read(self.psffile, 'XSIG')
+        self.assertEqual(data.nread, 3)
+
+    def test_threads(self):
+        data = ExposureData(self.indir)
+        results = list()
+        threads = [threading.Thread(target=lambda: results.append(data.read(self.psffile, 'XSIG')))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(data.nread, 1)
+
+    def test_qa(self):
+        #- QA classes reading through the same ExposureData share reads
+        data = ExposureData(self.indir)
+        a = QATraceShift().run(self.indir, data=data)
+        b = QAPSF().run(self.indir, camera='b0', data=data)
+        self.assertEqual(len(a), 1)
+        self.assertAlmostEqual(b['MAXXSIG'][0], 18.0)
+        self.assertEqual(data.nread, 2)
+        self.assertEqual(list(QAPSF().run(self.indir)['MAXXSIG']), list(b['MAXXSIG']))
+
+if __name__ == '__main__':
+    unittest.main()
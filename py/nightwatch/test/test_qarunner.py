@@ -0,0 +1,144 @@
+import os
+import glob
+import time
+import itertools
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+from astropy.table import Table
+
+from nightwatch import workers
+from nightwatch.qa.base import QA, stack_columns
+from nightwatch.qa.runner import QARunner, run_camera_qa
+
+class QASlow(QA):
+    '''Slow QA finishing last'''
+    def __init__(self):
+        self.output_type = 'PER_CAMERA'
+    def valid_obstype(self, obstype):
+        return True
+    def run(self, indir, camera=None):
+        time.sleep(0.3)
+        return Table(dict(NIGHT=[20260101], EXPID=[1], SPECTRO=[0], CAM=['B'], SLOW=[1.0]))
+
+class QAFast(QA):
+    '''Fast QA finishing first'''
+    def __init__(self):
+        self.output_type = 'PER_CAMERA'
+    def valid_obstype(self, obstype):
+        return True
+    def run(self, indir, camera=None):
+        time.sleep(0.1)
+        return Table(dict(NIGHT=[20260101], EXPID=[1], SPECTRO=[0], CAM=['B'], FAST=[2.0]))
+
+class QABlock(QA):
+    '''QA returning a columnar block instead of a Table'''
+    def __init__(self):
+        self.output_type = 'PER_CAMERA'
+    def valid_obstype(self, obstype):
+        return True
+    def run(self, indir, camera=None):
+        return dict(NIGHT=np.array([20260101]), EXPID=np.array([1]), SPECTRO=np.array([0]),
+                    CAM=np.array(['B']), BLOCK=np.array([3.0]))
+
+class QACamera(QA):
+    '''Per-camera QA with one row per camera'''
+    per_camera = True
+    def __init__(self):
+        self.output_type = 'PER_CAMERA'
+    def valid_obstype(self, obstype):
+        return True
+    def run(self, indir, camera=None):
+        if camera is None:
+            preprocfiles = sorted(glob.glob(os.path.join(indir, 'preproc-*.fits')))
+            cameras = [os.path.basename(f).split('-')[1] for f in preprocfiles]
+        else:
+            cameras = [camera,]
+        return Table(dict(NIGHT=[20260101]*len(cameras), EXPID=[1]*len(cameras),
+                          SPECTRO=[int(c[1]) for c in cameras],
+                          CAM=[c[0].upper() for c in cameras],
+                          X=[float(ord(c[0]) + int(c[1])) for c in cameras]))
+
+class QABroken(QA):
+    def __init__(self):
+        self.output_type = 'PER_EXP'
+    def valid_obstype(self, obstype):
+        return True
+    def run(self, indir, camera=None):
+        raise RuntimeError('broken QA')
+
+class QASkipped(QABroken):
+    def valid_obstype(self, obstype):
+        return False
+
+class TestQARunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        header = [dict(name='OBSTYPE', value='ZERO'), dict(name='FLAVOR', value='ZERO')]
+        fitsio.write(os.path.join(self.tmpdir.name, 'preproc-b0-00000001.fits'),
+                     np.zeros((2, 2)), header=header)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_concurrent(self):
+        qalist = (QASlow, QABroken, QASkipped, QAFast)
+        serial = QARunner(qalist).run(self.tmpdir.name)
+
+        #- QA threads are limited by the worker pool size; pretend it is 4
+        get_ncpu = workers.get_ncpu
+        workers.get_ncpu = lambda: 4
+        try:
+            t0 = time.time()
+            results = QARunner(qalist, concurrency=4).run(self.tmpdir.name)
+            dt = time.time() - t0
+        finally:
+            workers.get_ncpu = get_ncpu
+        self.assertLess(dt, 0.35)
+
+        #- failures are isolated and results are merged in qalist order
+        self.assertEqual(list(results.keys()), ['PER_CAMERA'])
+        self.assertEqual(results['PER_CAMERA'].colnames, serial['PER_CAMERA'].colnames)
+        self.assertEqual(results['PER_CAMERA'].colnames[-2:], ['SLOW', 'FAST'])
+
+    def test_blocks(self):
+        results = QARunner((QASlow, QABlock)).run(self.tmpdir.name)
+        self.assertEqual(results['PER_CAMERA']['BLOCK'][0], 3.0)
+        self.assertEqual(results['PER_CAMERA']['SLOW'][0], 1.0)
+
+        a = dict(CAM=np.array(['B', 'R']), X=np.array([1.0, 2.0]))
+        b = Table(dict(CAM=['Z'], Y=[3]))
+        stacked = stack_columns([a, None, b])
+        self.assertEqual(list(stacked.keys()), ['CAM', 'X', 'Y'])
+        self.assertEqual(list(stacked['CAM']), ['B', 'R', 'Z'])
+        self.assertTrue(np.isnan(stacked['X'][2]))
+        self.assertEqual(list(stacked['Y']), [0, 0, 3])
+        self.assertIsNone(stack_columns([None]))
+
+    def test_streamed(self):
+        #- per-camera results streamed in any order (imap_unordered), or not
+        #- at all for some cameras, combine to the serial results
+        header = [dict(name='OBSTYPE', value='ZERO'), dict(name='FLAVOR', value='ZERO')]
+        cameras = ['b0', 'r0', 'z1']
+        for cam in cameras[1:]:
+            fitsio.write(os.path.join(self.tmpdir.name, f'preproc-{cam}-00000001.fits'),
+                         np.zeros((2, 2)), header=header)
+        serial = QARunner((QACamera,)).run(self.tmpdir.name)['PER_CAMERA']
+        self.assertEqual(list(serial['CAM']), ['B', 'R', 'Z'])
+
+        camera_results = {cam: run_camera_qa(self.tmpdir.name, cam, [QACamera]) for cam in cameras}
+        for n in (3, 2):
+            for order in itertools.permutations(cameras, n):
+                qarunner = QARunner((QACamera,))
+                for cam in order:
+                    qarunner.add_camera_results(self.tmpdir.name, cam, camera_results[cam])
+                results = qarunner.run(self.tmpdir.name)['PER_CAMERA']
+                self.assertEqual(results.colnames, serial.colnames)
+                for name in serial.colnames:
+                    self.assertEqual(list(results[name]), list(serial[name]), order)
+
+if __name__ == '__main__':
+    unittest.main()
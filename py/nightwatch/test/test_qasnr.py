@@ -0,0 +1,104 @@
+import unittest
+
+import numpy as np
+import astropy.units as u
+from astropy.table import Table
+
+from desispec.interpolation import resample_flux
+from desispec.io.filters import load_legacy_survey_filter
+
+from nightwatch.qa import snr
+from nightwatch.qa.snr import QASNR, FluxResampler
+
+class FakeQFrame(object):
+    def __init__(self, wave, flux, ivar, meta, fibermap):
+        self.wave, self.flux, self.ivar = wave, flux, ivar
+        self.meta, self.fibermap = meta, fibermap
+
+def make_qasnr():
+    '''QASNR without the desimodel data needed by its __init__'''
+    qa = QASNR.__new__(QASNR)
+    qa.output_type = "PER_FIBER"
+    qa.thru_conversion_wavelength = 6000
+    qa.thru_conversion_factor_ergs_per_cm2 = 1e-3
+    qa.filters = dict()
+    for photsys in ["N", "S"]:
+        for band in ["G", "R", "Z"]:
+            qa.filters[band+photsys] = load_legacy_survey_filter(band=band, photsys=photsys)
+    qa.rwave = np.linspace(3300.0, 11100.0, 7800)
+    return qa
+
+class TestQASNR(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def spectra(self, nspec, wmin, wmax, nwave):
+        #- slightly different wavelength grid per fiber, some masked pixels
+        wave = np.linspace(wmin, wmax, nwave)[None, :] + self.rng.uniform(-0.5, 0.5, size=(nspec, 1))
+        flux = 5 + self.rng.normal(size=(nspec, nwave))
+        ivar = self.rng.uniform(0.5, 2, size=(nspec, nwave))
+        ivar[self.rng.uniform(size=ivar.shape) < 0.05] = 0
+        return wave, flux, ivar
+
+    def test_resampler(self):
+        wave, flux, ivar = self.spectra(5, 3600.0, 5900.0, 2800)
+        xout = np.linspace(3500.0, 6000.0, 2400)[100:2300]
+        outflux, outivar = FluxResampler(xout, wave)(flux, ivar)
+        for i in range(5):
+            f, w = resample_flux(xout, wave[i], flux[i], ivar[i])
+            self.assertTrue(np.allclose(outflux[i], f, rtol=1e-8, atol=1e-10))
+            self.assertTrue(np.allclose(outivar[i], w, rtol=1e-8, atol=1e-10))
+
+    def test_maggies(self):
+        qa = make_qasnr()
+        lo, hi, w = snr.ab_maggies_weights(qa.filters['GS'], qa.rwave)
+        fluxunits = 1e-17 * u.erg / u.s / u.cm**2 / u.Angstrom
+        rflux = self.rng.uniform(0, 10, size=qa.rwave.size)
+        rflux[:lo] = rflux[hi:] = 0
+        expected = qa.filters['GS'].get_ab_maggies(rflux*fluxunits, qa.rwave)
+        self.assertAlmostEqual(rflux[lo:hi].dot(w)/expected, 1.0, places=10)
+
+    def test_batched(self):
+        qa = make_qasnr()
+        nfiber = 8
+        fmap = Table()
+        fmap['FIBER'] = np.arange(nfiber) + 500
+        for band in ['G', 'R', 'Z']:
+            fmap['FLUX_'+band] = np.linspace(1, 50, nfiber).astype(np.float32)
+        fmap['MORPHTYPE'] = ['PSF', 'REX', '', '', 'DEV', 'EXP', '', 'PSF']
+        fmap['OBJTYPE'] = ['TGT', 'TGT', 'SKY', 'TGT', 'TGT', 'TGT', 'TGT', 'SKY']
+        fmap['PHOTSYS'] = ['N', 'S', 'S', 'N', '', 'S', 'N', 'S']
+        stars = np.array([0, 0, 0, 1, 0, 0, 0, 0], dtype=bool)
+        qsos = np.zeros(nfiber, dtype=bool)
+
+        meta = dict(CALVALUE=2.0, CALWAVE=5000.0, EXPTIME=900.0)
+        qframes = dict()
+        for cam, (wmin, wmax, nwave) in dict(B=(3600.0, 5900.0, 2800), R=(5700.0, 7700.0, 2500),
+                                             Z=(7500.0, 9800.0, 2800)).items():
+            qframes[cam] = FakeQFrame(*self.spectra(nfiber, wmin, wmax, nwave), meta=meta, fibermap=fmap)
+        qframes['R'].meta = dict()  #- no calibration for R
+
+        iiband = dict()
+        for c, qframe in qframes.items():
+            iiband[c] = (qframe.wave[0][0] < qa.rwave) & (qa.rwave < qframe.wave[0][-1])
+
+        args = (iiband, qframes, fmap, 20260101, 1, 5, stars, qsos)
+        batched = snr.get_spectro_table(qa, *args)
+        rows = [snr.get_dico(qa, iiband, snr.get_fiber_data(qframes, fmap, f, fiber, *args[3:]))
+                for f, fiber in enumerate(fmap['FIBER'])]
+        reference = Table(rows)
+
+        self.assertEqual(batched.colnames, reference.colnames)
+        self.assertEqual(list(batched['MORPHTYPE']),
+                         ['PSF', 'REX', 'SKY', 'PSF', 'DEV', 'EXP', 'OTHER', 'SKY'])
+        for name in batched.colnames:
+            if name == 'MORPHTYPE':
+                continue
+            self.assertTrue(np.allclose(batched[name], reference[name], rtol=1e-6, atol=1e-9), name)
+        self.assertTrue(np.all(batched['SPECFLUX_G'][[0, 1, 2]] > 0))
+        self.assertEqual(batched['SPECFLUX_G'][4], 0)
+        self.assertTrue(np.all(batched['THRU_R'] == 0))
+
+if __name__ == '__main__':
+    unittest.main()
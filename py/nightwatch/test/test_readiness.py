@@ -0,0 +1,121 @@
+import os
+import time
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from nightwatch import readiness
+from nightwatch.readiness import ReadinessChecker, check_hdu_index, FITS_BLOCK
+
+class FakeTime(object):
+    '''Replaces the time module in nightwatch.readiness'''
+    def __init__(self):
+        self.now = time.time()
+    def time(self):
+        return self.now
+
+class TestReadiness(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.expdir = os.path.join(self.tmpdir.name, '20260101', '00000001')
+        os.makedirs(self.expdir)
+        self.rawfile = os.path.join(self.expdir, 'desi-00000001.fits.fz')
+        self.clock = FakeTime()
+        self._time = readiness.time
+        readiness.time = self.clock
+
+    def tearDown(self):
+        readiness.time = self._time
+        self.tmpdir.cleanup()
+
+    def write_raw(self, filename=None):
+        if filename is None:
+            filename = self.rawfile
+        fitsio.write(filename, np.zeros((100, 100), dtype='f4'), clobber=True)
+        fitsio.write(filename, np.ones((10, 10), dtype='f4'), extname='B0')
+        return os.path.getsize(filename)
+
+    def truncate(self, filesize):
+        with open(self.rawfile, 'r+b') as fx:
+            fx.truncate(filesize)
+
+    def test_check_hdu_index(self):
+        filesize = self.write_raw()
+        self.assertEqual(filesize % FITS_BLOCK, 0)
+        self.assertTrue(check_hdu_index(self.rawfile))
+        self.assertTrue(check_hdu_index(self.rawfile, filesize=filesize))
+
+        #- truncated in the last HDU, but still a whole number of blocks
+        self.truncate(filesize - FITS_BLOCK)
+        self.assertFalse(check_hdu_index(self.rawfile))
+
+        #- not a whole number of blocks
+        self.write_raw()
+        self.truncate(filesize - 1)
+        self.assertFalse(check_hdu_index(self.rawfile))
+        self.truncate(0)
+        self.assertFalse(check_hdu_index(self.rawfile))
+
+        #- not FITS at all
+        with open(self.rawfile, 'wb') as fx:
+            fx.write(b'x' * FITS_BLOCK)
+        self.assertFalse(check_hdu_index(self.rawfile))
+
+    def test_settle(self):
+        checker = ReadinessChecker(settle=5, timeout=None)
+        self.assertEqual(checker.check(self.rawfile), (False, 'missing'))
+
+        self.write_raw()
+        self.clock.now = time.time() + 1
+        ready, reason = checker.check(self.rawfile)
+        self.assertFalse(ready)
+        self.assertTrue(reason.startswith('still being written'))
+
+        self.clock.now += 10
+        self.assertEqual(checker.check(self.rawfile), (True, None))
+
+        #- a truncated file isn't ready even once settled
+        self.truncate(FITS_BLOCK)
+        self.clock.now = time.time() + 10
+        self.assertEqual(checker.check(self.rawfile), (False, 'incomplete HDU index'))
+
+        #- without HDU checks only the stat matters
+        checker = ReadinessChecker(settle=5, check_hdus=False, timeout=None)
+        self.assertEqual(checker.check(self.rawfile), (True, None))
+
+    def test_companions(self):
+        self.write_raw()
+        self.clock.now = time.time() + 10
+        checker = ReadinessChecker(settle=5, timeout=None,
+                                   companions=['coordinates-{expid}.fits', 'guide-*.fits.fz'])
+        ready, reason = checker.check(self.rawfile)
+        self.assertFalse(ready)
+        self.assertEqual(reason, 'missing coordinates-00000001.fits, guide-*.fits.fz')
+
+        self.write_raw(os.path.join(self.expdir, 'coordinates-00000001.fits'))
+        self.assertEqual(checker.check(self.rawfile), (False, 'missing guide-*.fits.fz'))
+        self.write_raw(os.path.join(self.expdir, 'guide-00000001.fits.fz'))
+        self.assertEqual(checker.check(self.rawfile), (True, None))
+
+    def test_timeout(self):
+        self.write_raw()
+        self.truncate(FITS_BLOCK)
+        self.clock.now = time.time() + 10
+        checker = ReadinessChecker(settle=5, timeout=60)
+        self.assertEqual(checker.check(self.rawfile), (False, 'incomplete HDU index'))
+
+        #- declared ready anyway once the timeout passes
+        self.clock.now += 61
+        ready, reason = checker.check(self.rawfile)
+        self.assertTrue(ready)
+        self.assertEqual(reason, 'timed out waiting for completion: incomplete HDU index')
+
+        #- forgetting the file restarts the timeout
+        checker.forget(self.rawfile)
+        self.assertEqual(checker.check(self.rawfile), (False, 'incomplete HDU index'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from nightwatch import resources
+from nightwatch.resources import CPUBudget
+
+class TestResources(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, filename, contents):
+        filename = os.path.join(self.root, filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as fx:
+            fx.write(contents + '\n')
+
+    def test_cgroup_v2(self):
+        self.assertIsNone(resources.cgroup_cpus(self.root))
+        self.write('cpu.max', 'max 100000')
+        self.assertIsNone(resources.cgroup_cpus(self.root))
+        self.write('cpu.max', '250000 100000')
+        self.assertEqual(resources.cgroup_cpus(self.root), 3)
+        self.write('memory.max', 'max')
+        self.assertIsNone(resources.cgroup_memory(self.root))
+        self.write('memory.max', '8000000000')
+        self.assertEqual(resources.cgroup_memory(self.root), 8000000000)
+
+    def test_cgroup_v1(self):
+        self.write('cpu/cpu.cfs_quota_us', '-1')
+        self.write('cpu/cpu.cfs_period_us', '100000')
+        self.assertIsNone(resources.cgroup_cpus(self.root))
+        self.write('cpu/cpu.cfs_quota_us', '400000')
+        self.assertEqual(resources.cgroup_cpus(self.root), 4)
+        self.write('memory/memory.limit_in_bytes', str(2**63 - 4096))
+        self.assertIsNone(resources.cgroup_memory(self.root))
+
+    def test_slurm(self):
+        self.assertIsNone(resources.slurm_cpus(dict(SLURM_CPUS_ON_NODE='8')))
+        env = dict(SLURM_JOB_ID='1', SLURM_CPUS_ON_NODE='8', SLURM_MEM_PER_CPU='1024')
+        self.assertEqual(resources.slurm_cpus(env), 8)
+        self.assertEqual(resources.slurm_memory(env), 8 * 1024**3)
+        env['SLURM_CPUS_PER_TASK'] = '2'
+        self.assertEqual(resources.slurm_cpus(env), 2)
+
+    def test_budget(self):
+        self.write('cpu.max', '200000 100000')
+        env = dict()
+        budget = CPUBudget(memory=16e9, task_memory=2e9, cgroup_root=self.root, environ=env)
+        self.assertEqual(budget.cpus, min(2, resources.affinity_cpus()))
+        self.assertLessEqual(budget.ncpu(), budget.cpus)
+        self.assertEqual(budget.ncpu(100), budget.cpus)
+
+        #- memory limits workers
+        budget = CPUBudget(ncpu=64, memory=16e9, task_memory=2e9, cache_memory=0, environ=env)
+        self.assertEqual(budget.ncpu(32), 8)
+        self.assertEqual(budget.ncpu(4), 4)
+        self.assertEqual(budget.ncpu(32, task_memory=1e9), 16)
+
+        #- each worker's calibration cache counts too
+        budget = CPUBudget(ncpu=64, memory=16e9, task_memory=1.5e9, cache_memory=0.5e9, environ=env)
+        self.assertEqual(budget.worker_memory(), 2e9)
+        self.assertEqual(budget.ncpu(32), 8)
+
+        #- NERSC login nodes
+        env['NERSC_HOST'] = 'perlmutter'
+        budget = CPUBudget(ncpu=64, memory=1e12, environ=env)
+        self.assertEqual(budget.ncpu(32), 8)
+        self.assertEqual(budget.worker_environ()['OMP_NUM_THREADS'], '1')
+
+    def test_reserve(self):
+        budget = CPUBudget(ncpu=4, memory=10e9, task_memory=1.5e9, cache_memory=0.5e9, environ=dict())
+        self.assertEqual(budget.reserve(1e9, nworkers=4), 1e9)
+        self.assertEqual(budget.reserve(0.5e9, nworkers=4), 0.5e9)
+
+        #- a third reservation waits until the 2 GB left by the workers is free
+        reserved = threading.Event()
+        def reserve():
+            budget.reserve(1e9, nworkers=4)
+            reserved.set()
+        t = threading.Thread(target=reserve)
+        t.start()
+        self.assertFalse(reserved.wait(0.2))
+        budget.release(1e9)
+        self.assertTrue(reserved.wait(5))
+        t.join()
+        self.assertEqual(budget.reserved, 1.5e9)
+
+        #- one oversized reservation is granted when nothing else is reserved
+        budget.release(1.5e9)
+        self.assertEqual(budget.reserve(20e9, nworkers=4), 20e9)
+        budget.release(20e9)
+
+        #- unknown memory isn't reserved
+        budget.memory = None
+        self.assertEqual(budget.reserve(1e9, nworkers=4), 0)
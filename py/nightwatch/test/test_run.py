@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import time
+import types
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from nightwatch import run, workers
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_deadline(self):
+        #- the timeout isn't swallowed by `except Exception` in the block
+        t0 = time.time()
+        with self.assertRaises(run.QprocTimeout):
+            with run.deadline(0.1):
+                while time.time() - t0 < 5:
+                    try:
+                        time.sleep(0.01)
+                    except Exception:
+                        pass
+        self.assertLess(time.time() - t0, 1)
+
+        with run.deadline(None):
+            time.sleep(0.01)
+
+    def test_redirect_output(self):
+        #- stdout and stderr are restored when the wrapped code raises
+        def fdstat(fd):
+            st = os.fstat(fd)
+            return (st.st_dev, st.st_ino)
+        before = (fdstat(1), fdstat(2))
+        nfds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+
+        logfile = os.path.join(self.tmpdir.name, 'log.txt')
+        with open(logfile, 'w') as logfx:
+            with self.assertRaises(RuntimeError):
+                with run.redirect_output(logfx):
+                    os.write(1, b'out\n')
+                    os.write(2, b'err\n')
+                    raise RuntimeError('qproc failed')
+
+        self.assertEqual((fdstat(1), fdstat(2)), before)
+        if nfds is not None:
+            self.assertEqual(len(os.listdir('/proc/self/fd')), nfds)
+        with open(logfile) as fx:
+            self.assertEqual(fx.read(), 'out\nerr\n')
+
+    def test_qproc_timeout(self):
+        #- qproc catching every Exception is still stopped at its deadline
+        def main(args):
+            t0 = time.time()
+            while time.time() - t0 < 5:
+                try:
+                    time.sleep(0.01)
+                except Exception:
+                    pass
+            return 0
+
+        qproc = types.ModuleType('desispec.scripts.qproc')
+        qproc.parse = lambda options: options
+        qproc.main = main
+        import desispec.scripts
+        saved = sys.modules.get('desispec.scripts.qproc'), getattr(desispec.scripts, 'qproc', None)
+        sys.modules['desispec.scripts.qproc'] = desispec.scripts.qproc = qproc
+        install = run.calibcache.install
+        run.calibcache.install = lambda: None
+        try:
+            logfile = os.path.join(self.tmpdir.name, 'qproc-b0-00000001.log')
+            err = run.run_qproc_camera(['--cam', 'b0'], logfile, 'qproc b0', timeout=0.1)
+        finally:
+            run.calibcache.install = install
+            if saved[0] is None:
+                del sys.modules['desispec.scripts.qproc']
+                del desispec.scripts.qproc
+            else:
+                sys.modules['desispec.scripts.qproc'], desispec.scripts.qproc = saved
+
+        self.assertEqual(err, {'qproc-b0-00000001.log': run.TIMEOUT_ERRORCODE})
+
+    def write_raw(self, cameras):
+        rawfile = os.path.join(self.tmpdir.name, 'desi-00000001.fits.fz')
+        header = [dict(name='NIGHT', value=20260101), dict(name='EXPID', value=1),
+                  dict(name='OBSTYPE', value='ZERO')]
+        fitsio.write(rawfile, np.zeros((2, 2)), header=header)
+        for camera in cameras:
+            fitsio.write(rawfile, np.zeros((2, 2)), extname=camera.upper())
+        return rawfile
+
+    def run_qproc_pool(self, fakeqproc, cameras, **kwargs):
+        '''
+        Run run.run_qproc in a pool of two workers with fakeqproc in place of
+        desispec qproc in the workers; returns the errorcodes it writes
+        '''
+        rawfile = self.write_raw(cameras)
+        outdir = os.path.join(self.tmpdir.name, 'out')
+        environ = os.environ.copy()
+        get_ncpu = run.get_ncpu
+        os.environ['FAKEQPROC'] = fakeqproc
+        run.get_ncpu = lambda ncpu: 2 if ncpu is None else ncpu
+        workers.shutdown()
+        workers.configure(ncpu=2, start_method='spawn', preload=['nightwatch.test.fakeqproc'])
+        try:
+            run.run_qproc(rawfile, outdir, ncpu=2, mode='inprocess', **kwargs)
+        finally:
+            workers.shutdown()
+            workers.configure(ncpu=None, preload=workers.PRELOAD)
+            run.get_ncpu = get_ncpu
+            os.environ.clear()
+            os.environ.update(environ)
+
+        with open(os.path.join(outdir, 'errorcodes-00000001.txt')) as fx:
+            return json.load(fx)
+
+    def test_worker_lost(self):
+        #- a camera whose worker dies is rerun as a subprocess, where the
+        #- crash is contained, instead of hanging the exposure
+        errorcodes = self.run_qproc_pool('b0=crash', ['b0', 'r0'])
+        self.assertEqual(errorcodes['qproc-r0-00000001.log'], 0)
+        self.assertNotIn(errorcodes['qproc-b0-00000001.log'],
+                         (0, run.WORKER_LOST_ERRORCODE))
+        with open(os.path.join(self.tmpdir.name, 'out', 'qproc-b0-00000001.log')) as fx:
+            self.assertIn('RUNNING desi_qproc', fx.read())
+
+    def test_worker_timeout(self):
+        #- qproc blocked where its SIGALRM deadline can't stop it is killed
+        #- by the parent and dropped like any other timeout
+        grace = run.QPROC_KILL_GRACE
+        run.QPROC_KILL_GRACE = 0.5
+        try:
+            errorcodes = self.run_qproc_pool('b0=hang', ['b0', 'r0'], timeout=0.5)
+        finally:
+            run.QPROC_KILL_GRACE = grace
+        self.assertEqual(errorcodes['qproc-b0-00000001.log'], run.TIMEOUT_ERRORCODE)
+        self.assertIn('qproc-b0-00000001.log', errorcodes[run.DROPPED_KEY])
+        with open(os.path.join(self.tmpdir.name, 'out', 'qproc-b0-00000001.log')) as fx:
+            self.assertIn('KILLED: Worker killed after', fx.read())
+
+if __name__ == '__main__':
+    unittest.main()
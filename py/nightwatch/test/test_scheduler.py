@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+
+from nightwatch.discovery import PollingFinder
+from nightwatch.scheduler import ExposureScheduler, parse_priorities
+
+class FakeFinder(object):
+    '''Returns a fixed list of live exposures'''
+    def __init__(self, indir, live=()):
+        self.indir = indir
+        self.startdate = None
+        self.live = list(live)
+        self.requeued = list()
+    def latest_expdirs(self, processed):
+        return [e for e in self.live if e not in processed]
+    def requeue(self, expdir):
+        self.requeued.append(expdir)
+    def close(self):
+        pass
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.indir = os.path.join(self.tmpdir.name, 'raw')
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        os.makedirs(self.indir)
+        os.makedirs(self.outdir)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def expdir(self, night, expid):
+        return os.path.join(self.indir, str(night), f'{expid:08d}')
+
+    def test_parse_priorities(self):
+        self.assertEqual(parse_priorities(None), dict())
+        self.assertEqual(parse_priorities(' '), dict())
+        self.assertEqual(parse_priorities('science=0, ARC=1,*=5'),
+                         {'SCIENCE':0, 'ARC':1, '*':5})
+        for spec in ('SCIENCE', 'SCIENCE=x', 'SCIENCE=0,', 'A=1=2'):
+            with self.assertRaises(ValueError):
+                parse_priorities(spec)
+
+    def test_priority(self):
+        sched = ExposureScheduler(FakeFinder(self.indir), priorities=parse_priorities('SCIENCE=0,ARC=2'))
+        a, b, c = [self.expdir(20260101, i) for i in (1, 2, 3)]
+        sched._obstypes.update({a: 'SCIENCE', b: 'ARC', c: 'ZERO'})
+        self.assertEqual(sched.priority(a), 0)
+        self.assertEqual(sched.priority(b), 2)
+        #- unlisted OBSTYPEs go after the listed ones, or get the * priority
+        self.assertEqual(sched.priority(c), 3)
+        sched.priorities['*'] = 1
+        self.assertEqual(sched.priority(c), 1)
+
+        #- unreadable raw data gets the default priority
+        d = self.expdir(20260101, 4)
+        self.assertEqual(sched.priority(d), 1)
+        self.assertIsNone(sched._obstypes[d])
+
+        #- without priorities everything is equal
+        self.assertEqual(ExposureScheduler(FakeFinder(self.indir)).priority(a), 0)
+
+    def test_sortkey(self):
+        live = [self.expdir(20260101, 10), self.expdir(20260101, 11),
+                self.expdir(20260101, 12), self.expdir(20251231, 13)]
+        finder = FakeFinder(self.indir, live)
+        sched = ExposureScheduler(finder, priorities=parse_priorities('SCIENCE=0,ARC=1'))
+        sched._obstypes.update({live[0]: 'SCIENCE', live[1]: 'SCIENCE',
+                                live[2]: 'ARC', live[3]: 'SCIENCE'})
+
+        #- priority first, then newest night and exposure first
+        self.assertEqual(sorted(live, key=sched._sortkey),
+                         [live[1], live[0], live[3], live[2]])
+        processed = set()
+        order = list()
+        while True:
+            expdir = sched.next_expdir(processed)
+            if expdir is None:
+                break
+            order.append(expdir)
+            processed.add(expdir)
+        self.assertEqual(order, [live[1], live[0], live[3], live[2]])
+
+        #- cached OBSTYPEs are dropped once processed
+        self.assertEqual(sched._obstypes, dict())
+
+    def test_backfill(self):
+        with self.assertRaises(ValueError):
+            ExposureScheduler(FakeFinder(self.indir), backfill=True)
+
+        for night, expid in ((20251231, 1), (20260101, 2)):
+            expdir = self.expdir(night, expid)
+            os.makedirs(expdir)
+            with open(os.path.join(expdir, f'desi-{expid:08d}.fits.fz'), 'w') as fx:
+                fx.write('raw')
+
+        #- live exposures come first, then the oldest unprocessed exposure
+        live = self.expdir(20260101, 2)
+        finder = FakeFinder(self.indir, [live,])
+        sched = ExposureScheduler(finder, outdir=self.outdir, backfill=True)
+        self.assertEqual(sched.next_expdir(set()), live)
+        self.assertEqual(sched.next_expdir({live,}), self.expdir(20251231, 1))
+        self.assertIsNone(sched.next_expdir({live, self.expdir(20251231, 1)}))
+
+        #- without backfill only live exposures are returned
+        sched = ExposureScheduler(finder, outdir=self.outdir)
+        self.assertIsNone(sched.next_expdir({live,}))
+
+        sched.requeue(live)
+        self.assertEqual(finder.requeued, [live,])
+
+    def test_catchup(self):
+        #- with --catchup the whole tree is processed oldest first before
+        #- live exposures are ordered by priority
+        for night, expid in ((20251231, 1), (20260101, 2)):
+            expdir = self.expdir(night, expid)
+            os.makedirs(expdir)
+            with open(os.path.join(expdir, f'desi-{expid:08d}.fits.fz'), 'w') as fx:
+                fx.write('raw')
+
+        finder = PollingFinder(self.indir, outdir=self.outdir, catchup=True)
+        sched = ExposureScheduler(finder, priorities=parse_priorities('SCIENCE=0'))
+        self.assertEqual(sched.next_expdir(set()), self.expdir(20251231, 1))
+        processed = {self.expdir(20251231, 1)}
+        self.assertEqual(sched.next_expdir(processed), self.expdir(20260101, 2))
+
+        #- once catchup is done, the live night is scheduled
+        finder.catchup = False
+        self.assertEqual(sched.next_expdir(set()), self.expdir(20260101, 2))
+
+if __name__ == '__main__':
+    unittest.main()
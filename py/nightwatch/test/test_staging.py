@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+from astropy.table import Table
+
+from nightwatch import staging
+from nightwatch.staging import ExposureStaging
+from nightwatch.manifest import ExposureManifest
+from nightwatch.pipeline import ExposureJob, ExposurePipeline
+from nightwatch.qa import runner
+from nightwatch.qa.base import QA
+
+class QAStub(QA):
+    def __init__(self):
+        self.output_type = 'PER_CAMERA'
+    def valid_obstype(self, obstype):
+        return True
+    def run(self, indir, camera=None):
+        return Table(dict(NIGHT=[20260101], EXPID=[1], SPECTRO=[0], CAM=['B'], X=[1.0]))
+
+class FakeSummaryDB(object):
+    '''Records which QA files were added to the summary DB file'''
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+    def write_exposure_to_db(self, fitsfile):
+        with open(self.dbfile, 'a') as fx:
+            fx.write(os.path.basename(fitsfile) + '\n')
+
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outdir = os.path.join(self.tmpdir.name, 'out')
+        self.scratch = os.path.join(self.tmpdir.name, 'scratch')
+        self.expdir = os.path.join(self.outdir, '20260101', '00000001')
+        self.rawfile = os.path.join(self.tmpdir.name, 'desi-00000001.fits.fz')
+        self.write(self.rawfile, 'raw')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, filename, contents):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as fx:
+            fx.write(contents)
+
+    def stage(self, name, contents):
+        staging = ExposureStaging(self.outdir, 20260101, 1, scratch=self.scratch)
+        stagedir = os.path.join(staging.basedir, '20260101', '00000001')
+        manifest = ExposureManifest(os.path.join(stagedir, 'manifest-00000001.json'))
+        outfile = os.path.join(stagedir, name)
+        ran = manifest.run_stage(name, [self.rawfile],
+                                 lambda: self.write(outfile, contents), [outfile])
+        self.write(os.path.join(staging.basedir, 'qa-lastexp.html'), contents)
+        return staging, ran
+
+    def test_publish(self):
+        staging, ran = self.stage('a.txt', 'first')
+        self.assertTrue(ran)
+        self.assertFalse(os.path.exists(self.expdir))
+        staging.publish()
+        self.assertFalse(os.path.exists(staging.tmpdir))
+        with open(os.path.join(self.expdir, 'a.txt')) as fx:
+            self.assertEqual(fx.read(), 'first')
+        self.assertTrue(os.path.exists(os.path.join(self.outdir, 'qa-lastexp.html')))
+
+        #- restaging starts from the published outputs, so the manifest
+        #- still considers the first stage current
+        staging, ran = self.stage('a.txt', 'second')
+        self.assertFalse(ran)
+        staging.publish()
+
+        #- new outputs are added, and no temporary directories are left
+        with ExposureStaging(self.outdir, 20260101, 1, scratch=self.scratch) as staging:
+            self.write(os.path.join(staging.basedir, '20260101', '00000001', 'b.txt'), 'b')
+        self.assertEqual(sorted(os.listdir(self.expdir)),
+                         ['a.txt', 'b.txt', 'manifest-00000001.json'])
+        self.assertEqual(os.listdir(os.path.dirname(self.expdir)), ['00000001'])
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_historyqa(self):
+        #- the summary QA DB is shared by all exposures, so it goes to the
+        #- final basedir instead of being staged and discarded
+        rawfile = os.path.join(self.tmpdir.name, 'raw', '20260101', '00000001', 'desi-00000001.fits.fz')
+        job = ExposureJob(rawfile, self.outdir, cameras=['b0'], scratch=self.scratch)
+
+        #- nothing is staged until processing starts
+        self.assertFalse(os.path.exists(self.scratch))
+        self.assertTrue(job.outdir.startswith(self.outdir))
+        job.stage()
+        self.assertTrue(job.outdir.startswith(self.scratch))
+        os.makedirs(job.outdir, exist_ok=True)
+        header = [dict(name='OBSTYPE', value='ZERO'), dict(name='FLAVOR', value='ZERO')]
+        fitsio.write(os.path.join(job.outdir, 'preproc-b0-00000001.fits'), np.zeros((2, 2)), header=header)
+
+        pipeline = ExposurePipeline(runner.QARunner([QAStub]), serial=True)
+        SummaryDB = runner.SQLiteSummaryDB
+        runner.SQLiteSummaryDB = FakeSummaryDB
+        try:
+            pipeline.run_qa(job)
+        finally:
+            runner.SQLiteSummaryDB = SummaryDB
+        pipeline._publish(job)
+
+        dbfile = os.path.join(self.outdir, 'historyqa', 'nightwatch_summary_qa.db')
+        with open(dbfile) as fx:
+            self.assertEqual(fx.read(), 'qa-00000001.fits\n')
+        self.assertTrue(os.path.exists(os.path.join(self.expdir, 'qa-00000001.fits')))
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_in_memory(self):
+        mounts = os.path.join(self.tmpdir.name, 'mounts')
+        self.write(mounts, '\n'.join(['/dev/sda1 / ext4 rw 0 0',
+                                      'tmpfs /dev/shm tmpfs rw 0 0',
+                                      'none /dev/shm/disk ext4 rw 0 0']))
+        self.assertTrue(staging.in_memory('/dev/shm', mounts))
+        self.assertTrue(staging.in_memory('/dev/shm/nightwatch', mounts))
+        self.assertFalse(staging.in_memory('/dev/shm/disk/x', mounts))
+        self.assertFalse(staging.in_memory('/dev/shmem', mounts))
+        self.assertFalse(staging.in_memory('/tmp', mounts))
+
+        #- existing outputs count if larger than a full exposure
+        full = staging.staged_bytes(self.outdir, 20260101, 1, ncameras=1)
+        self.write(os.path.join(self.expdir, 'a.txt'), 'x'*100)
+        self.assertEqual(staging.staged_bytes(self.outdir, 20260101, 1, ncameras=1), full)
+        with open(os.path.join(self.expdir, 'big.fits'), 'w') as fx:
+            fx.truncate(full)
+        self.assertEqual(staging.staged_bytes(self.outdir, 20260101, 1, ncameras=1), full+100)
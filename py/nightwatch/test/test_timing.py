@@ -0,0 +1,108 @@
+import os
+import time
+import tempfile
+import unittest
+
+import numpy as np
+
+from nightwatch import run, timing
+from nightwatch.timing import ExposureTimer, QprocDeadlines
+
+class TestTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.outdir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def timer(self, night, expid, obstype='SCIENCE'):
+        filename = os.path.join(self.outdir, str(night), '{:08d}'.format(expid),
+                                'timing-{:08d}.json'.format(expid))
+        return ExposureTimer(filename, night, expid, obstype=obstype)
+
+    def test_measure(self):
+        with timing.measure() as usage:
+            time.sleep(0.05)
+            sum(range(100000))
+        self.assertGreaterEqual(usage['wall'], 0.05)
+        self.assertGreater(usage['cpu'], 0.0)
+        self.assertGreater(usage['maxrss'], 0)
+
+    def test_failed_step(self):
+        timer = self.timer(20260101, 1)
+        with self.assertRaises(ValueError):
+            with timer.time('qa', 'QAFail'):
+                raise ValueError('boom')
+        self.assertEqual(len(timer.records), 1)
+        self.assertFalse(timer.records[0]['ok'])
+        self.assertIn('wall', timer.records[0])
+
+        #- no timer is a no-op
+        with timing.timed(None, 'qa', 'QAAmp'):
+            pass
+
+    def test_summarize(self):
+        for night, expid in [(20260101, 1), (20260101, 2), (20260102, 3)]:
+            timer = self.timer(night, expid)
+            timer.add('qproc', 'b0', wall=10.0*expid, cpu=9.0, maxrss=100)
+            timer.add('qproc', 'r0', wall=1.0, cpu=1.0, maxrss=200)
+            timer.add('plots', 'amp', wall=0.5, cpu=0.5, maxrss=50)
+            timer.write()
+
+        self.assertEqual(timing.select_nights(self.outdir), [20260101, 20260102])
+        self.assertEqual(timing.select_nights(self.outdir, '20260102:'), [20260102])
+        self.assertEqual(timing.select_nights(self.outdir, '20260101,20260105'), [20260101])
+
+        files = timing.find_timing_files(self.outdir, [20260101,])
+        self.assertEqual(len(files), 2)
+        records = timing.read_timing(timing.find_timing_files(self.outdir))
+        self.assertEqual(len(records), 9)
+        self.assertEqual(records[0]['obstype'], 'SCIENCE')
+
+        summary = timing.summarize(records)
+        self.assertEqual(list(summary['NAME'][0:3]), ['b0', 'r0', 'amp'])
+        self.assertEqual(summary['NSTEP'][0], 3)
+        self.assertAlmostEqual(summary['WALL_TOTAL'][0], 60.0)
+        self.assertAlmostEqual(summary['WALL_MAX'][0], 30.0)
+        self.assertEqual(summary['MAXRSS'][1], 200)
+
+        summary = timing.summarize(records, by=('stage',))
+        self.assertEqual(list(summary['STAGE']), ['qproc', 'plots'])
+        self.assertEqual(summary['NSTEP'][0], 6)
+
+        self.assertEqual(len(timing.summarize(list())), 0)
+
+    def test_deadlines(self):
+        for expid in range(1, 6):
+            timer = self.timer(20260101, expid, obstype='ARC')
+            for i in range(10):
+                timer.add('qproc', 'b{}'.format(i), ok=True, wall=100.0 + i)
+            timer.add('qproc', 'r0', ok=False, wall=5000.0)
+            timer.write()
+
+        deadlines = QprocDeadlines(self.outdir, factor=2.0, minimum=60, default=900)
+        self.assertAlmostEqual(deadlines.get('ARC'), 2*np.percentile(list(range(100, 110))*5, 99))
+        self.assertEqual(deadlines.get('SCIENCE'), 900)
+
+        self.assertIsNone(timing.parse_qproc_timeout('none', self.outdir)('ARC'))
+        self.assertIsNone(timing.parse_qproc_timeout('0', self.outdir)('ARC'))
+        self.assertEqual(timing.parse_qproc_timeout('30', self.outdir)('ARC'), 30)
+
+    def test_timeout(self):
+        logfile = os.path.join(self.outdir, 'sleep.log')
+        t0 = time.time()
+        err = run.runcmd('sleep 10', logfile, 'sleep', timeout=0.5)
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(err, {'sleep.log': run.TIMEOUT_ERRORCODE})
+
+        err = run.runcmd('true', logfile, 'true', timeout=5)
+        self.assertEqual(err, {'sleep.log': 0})
+
+        with self.assertRaises(run.QprocTimeout):
+            with run.deadline(0.2):
+                time.sleep(5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import signal
+import unittest
+import multiprocessing as mp
+import multiprocessing.forkserver
+from concurrent.futures.process import BrokenProcessPool
+
+from nightwatch import run, workers
+
+def square(x):
+    return x*x
+
+def loaded(names):
+    '''Returns which of names were imported in this process, and its parent'''
+    return [name in sys.modules for name in names], os.getppid()
+
+def crash(x):
+    '''Dies like a segfault in a C extension for x<0, otherwise returns x'''
+    if x < 0:
+        os._exit(1)
+    return x
+
+def hang(x):
+    '''For x<0, blocks where the SIGALRM of run.deadline can't interrupt it'''
+    if x < 0:
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+        with run.deadline(0.1):
+            time.sleep(60)
+    return x
+
+def slow_followup(x):
+    '''Finishes after its imap_unordered timeout, but exempt from it'''
+    workers.end_deadline()
+    time.sleep(1)
+    return x
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        workers.shutdown()
+        #- allow two workers even on a single CPU
+        self.get_ncpu = run.get_ncpu
+        run.get_ncpu = lambda ncpu: 2 if ncpu is None else ncpu
+
+    def tearDown(self):
+        workers.shutdown()
+        workers.configure(ncpu=None, preload=workers.PRELOAD)
+        run.get_ncpu = self.get_ncpu
+
+    def test_parse_preload(self):
+        self.assertEqual(workers.parse_preload(None), workers.PRELOAD)
+        self.assertEqual(workers.parse_preload(''), ())
+        self.assertEqual(workers.parse_preload('numpy, fitsio'), ('numpy', 'fitsio'))
+        self.assertEqual(workers.parse_preload('+blat'), workers.PRELOAD + ('blat',))
+        with self.assertRaises(ValueError):
+            workers.configure(start_method='blat')
+
+    def test_pool_reused(self):
+        workers.configure(ncpu=2, start_method='spawn', preload=())
+        self.assertEqual(workers.get_ncpu(), 2)
+
+        pids = workers.starmap(os.getpid, [()]*4)
+        pool = workers.get_pool()
+        self.assertEqual(workers.starmap(square, [(i,) for i in range(5)]), [0, 1, 4, 9, 16])
+        self.assertEqual(sorted(workers.imap_unordered(square, [(i,) for i in range(5)])),
+                         [0, 1, 4, 9, 16])
+        pids += workers.starmap(os.getpid, [()]*4)
+
+        #- every call ran in the same two worker processes
+        self.assertIs(workers.get_pool(), pool)
+        self.assertNotIn(os.getpid(), pids)
+        self.assertLessEqual(len(set(pids)), 2)
+
+        #- resizing a running pool is ignored
+        workers.configure(ncpu=3)
+        self.assertIs(workers.get_pool(), pool)
+        self.assertEqual(workers.get_ncpu(), 2)
+
+    @unittest.skipUnless('forkserver' in mp.get_all_start_methods(), 'forkserver is not available')
+    def test_forkserver(self):
+        #- a forkserver started by another test would keep its own preload
+        mp.forkserver._forkserver._stop()
+        self.assertNotIn('tabnanny', sys.modules)
+        workers.configure(ncpu=2, start_method='forkserver', preload=['tabnanny'])
+
+        workers.warmup()
+        self.assertIsNotNone(workers._pool)
+
+        #- workers are forked from the forkserver with the preload imported
+        results = workers.starmap(loaded, [(['tabnanny'],)]*2)
+        for imported, ppid in results:
+            self.assertEqual(imported, [True,])
+            self.assertNotEqual(ppid, os.getpid())
+        self.assertNotIn('tabnanny', sys.modules)
+
+    def test_serial(self):
+        workers.configure(ncpu=1, preload=())
+        self.assertFalse(workers.parallel(4))
+        self.assertEqual(workers.starmap(os.getpid, [()]*3), [os.getpid()]*3)
+        self.assertEqual(list(workers.imap_unordered(square, [(i,) for i in range(4)])),
+                         [0, 1, 4, 9])
+        workers.warmup()
+        self.assertIsNone(workers._pool)
+
+        #- ncpu=1 per call also runs serially
+        workers.configure(ncpu=2, preload=())
+        self.assertEqual(workers.starmap(os.getpid, [()]*3, ncpu=1), [os.getpid()]*3)
+        self.assertIsNone(workers._pool)
+
+    def test_worker_died(self):
+        workers.configure(ncpu=2, start_method='spawn', preload=())
+
+        #- a dead worker fails the call instead of hanging it
+        pool = workers.get_pool()
+        with self.assertRaises(BrokenProcessPool):
+            workers.starmap(crash, [(1,), (-1,), (2,)])
+
+        #- and the next call gets a new pool
+        self.assertEqual(workers.starmap(crash, [(1,), (2,)]), [1, 2])
+        self.assertIsNot(workers.get_pool(), pool)
+
+        #- on_error replaces the results of the tasks that were lost
+        results = list(workers.imap_unordered(crash, [(1,), (-1,), (2,)],
+                                              on_error=lambda args, err: ('lost', args)))
+        self.assertEqual(len(results), 3)
+        self.assertIn(('lost', (-1,)), results)
+        self.assertEqual(workers.starmap(crash, [(3,), (4,)]), [3, 4])
+
+    def test_timeout(self):
+        workers.configure(ncpu=2, start_method='spawn', preload=())
+
+        #- the parent kills a worker stuck past the timeout
+        t0 = time.time()
+        results = list(workers.imap_unordered(hang, [(1,), (-1,)], timeout=0.5,
+                                              on_error=lambda args, err: (args, type(err))))
+        self.assertLess(time.time() - t0, 30)
+        self.assertIn(1, results)
+        self.assertIn(((-1,), workers.TaskTimeout), results)
+
+        #- without on_error the timeout is raised
+        with self.assertRaises(workers.TaskTimeout):
+            list(workers.imap_unordered(hang, [(-1,), (-2,)], timeout=0.5))
+
+        #- time after end_deadline doesn't count
+        results = workers.imap_unordered(slow_followup, [(1,), (2,)], timeout=0.3)
+        self.assertEqual(sorted(results), [1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+'''
+Wall time, CPU time, and peak memory of each processing step
+
+Each exposure gets an ExposureTimer that collects one record per step:
+
+  * stage=fibermap : assemble_fibermap
+  * stage=qproc, name=CAMERA : qproc for each camera
+  * stage=camera_qa, name=CAMERA : per-camera QA run right after qproc
+  * stage=qa, name=QACLASS : each QA class in QARunner.run
+  * stage=plots, name=PAGE : each page in make_plots
+  * stage=tables : write_tables (shared by exposures updated together)
+  * stage=exposure : the whole exposure from submission to finish
+
+Each record has the step's start time, wall time, CPU time, and peak RSS,
+and the timer writes them to OUTDIR/YEARMMDD/EXPID/timing-EXPID.json.
+CPU time is that of the thread running the step plus any subprocesses it
+waited for, e.g. desi_qproc in subprocess mode; it doesn't include work
+farmed out to the shared worker pool, which is measured by the steps
+running in the workers (e.g. each camera's qproc).  Peak RSS is the high
+water mark of the process running the step (or its largest subprocess) at
+the end of the step; since workers are reused, it is an upper bound for
+the step itself.
+
+`read_timing` and `summarize` aggregate the records of many exposures, as
+used by `nightwatch timing`, and `QprocDeadlines` derives per-camera qproc
+timeouts for each OBSTYPE from them.
+'''
+
+import os, time
+import glob
+import json
+import resource
+import threading
+import contextlib
+
+import numpy as np
+
+#- ru_maxrss is in kilobytes on Linux, bytes on macOS
+_MAXRSS_UNITS = 1 if os.uname().sysname == 'Darwin' else 1024
+
+
+def _snapshot():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.time(), time.thread_time(), children.ru_utime + children.ru_stime)
+
+
+def _maxrss():
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss * _MAXRSS_UNITS
+
+
+@contextlib.contextmanager
+def measure():
+    '''
+    Context manager measuring the enclosed block
+
+    Yields a dict that is filled with start, wall, cpu [seconds] and
+    maxrss [bytes] when the block exits, even if it raises an exception
+    '''
+    result = dict()
+    t0, cpu0, child0 = _snapshot()
+    try:
+        yield result
+    finally:
+        t1, cpu1, child1 = _snapshot()
+        result.update(start=t0, wall=t1-t0, cpu=(cpu1-cpu0) + (child1-child0),
+                      maxrss=_maxrss())
+
+
+class ExposureTimer(object):
+    '''Collect timing records for one exposure'''
+
+    def __init__(self, filename, night, expid, obstype=None):
+        '''
+        Args:
+            filename : timing JSON file to write
+            night : YEARMMDD
+            expid : exposure ID
+
+        Options:
+            obstype : OBSTYPE of the exposure, if known
+        '''
+        self.filename = filename
+        self.night = int(night)
+        self.expid = int(expid)
+        self.obstype = obstype
+        self.records = list()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def time(self, stage, name=None):
+        '''
+        Context manager recording the enclosed block as stage/name, with
+        ok=False if it raised an exception
+        '''
+        ok = False
+        try:
+            with measure() as result:
+                yield result
+            ok = True
+        finally:
+            self.add(stage, name, ok=ok, **result)
+
+    def add(self, stage, name=None, **values):
+        '''Add record for stage/name with values like wall, cpu, maxrss'''
+        record = dict(stage=stage, name=name)
+        record.update(values)
+        with self._lock:
+            self.records.append(record)
+
+    def extend(self, records):
+        '''Add list of record dicts, e.g. measured in a worker process'''
+        with self._lock:
+            self.records.extend(records)
+
+    def write(self):
+        '''Write records to self.filename'''
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with self._lock:
+            data = dict(night=self.night, expid=self.expid, obstype=self.obstype,
+                        records=list(self.records))
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as fx:
+            json.dump(data, fx, indent=1)
+        os.replace(tmpfile, self.filename)
+
+    def __repr__(self):
+        return 'ExposureTimer({}/{:08d}, {} records)'.format(
+            self.night, self.expid, len(self.records))
+
+
+def timed(timer, stage, name=None):
+    '''Returns timer.time(stage, name), or a no-op context if timer is None'''
+    if timer is None:
+        return contextlib.nullcontext(dict())
+    return timer.time(stage, name)
+
+
+def select_nights(basedir, spec=None):
+    '''
+    Returns sorted list of YEARMMDD nights in basedir matching spec
+
+    Args:
+        basedir : base output directory with YEARMMDD subdirectories
+
+    Options:
+        spec : comma separated list of nights, or FIRST:LAST for an
+            inclusive range where either end may be omitted; default all
+    '''
+    nightdirs = glob.glob(os.path.join(basedir, '20[0-9][0-9][01][0-9][0-3][0-9]'))
+    nights = sorted([int(os.path.basename(d)) for d in nightdirs if os.path.isdir(d)])
+    if spec is None or spec.strip() == '':
+        return nights
+
+    if ':' in spec:
+        first, last = spec.split(':')
+        first = int(first) if first.strip() else 0
+        last = int(last) if last.strip() else 99999999
+        return [n for n in nights if first <= n <= last]
+
+    wanted = set([int(n) for n in spec.split(',')])
+    return [n for n in nights if n in wanted]
+
+
+def find_timing_files(basedir, nights=None):
+    '''
+    Returns sorted list of timing files in basedir/YEARMMDD/EXPID/
+
+    Options:
+        nights : list of YEARMMDD nights to include; default all
+    '''
+    if nights is None:
+        nightdirs = glob.glob(os.path.join(basedir, '20[0-9][0-9][01][0-9][0-3][0-9]'))
+    else:
+        nightdirs = [os.path.join(basedir, str(night)) for night in nights]
+
+    files = list()
+    for nightdir in nightdirs:
+        files.extend(glob.glob(os.path.join(nightdir, '[0-9]*', 'timing-*.json')))
+
+    return sorted(files)
+
+
+def read_timing(filenames):
+    '''
+    Returns list of timing records from filenames, each record including the
+    night, expid, and obstype of its exposure
+    '''
+    records = list()
+    for filename in filenames:
+        try:
+            with open(filename) as fx:
+                data = json.load(fx)
+        except (OSError, ValueError):
+            continue
+
+        for record in data['records']:
+            record = dict(record)
+            for key in ('night', 'expid', 'obstype'):
+                record[key] = data.get(key)
+            records.append(record)
+
+    return records
+
+
+def summarize(records, by=('stage', 'name')):
+    '''
+    Aggregate timing records
+
+    Args:
+        records : list of timing record dicts, e.g. from read_timing
+
+    Options:
+        by : tuple of record keys to group by, e.g. ('stage',) or
+            ('stage', 'obstype')
+
+    Returns astropy Table with one row per group and columns for the group
+    keys plus NSTEP, WALL_TOTAL, WALL_MEAN, WALL_P50, WALL_P90, WALL_MAX,
+    CPU_TOTAL [seconds], and MAXRSS [bytes], sorted by decreasing WALL_TOTAL
+    '''
+    from astropy.table import Table
+
+    groups = dict()
+    for record in records:
+        key = tuple([str(record.get(k)) for k in by])
+        groups.setdefault(key, list()).append(record)
+
+    rows = list()
+    for key, group in groups.items():
+        wall = np.array([r.get('wall', 0.0) for r in group])
+        cpu = np.array([r.get('cpu', 0.0) for r in group])
+        maxrss = max([r.get('maxrss', 0) for r in group])
+        rows.append(list(key) + [len(group), wall.sum(), wall.mean(),
+                    np.percentile(wall, 50), np.percentile(wall, 90), wall.max(),
+                    cpu.sum(), maxrss])
+
+    names = [k.upper() for k in by] + ['NSTEP', 'WALL_TOTAL', 'WALL_MEAN', 'WALL_P50',
+             'WALL_P90', 'WALL_MAX', 'CPU_TOTAL', 'MAXRSS']
+    if len(rows) == 0:
+        return Table(names=names, dtype=[str]*len(by) + [int] + [float]*6 + [int])
+
+    table = Table(rows=rows, names=names)
+    table.sort('WALL_TOTAL', reverse=True)
+    return table
+
+
+#- qproc timeout [sec] per camera for OBSTYPEs without enough history
+DEFAULT_QPROC_TIMEOUT = 900
+
+
+class QprocDeadlines(object):
+    '''Per-camera qproc timeouts by OBSTYPE, derived from the timing history'''
+
+    def __init__(self, basedir, nnights=10, quantile=99, factor=2.0, minimum=120,
+                 default=DEFAULT_QPROC_TIMEOUT, min_samples=30, refresh=3600):
+        '''
+        Args:
+            basedir : nightwatch output base directory with timing files
+
+        Options:
+            nnights : use the timing files of the most recent nnights nights
+            quantile : percentile of successful qproc wall times to use
+            factor : timeout is factor times that percentile ...
+            minimum : ... but at least this many seconds
+            default : timeout for OBSTYPEs with fewer than min_samples cameras
+            min_samples : minimum number of timed cameras for an OBSTYPE
+            refresh : reread the timing history after this many seconds
+        '''
+        self.basedir = basedir
+        self.nnights = nnights
+        self.quantile = quantile
+        self.factor = factor
+        self.minimum = minimum
+        self.default = default
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self.timeouts = dict()
+        self._time_loaded = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''Read the timing history and update self.timeouts'''
+        nights = select_nights(self.basedir)[-self.nnights:]
+        records = read_timing(find_timing_files(self.basedir, nights))
+
+        walltimes = dict()
+        for record in records:
+            if record.get('stage') == 'qproc' and record.get('ok') and 'wall' in record:
+                walltimes.setdefault(record['obstype'], list()).append(record['wall'])
+
+        timeouts = dict()
+        for obstype, wall in walltimes.items():
+            if len(wall) >= self.min_samples:
+                t = self.factor * np.percentile(wall, self.quantile)
+                timeouts[obstype] = float(max(self.minimum, t))
+
+        self.timeouts = timeouts
+        self._time_loaded = time.time()
+        return timeouts
+
+    def get(self, obstype):
+        '''Returns qproc timeout in seconds per camera for obstype'''
+        with self._lock:
+            if self._time_loaded is None or time.time() - self._time_loaded > self.refresh:
+                self.load()
+            return self.timeouts.get(obstype, self.default)
+
+    def __repr__(self):
+        return 'QprocDeadlines({})'.format(', '.join(
+            ['{}={:.0f}s'.format(k, v) for k, v in sorted(self.timeouts.items())]))
+
+
+def parse_qproc_timeout(spec, basedir):
+    '''
+    Parse a --qproc-timeout option
+
+    Args:
+        spec : "auto" to derive timeouts from the timing history in basedir,
+            a number of seconds, or "none" or 0 for no timeout
+        basedir : nightwatch output base directory
+
+    Returns function(obstype) -> timeout in seconds or None
+    '''
+    if spec is None or spec.lower() == 'none':
+        return lambda obstype: None
+    elif spec.lower() == 'auto':
+        return QprocDeadlines(basedir).get
+    else:
+        timeout = float(spec)
+        if timeout <= 0:
+            return lambda obstype: None
+        return lambda obstype: timeout
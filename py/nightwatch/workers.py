@@ -0,0 +1,406 @@
+'''
+Process-wide worker pool shared by all nightwatch processing stages
+
+Instead of every stage creating and tearing down its own multiprocessing
+Pool, qproc, QA, plotting, and tables all submit work to a single pool that
+is created on first use and lives as long as the monitor or run command.
+The pool size is the global concurrency budget: pipeline threads may submit
+work concurrently, but never more than `ncpu` tasks run at once.
+
+Calls from within a pool worker run serially rather than starting pools of
+their own.
+
+The pool is a concurrent.futures.ProcessPoolExecutor rather than a
+multiprocessing Pool, so that a worker dying in a task (e.g. a segfault in
+a C extension, or the OOM killer) fails the tasks it took down with
+BrokenProcessPool instead of leaving them waiting forever.  The broken pool
+is then discarded, and the next call starts a new one.  The same mechanism
+enforces `imap_unordered` timeouts: workers report when each task starts,
+and the parent kills a worker whose task runs past its timeout, which
+works even when the task is stuck in C code that no signal handler within
+the worker would interrupt.
+
+Workers are started with a forkserver by default: the forkserver imports
+the PRELOAD modules once, and every worker forked from it starts with them
+already imported, without inheriting threads, open inotify/sqlite handles,
+or matplotlib/bokeh state from the monitor.  The spawn start method is
+available as a fallback, in which case each worker imports the PRELOAD
+modules as it starts rather than on its first task.
+'''
+
+import atexit
+import importlib
+import itertools
+import os, time
+import signal
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import desiutil.log
+
+#- heavy modules used by qproc, QA, and plotting tasks
+PRELOAD = ('numpy', 'scipy.ndimage', 'fitsio', 'astropy.table',
+           'desispec.io', 'desispec.preproc', 'desispec.qproc.io',
+           'desispec.scripts.qproc',
+           'bokeh.plotting', 'nightwatch.run', 'nightwatch.qa.runner',
+           'nightwatch.webpages.plotimage')
+
+START_METHODS = ('forkserver', 'spawn')
+
+#- how often imap_unordered checks for tasks past their timeout [sec]
+POLL_INTERVAL = 0.5
+
+_lock = threading.Lock()
+_pool = None
+_taskids = itertools.count()
+_in_worker = False
+_started = None
+_task = None
+_ncpu = None
+_start_method = None
+_preload = PRELOAD
+
+
+def default_start_method():
+    '''Returns forkserver if supported on this platform, otherwise spawn'''
+    if 'forkserver' in mp.get_all_start_methods():
+        return 'forkserver'
+    else:
+        return 'spawn'
+
+
+def parse_preload(spec):
+    '''
+    Parse comma separated list of modules to preload in workers
+
+    Args:
+        spec : comma separated module names, None for the default PRELOAD
+            list, or '' for none.  A leading '+' adds to the default list.
+
+    Returns tuple of module names
+    '''
+    if spec is None:
+        return PRELOAD
+
+    spec = spec.strip()
+    if spec.startswith('+'):
+        modules = list(PRELOAD)
+        spec = spec[1:]
+    else:
+        modules = list()
+
+    modules.extend([m.strip() for m in spec.split(',') if m.strip() != ''])
+    return tuple(modules)
+
+
+def configure(ncpu=None, start_method=None, preload=None):
+    '''
+    Set the size and bootstrap mode of the shared pool
+
+    Options:
+        ncpu : number of worker processes; default from run.get_ncpu
+        start_method : 'forkserver' or 'spawn'; default forkserver if available
+        preload : list of modules to import in workers before their first
+            task; default PRELOAD
+
+    Must be called before the pool is first used to have any effect;
+    otherwise logs a warning and keeps the existing pool.
+    '''
+    global _ncpu, _start_method, _preload
+    if start_method is not None and start_method not in START_METHODS:
+        raise ValueError('Unknown start method {}; expected one of {}'.format(
+            start_method, START_METHODS))
+
+    with _lock:
+        if _pool is not None:
+            if ncpu is not None and ncpu != _ncpu:
+                log = desiutil.log.get_logger()
+                log.warning('Worker pool already running with {} processes; ignoring ncpu={}'.format(_ncpu, ncpu))
+            return
+        _ncpu = ncpu
+        _start_method = start_method
+        if preload is not None:
+            _preload = tuple(preload)
+
+
+def get_ncpu():
+    '''Returns the number of worker processes the shared pool uses'''
+    from .run import get_ncpu as _get_ncpu
+    if _ncpu is None:
+        return _get_ncpu(None)
+    else:
+        return _get_ncpu(_ncpu)
+
+
+def in_worker():
+    '''Returns True if called from within a pool worker process'''
+    return _in_worker
+
+
+def _import_modules(modules):
+    '''Import modules, logging but otherwise ignoring any that fail'''
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as err:
+            log = desiutil.log.get_logger()
+            log.warning('Unable to preload {}: {}'.format(name, err))
+
+
+def _init_worker(modules, started):
+    '''
+    Pool worker initializer: mark this process as a worker, keep the queue
+    for reporting task starts to the parent, and import modules
+    '''
+    global _in_worker, _started
+    _in_worker = True
+    _started = started
+    _import_modules(modules)
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+class TaskTimeout(Exception):
+    '''A pool task ran past its `imap_unordered` timeout and its worker was killed'''
+    pass
+
+
+def _run_task(taskid, func, args):
+    '''Run func(*args) in a worker, reporting its start and end to the parent'''
+    global _task
+    _task = taskid
+    _started.put((taskid, os.getpid(), time.time()))
+    try:
+        return func(*args)
+    finally:
+        end_deadline()
+
+
+def end_deadline():
+    '''
+    Exempt the rest of the current pool task from its `imap_unordered`
+    timeout, e.g. for follow-up work after the step the timeout is for
+
+    No-op outside of a pool task with a timeout.
+    '''
+    global _task
+    if _task is not None:
+        _started.put((_task, os.getpid(), None))
+        _task = None
+
+
+class _Pool(ProcessPoolExecutor):
+    '''ProcessPoolExecutor whose workers report when each timed task starts'''
+
+    def __init__(self, ncpu, context, preload):
+        self._started = context.SimpleQueue()
+        self._running = dict()
+        self._running_lock = threading.Lock()
+        super().__init__(ncpu, mp_context=context, initializer=_init_worker,
+                         initargs=(preload, self._started))
+
+    def kill_overdue(self, taskids, timeout):
+        '''
+        Kill the workers running any of `taskids` for more than `timeout` sec
+
+        Returns list of the taskids whose workers were killed
+        '''
+        killed = list()
+        with self._running_lock:
+            while not self._started.empty():
+                taskid, pid, start = self._started.get()
+                if start is None:
+                    self._running.pop(taskid, None)
+                else:
+                    self._running[taskid] = (pid, start)
+
+            now = time.time()
+            for taskid in taskids:
+                if taskid in self._running and now - self._running[taskid][1] > timeout:
+                    pid, start = self._running.pop(taskid)
+                    log = desiutil.log.get_logger()
+                    log.error('Killing worker process {} after {:.0f} sec timeout'.format(
+                        pid, now - start))
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    killed.append(taskid)
+
+        return killed
+
+
+def get_pool():
+    '''Returns the shared ProcessPoolExecutor, creating it if needed'''
+    global _pool
+    with _lock:
+        if _pool is None:
+            ncpu = get_ncpu()
+            start_method = _start_method or default_start_method()
+            log = desiutil.log.get_logger()
+            log.info('Starting shared worker pool with {} {} processes'.format(
+                ncpu, start_method))
+
+            #- one thread per worker for OpenMP/BLAS; must be set before the
+            #- forkserver or spawned workers import numpy
+            from .resources import get_budget
+            os.environ.update(get_budget().worker_environ())
+
+            t0 = time.time()
+            context = mp.get_context(start_method)
+            if start_method == 'forkserver':
+                context.set_forkserver_preload(list(_preload))
+
+            #- with forkserver the initializer is a no-op for modules that
+            #- were preloaded; with spawn it does the imports
+            _pool = _Pool(ncpu, context, _preload)
+
+            #- wait for a round trip so that the warm-up cost is paid (and
+            #- reported) here rather than by the first exposure
+            for future in [_pool.submit(_worker_ready) for i in range(ncpu)]:
+                future.result()
+            log.info('Worker pool warm-up took {:.1f} sec for {} workers'.format(
+                time.time() - t0, ncpu))
+
+        return _pool
+
+
+def warmup():
+    '''Start the shared pool now, if it would be used, instead of on first use'''
+    if get_ncpu() > 1 and not in_worker():
+        get_pool()
+
+
+def _discard_pool(pool):
+    '''Stop using pool after one of its workers died; get_pool starts a new one'''
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+            log = desiutil.log.get_logger()
+            log.error('A worker process died; restarting the shared worker pool')
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parallel(ntasks, ncpu=None):
+    '''
+    Returns True if `starmap` would run `ntasks` tasks in the shared pool
+
+    Options:
+        ncpu : as passed to `starmap`
+    '''
+    return (ntasks > 1) and not in_worker() and \
+           (ncpu is None or ncpu > 1) and get_ncpu() > 1
+
+
+def starmap(func, argslist, ncpu=None):
+    '''
+    Run func(*args) for each args in argslist, in parallel if possible
+
+    Args:
+        func : function to call; must be picklable (e.g. module level)
+        argslist : list of argument tuples
+
+    Options:
+        ncpu : if <= 1, run serially in this process
+
+    Returns list of results in the same order as argslist.  Runs serially
+    if there is only one task, if the pool has only one process, or if
+    called from within a pool worker.  Raises BrokenProcessPool if a worker
+    died before all tasks finished.
+    '''
+    argslist = list(argslist)
+    if not parallel(len(argslist), ncpu):
+        return [func(*args) for args in argslist]
+
+    pool = get_pool()
+    try:
+        futures = [pool.submit(func, *args) for args in argslist]
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+
+
+def imap_unordered(func, argslist, ncpu=None, on_error=None, timeout=None):
+    '''
+    Like `starmap`, but yields results as soon as each task finishes
+
+    Args:
+        func : function to call; must be picklable (e.g. module level)
+        argslist : list of argument tuples
+
+    Options:
+        ncpu : if <= 1, run serially in this process
+        on_error : function(args, err) called in this process for each task
+            lost because a worker died, returning the result to yield in its
+            place; default raise the error.  err is TaskTimeout for a task
+            killed after its timeout, otherwise BrokenProcessPool.
+        timeout : kill the worker of a task that runs longer than this many
+            seconds (or until it calls `end_deadline`), which also loses the
+            other tasks running in the pool.  Only applies in the pool.
+
+    Yields results in the order the tasks finish, which is the order of
+    argslist when running serially.
+    '''
+    argslist = list(argslist)
+    if not parallel(len(argslist), ncpu):
+        for args in argslist:
+            yield func(*args)
+        return
+
+    pool = get_pool()
+    futures = dict()
+    lost = list()
+    for args in argslist:
+        taskid = next(_taskids)
+        try:
+            if timeout is None:
+                future = pool.submit(func, *args)
+            else:
+                future = pool.submit(_run_task, taskid, func, args)
+            futures[future] = (taskid, args)
+        except BrokenProcessPool as err:
+            lost.append((args, err))
+
+    killed = set()
+    pending = set(futures)
+    while len(pending) > 0:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED,
+                             timeout=None if timeout is None else POLL_INTERVAL)
+        for future in done:
+            taskid, args = futures[future]
+            try:
+                result = future.result()
+            except BrokenProcessPool as err:
+                if taskid in killed:
+                    err = TaskTimeout('Worker killed after {:.0f} sec timeout'.format(timeout))
+                lost.append((args, err))
+                continue
+            yield result
+
+        if timeout is not None:
+            killed.update(pool.kill_overdue([futures[f][0] for f in pending], timeout))
+
+    if len(lost) > 0:
+        _discard_pool(pool)
+        if on_error is None:
+            raise lost[0][1]
+        for args, err in lost:
+            yield on_error(args, err)
+
+
+def shutdown():
+    '''Finish running tasks and stop the shared pool'''
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+
+atexit.register(shutdown)